@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate a synthetic DocBook book made of modules.
+
+Usage: corpus.py <dir> [<name>=<value>...]
+
+Writes book.xml and the files it includes to <dir>. The parameters (see
+DEFAULTS) are:
+
+modules        Number of module files, each a chapter with sections
+sections       Sections per module, each with PARAGRAPHS paragraphs
+depth          Length of the include chains: the book includes every
+               depth-th module, which includes the next one and so on
+fragid_reuse   Paragraphs of other modules each module includes by fragid,
+               so their IDs are duplicated
+links          xref and link elements per paragraph, to sections of the module
+linkscope      trans:linkscope of the includes: near, local, global, user
+               or mixed to use them in turn
+idfixup        trans:idfixup of the includes: none, suffix, auto or mixed
+text_includes  parse="text/plain" includes per module, every other one
+               with a fragid selecting some lines
+text_lines     Lines of each of the TEXT_FILES included as text
+"""
+
+import os.path
+import sys
+
+from process_tree import HEADER
+
+DEFAULTS = {
+    "modules": 40,
+    "sections": 10,
+    "depth": 1,
+    "fragid_reuse": 0,
+    "links": 2,
+    "linkscope": "near",
+    "idfixup": "auto",
+    "text_includes": 0,
+    "text_lines": 50,
+}
+
+LINKSCOPES = ["near", "local", "global", "user"]
+IDFIXUPS = ["none", "suffix", "auto"]
+
+# Paragraphs per section and number of different text files
+PARAGRAPHS = 3
+TEXT_FILES = 8
+
+
+def include(href, label, index, params, extra=""):
+    """Return an xi:include of href with the transclusion attributes.
+
+    :param label: Unique suffix for trans:suffix
+    :param index: Number of the include, selects the values of mixed
+    :param extra: More attributes
+    """
+
+    linkscope, idfixup = params["linkscope"], params["idfixup"]
+    if linkscope == "mixed":
+        linkscope = LINKSCOPES[index % len(LINKSCOPES)]
+    if idfixup == "mixed":
+        idfixup = IDFIXUPS[index % len(IDFIXUPS)]
+
+    return (
+        '<xi:include href="{0}"{1} trans:idfixup="{2}" trans:suffix="-{3}" '
+        'trans:linkscope="{4}"/>'.format(href, extra, idfixup, label, linkscope)
+    )
+
+
+def write_text(path, lines):
+    """Write a text file with the given number of lines to path."""
+    with open(path, "w") as file:
+        for line in range(lines):
+            file.write("line {0}: if (a < b && c > d) return;\n".format(line))
+
+
+def write_module(path, number, params):
+    """Write module number to path.
+
+    Links point to the sections of the module, which are children of the
+    included chapter, so they can be resolved with any linkscope. The first
+    paragraph of each section has no links and no includes, those are reused
+    by other modules.
+    """
+
+    modules, sections = params["modules"], params["sections"]
+    with open(path, "w") as file:
+        file.write(HEADER.format("chapter", ' xml:id="m{0}"'.format(number)))
+        file.write("<title>Module {0}</title>".format(number))
+        for sect in range(sections):
+            prefix = "m{0}s{1}".format(number, sect)
+            file.write('<section xml:id="{0}"><title>{0}</title>'.format(prefix))
+            file.write('<para xml:id="{0}p0">Text.</para>'.format(prefix))
+            for para in range(1, PARAGRAPHS):
+                file.write('<para xml:id="{0}p{1}">Text'.format(prefix, para))
+                for link in range(params["links"]):
+                    target = "m{0}s{1}".format(number, (sect + link + 1) % sections)
+                    if link % 2:
+                        file.write(' <link linkend="{0}">link</link>'.format(target))
+                    else:
+                        file.write(' <xref linkend="{0}"/>'.format(target))
+                file.write(".</para>")
+
+            for text in range(sect, params["text_includes"], sections):
+                extra = ' parse="text/plain"'
+                if text % 2:
+                    start = text * 7 % max(params["text_lines"] - 10, 1)
+                    extra += ' fragid="line={0},{1}"'.format(start, start + 10)
+                href = "text{0}.txt".format(text % TEXT_FILES)
+                label = "m{0}t{1}".format(number, text)
+                file.write("<programlisting>")
+                file.write(include(href, label, number + text, params, extra))
+                file.write("</programlisting>")
+
+            for reuse in range(sect, params["fragid_reuse"], sections):
+                other = (number + reuse + 1) % modules
+                fragid = ' fragid="m{0}s{1}p0"'.format(other, reuse % sections)
+                href = "module{0}.xml".format(other)
+                label = "m{0}r{1}".format(number, reuse)
+                file.write(include(href, label, number + reuse, params, fragid))
+
+            if sect == sections - 1 and (number + 1) % params["depth"]:
+                if number + 1 < modules:
+                    href = "module{0}.xml".format(number + 1)
+                    label = "m{0}c".format(number)
+                    file.write(include(href, label, number, params))
+            file.write("</section>")
+        file.write("</chapter>")
+
+
+def write_corpus(directory, **params):
+    """Write book.xml and its modules to directory.
+
+    :param params: Parameters overriding DEFAULTS
+    :return: Path of book.xml
+    """
+
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown parameters: {0}".format(", ".join(sorted(unknown))))
+    params = dict(DEFAULTS, **params)
+    if min(params["modules"], params["sections"], params["depth"]) < 1:
+        raise ValueError("modules, sections and depth must be positive")
+
+    for number in range(params["modules"]):
+        path = os.path.join(directory, "module{0}.xml".format(number))
+        write_module(path, number, params)
+    for number in range(min(params["text_includes"], TEXT_FILES)):
+        path = os.path.join(directory, "text{0}.txt".format(number))
+        write_text(path, params["text_lines"])
+
+    book = os.path.join(directory, "book.xml")
+    with open(book, "w") as file:
+        file.write(HEADER.format("book", ' xml:id="book"'))
+        file.write("<title>Book</title>")
+        for number in range(0, params["modules"], params["depth"]):
+            href = "module{0}.xml".format(number)
+            file.write(include(href, "b{0}".format(number), number, params))
+        file.write("</book>")
+
+    return book
+
+
+def parse_params(args):
+    """Return a dict of the <name>=<value> strings args, with the values
+    converted to the type of the defaults.
+
+    :raises ValueError: Invalid argument
+    """
+
+    params = {}
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name not in DEFAULTS:
+            raise ValueError("Unknown parameter {0!r}".format(name))
+        params[name] = type(DEFAULTS[name])(value)
+
+    return params
+
+
+def main(argv):
+    """Write the corpus described by argv."""
+    if len(argv) < 2:
+        sys.stderr.write(__doc__)
+        return 1
+
+    try:
+        book = write_corpus(argv[1], **parse_params(argv[2:]))
+    except ValueError as exc:
+        sys.stderr.write("{0}\n".format(str(exc)))
+        return 1
+
+    print(book)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark docbook.process_tree on a generated book.
+
+Usage: process_tree.py [<chapters> [<sections> [<repeat>]]]
+
+The book includes a module with idfixup="auto" or "suffix" per chapter,
+each module contains sections with IDs, fallbacks and references.
+Prints the number of elements of the result and the best time of all runs.
+"""
+
+import contextlib
+import io
+import os.path
+import sys
+import tempfile
+import time
+
+import lxml.etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dbxincluder import docbook  # noqa: E402
+
+HEADER = (
+    '<{0} xmlns="http://docbook.org/ns/docbook" '
+    'xmlns:xi="http://www.w3.org/2001/XInclude" '
+    'xmlns:trans="http://docbook.org/ns/transclude" version="5.0"{1}>'
+)
+
+
+def write_module(path, sections):
+    """Write a module with the given number of sections to path."""
+    with open(path, "w") as file:
+        file.write(HEADER.format("chapter", ' xml:id="module"'))
+        file.write("<title>Module</title>")
+        for sect in range(sections):
+            file.write('<section xml:id="s{0}"><title>S{0}</title>'.format(sect))
+            for para in range(5):
+                file.write(
+                    '<para xml:id="s{0}p{1}">See <xref linkend="s{0}"/> and '
+                    '<link linkend="s{2}">next</link>.</para>'.format(
+                        sect, para, (sect + 1) % sections
+                    )
+                )
+            file.write(
+                '<xi:include href="missing.xml"><xi:fallback><para>Fallback'
+                "</para><note><para>Note</para></note></xi:fallback></xi:include>"
+            )
+            file.write("</section>")
+        file.write("</chapter>")
+
+
+def write_book(path, chapters):
+    """Write a book including module.xml chapters times to path."""
+    with open(path, "w") as file:
+        file.write(HEADER.format("book", ' trans:suffix="-book"'))
+        file.write("<title>Book</title>")
+        for chapter in range(chapters):
+            idfixup = "auto" if chapter % 2 else "suffix"
+            file.write(
+                '<xi:include href="module.xml" trans:idfixup="{0}"/>'.format(idfixup)
+            )
+        file.write("</book>")
+
+
+def run(directory, repeat):
+    """Return tuple (elements, best time in seconds) of processing the book."""
+    book = os.path.join(directory, "book.xml")
+    best = None
+    for _ in range(repeat):
+        tree = lxml.etree.parse(book)
+        start = time.perf_counter()
+        # Ignore the warnings about missing.xml
+        with contextlib.redirect_stderr(io.StringIO()):
+            docbook.process_tree(tree.getroot(), book, None, book)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return sum(1 for _ in tree.iter()), best
+
+
+def main(argv):
+    """Generate the book and print the results."""
+    chapters = int(argv[1]) if len(argv) > 1 else 100
+    sections = int(argv[2]) if len(argv) > 2 else 20
+    repeat = int(argv[3]) if len(argv) > 3 else 5
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_module(os.path.join(directory, "module.xml"), sections)
+        write_book(os.path.join(directory, "book.xml"), chapters)
+        elements, best = run(directory, repeat)
+
+    print("{0} elements: {1:.3f}s".format(elements, best))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark suite: time the phases of processing generated books and
+compare them with a baseline.
+
+Usage:
+  suite.py [options] [<scenario>...]
+
+Each scenario varies one parameter of corpus.write_corpus (see SCENARIOS)
+and processes the book of each value, with cold caches, as often as --repeat
+says. The best time of each phase counts. Before each run, a fixed lxml
+workload is timed as well, its best time is the calibration of the point.
+Total times divided by it are comparable across machines and load. For
+numeric parameters, the scaling exponent is how the normalized total time
+grows with the value: 1 is linear, 2 quadratic.
+
+A point fails if it's slower than the baseline by more than --tolerance,
+after scaling the baseline by the calibrations, a scenario fails if its
+exponent grew by more than --margin. Scenarios or points missing from the
+baseline are not compared.
+
+Known limits, like a phase which grows faster than the others, are noted in
+the "limits" list of the baseline. Each names a scenario and a phase and the
+maximum ratio of its time at the last point to the time at the first point.
+They are checked as well and kept when the baseline is saved.
+
+The baseline file has a "full" part and a "check" part for --check, which
+runs all scenarios on the small corpus of CHECK_PARAMS, quick enough for
+tox -e bench.
+
+Options:
+  --repeat <n>       Runs per point [default: 3]
+  --baseline <file>  Baseline to compare with or save, default baseline.json
+                     next to this script
+  --save-baseline    Save the results as baseline instead of comparing
+  --check            Use the small corpus and the "check" baseline
+  --tolerance <f>    Factor a point may be slower [default: 2.0]
+  --margin <x>       Growth of the scaling exponent allowed [default: 0.25]
+  --json <file>      Write the results to <file>
+  --plot <dir>       Plot the time of each phase per scenario to <dir>,
+                     needs matplotlib
+  -h --help          Show this screen.
+"""
+
+import contextlib
+import io
+import json
+import math
+import os.path
+import sys
+import tempfile
+import time
+
+import docopt
+import lxml.etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import corpus  # noqa: E402
+import dbxincluder  # noqa: E402
+from dbxincluder import stats, xmlcat  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Tuples of the parameter to vary, its values and the other parameters
+SCENARIOS = [
+    ("modules", [25, 50, 100, 200], {}),
+    ("depth", [1, 4, 16, 64], {"modules": 64}),
+    ("fragid_reuse", [5, 10, 20, 40], {}),
+    ("links", [1, 4, 16, 64], {}),
+    ("text_includes", [5, 10, 20, 40], {}),
+    ("linkscope", corpus.LINKSCOPES + ["mixed"], {"modules": 100, "fragid_reuse": 10}),
+    ("idfixup", corpus.IDFIXUPS + ["mixed"], {"modules": 100, "fragid_reuse": 10}),
+]
+
+# Phases shown in the table and plots, as reported by stats, and their labels
+PHASES = [
+    ("total", "total"),
+    ("parse", "parse"),
+    ("xinclude", "xinclude"),
+    ("fetch", "fetch"),
+    ("docbook ids", "ids"),
+    ("docbook references", "refs"),
+    ("docbook namespaces", "ns"),
+    ("serialize", "serialize"),
+]
+
+# Differences of less seconds are noise, even if above the tolerance
+MIN_DIFFERENCE = 0.01
+
+# Parameters of the small corpus for --check
+CHECK_PARAMS = {"sections": 2}
+
+
+def clear_caches():
+    """Drop the targets, expansions and catalog lookups of earlier runs."""
+    for cache in stats.CACHES.values():
+        cache.clear()
+    xmlcat.CATALOG_CACHE.clear()
+    xmlcat.XMLCAT_CACHE.clear()
+
+
+def reference_workload():
+    """Return a function timing a fixed lxml workload, to tell how fast the
+    machine is at the moment."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "module.xml")
+        corpus.write_module(path, 0, dict(corpus.DEFAULTS, sections=200))
+        with open(path, "rb") as file:
+            data = file.read()
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(10):
+            lxml.etree.tostring(lxml.etree.fromstring(data))
+        return time.perf_counter() - start
+
+    return run
+
+
+def measure(book, repeat, reference):
+    """Process book repeat times with cold caches, each time after running
+    the reference workload.
+
+    :param reference: Function returned by reference_workload
+    :return: Dict with the best wall time of each phase, of the reference
+             workload ("calibration") and the size of the output
+    :raises RuntimeError: Processing failed
+    """
+
+    output = os.path.join(os.path.dirname(book), "output.xml")
+    best = {}
+    calibration = None
+    for _ in range(repeat):
+        elapsed = reference()
+        calibration = elapsed if calibration is None else min(calibration, elapsed)
+
+        clear_caches()
+        stderr = io.StringIO()
+        stats.ENABLED = True
+        stats.reset()
+        try:
+            with contextlib.redirect_stderr(stderr):
+                success = dbxincluder.process_document(book, output, None)
+            phases = stats.report()["phases"]
+        finally:
+            stats.ENABLED = False
+        if not success:
+            raise RuntimeError(stderr.getvalue().strip())
+
+        for name, entry in phases.items():
+            best[name] = min(best.get(name, entry["wall"]), entry["wall"])
+
+    return {
+        "phases": best,
+        "calibration": calibration,
+        "output_bytes": os.path.getsize(output),
+    }
+
+
+def normalized(point):
+    """Return the total time of point in units of its calibration."""
+    return point["phases"]["total"] / point["calibration"]
+
+
+def exponent(points):
+    """Return the scaling exponent of the normalized total time between the
+    first and the last point, None if the values aren't numbers."""
+    first, last = points[0], points[-1]
+    if not all(isinstance(point["value"], int) for point in (first, last)):
+        return None
+
+    times = normalized(last) / normalized(first)
+    return math.log(times) / math.log(last["value"] / first["value"])
+
+
+def run_suite(names, repeat, progress=None, small=False):
+    """Run the scenarios with the given parameter names, all if empty.
+
+    :param progress: Stream to report each point to, or None
+    :param small: Use CHECK_PARAMS for all scenarios
+    :return: Results as dict for JSON
+    """
+
+    reference = reference_workload()
+    scenarios = {}
+    for parameter, values, params in SCENARIOS:
+        if names and parameter not in names:
+            continue
+
+        if small:
+            params = dict(CHECK_PARAMS, **params)
+        points = []
+        for value in values:
+            with tempfile.TemporaryDirectory() as directory:
+                book = corpus.write_corpus(
+                    directory, **dict(params, **{parameter: value})
+                )
+                point = dict(value=value, **measure(book, repeat, reference))
+            points.append(point)
+            if progress is not None:
+                progress.write(
+                    "{0}={1}: {2:.3f}s\n".format(
+                        parameter, value, point["phases"]["total"]
+                    )
+                )
+
+        scenarios[parameter] = {
+            "params": params,
+            "points": points,
+            "exponent": exponent(points),
+        }
+
+    return {"scenarios": scenarios}
+
+
+def compare(results, baseline, tolerance, margin):
+    """Return a list of messages about the regressions of results against
+    baseline, both dicts as returned by run_suite."""
+
+    failures = []
+    for name, scenario in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+
+        base_points = {point["value"]: point for point in base["points"]}
+        for point in scenario["points"]:
+            if point["value"] not in base_points:
+                continue
+
+            # The baseline as fast as the machine was for this point
+            total = point["phases"]["total"]
+            expected = normalized(base_points[point["value"]]) * point["calibration"]
+            if total > expected * tolerance and total - expected > MIN_DIFFERENCE:
+                failures.append(
+                    "{0}={1}: {2:.3f}s, baseline {3:.3f}s".format(
+                        name, point["value"], total, expected
+                    )
+                )
+
+        if scenario["exponent"] is not None and base["exponent"] is not None:
+            if scenario["exponent"] > base["exponent"] + margin:
+                failures.append(
+                    "{0}: scales with exponent {1:.2f}, baseline {2:.2f}".format(
+                        name, scenario["exponent"], base["exponent"]
+                    )
+                )
+
+    return failures
+
+
+def check_limits(results, limits):
+    """Return a list of messages about the known limits exceeded by results.
+
+    :param limits: List of dicts with scenario, phase, max_ratio and note
+    """
+
+    failures = []
+    for limit in limits:
+        scenario = results["scenarios"].get(limit["scenario"])
+        if scenario is None:
+            continue
+
+        points = scenario["points"]
+        first = points[0]["phases"][limit["phase"]]
+        ratio = points[-1]["phases"][limit["phase"]] / first
+        if ratio > limit["max_ratio"]:
+            failures.append(
+                "{0}: {1} grows by {2:.1f}x, known limit {3:.1f}x ({4})".format(
+                    limit["scenario"],
+                    limit["phase"],
+                    ratio,
+                    limit["max_ratio"],
+                    limit["note"],
+                )
+            )
+
+    return failures
+
+
+def format_results(results):
+    """Return the results of run_suite as tables for humans."""
+    row = "{:<10}" + " {:>9}" * len(PHASES)
+    lines = []
+    for name, scenario in results["scenarios"].items():
+        title = name
+        if scenario["exponent"] is not None:
+            title += " (exponent {0:.2f})".format(scenario["exponent"])
+        lines += [title, row.format(name, *(label for _, label in PHASES))]
+        for point in scenario["points"]:
+            times = [point["phases"].get(phase) for phase, _ in PHASES]
+            times = ["-" if time is None else "{0:.4f}".format(time) for time in times]
+            lines.append(row.format(point["value"], *times))
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def plot(results, directory):
+    """Plot the phase times of each scenario to <directory>/<name>.png, on
+    logarithmic scales for numeric parameters."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as pyplot
+
+    os.makedirs(directory, exist_ok=True)
+    for name, scenario in results["scenarios"].items():
+        values = [point["value"] for point in scenario["points"]]
+        numeric = scenario["exponent"] is not None
+        xs = values if numeric else list(range(len(values)))
+
+        figure, axes = pyplot.subplots()
+        for phase, _ in PHASES:
+            times = [point["phases"].get(phase) for point in scenario["points"]]
+            if all(times):
+                axes.plot(xs, times, marker="o", label=phase)
+        if numeric:
+            axes.set_xscale("log")
+            axes.set_yscale("log")
+        else:
+            axes.set_xticks(xs)
+            axes.set_xticklabels(values)
+        axes.set_title(name)
+        axes.set_xlabel(name)
+        axes.set_ylabel("seconds")
+        axes.legend()
+        figure.savefig(os.path.join(directory, name + ".png"))
+        pyplot.close(figure)
+
+
+def main(argv):
+    """Run the suite as argv says, return 1 on regressions."""
+    opts = docopt.docopt(__doc__, argv[1:])
+    names = opts["<scenario>"]
+    unknown = set(names) - {parameter for parameter, _, _ in SCENARIOS}
+    if unknown:
+        sys.stderr.write("Unknown scenarios: {0}\n".format(", ".join(sorted(unknown))))
+        return 1
+    if opts["--plot"] is not None:
+        try:
+            import matplotlib  # noqa: F401
+        except ImportError:
+            sys.stderr.write("--plot needs matplotlib\n")
+            return 1
+
+    results = run_suite(names, int(opts["--repeat"]), sys.stderr, opts["--check"])
+    print(format_results(results))
+    if opts["--json"] is not None:
+        with open(opts["--json"], "w") as file:
+            json.dump(results, file, indent=2)
+    if opts["--plot"] is not None:
+        plot(results, opts["--plot"])
+
+    baseline_path = opts["--baseline"] or BASELINE
+    try:
+        with open(baseline_path) as file:
+            stored = json.load(file)
+    except FileNotFoundError:
+        stored = {}
+    section = "check" if opts["--check"] else "full"
+    baseline = stored.get(section)
+
+    if opts["--save-baseline"]:
+        # The limits are written by hand
+        results["limits"] = baseline["limits"] if baseline else []
+        stored[section] = results
+        with open(baseline_path, "w") as file:
+            json.dump(stored, file, indent=2)
+            file.write("\n")
+        return 0
+
+    if baseline is None:
+        print(
+            "No {0} baseline in {1!r}, save one with --save-baseline".format(
+                section, baseline_path
+            )
+        )
+        return 0
+
+    failures = compare(
+        results, baseline, float(opts["--tolerance"]), float(opts["--margin"])
+    )
+    failures += check_limits(results, baseline.get("limits", []))
+    for failure in failures:
+        print("REGRESSION " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
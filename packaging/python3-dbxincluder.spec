@@ -59,6 +59,7 @@ install -D -m644 -t %{buildroot}%{_mandir}/man1/ doc/_build/man/%{binname}.1
 %doc LICENSE
 %{python3_sitelib}/*
 %{_bindir}/%{binname}
+%{_bindir}/%{binname}-client
 %{_mandir}/man1/*
 
 %changelog
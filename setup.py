@@ -89,7 +89,10 @@ setup(
         #   ':python_version=="2.6"': ['argparse'],
     },
     entry_points={
-        'console_scripts': ['dbxincluder=dbxincluder:main'],
+        'console_scripts': [
+            'dbxincluder=dbxincluder:main',
+            'dbxincluder-client=dbxincluder_client:main',
+        ],
         },
 
     # Required packages for testing
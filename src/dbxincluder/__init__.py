@@ -21,31 +21,296 @@ dbxincluder: XInclude and DocBook transclusion processor
 
 Usage:
   dbxincluder [options] [--] <input>
+  dbxincluder [options] --batch <dir> [--] <input>...
+  dbxincluder [options] [--batch <dir>] --manifest <file>
+  dbxincluder --serve [<socket>]
   dbxincluder -h | --help
   dbxincluder --version
 
 Options:
   -o <output>   Output file [default: -]
+  --batch <dir>
+                Process all inputs in one run and write each of them to a
+                file of the same name in <dir>.
+  --manifest <file>
+                Process the inputs listed in <file>, one per line with an
+                optional output file.
   -c <catalog>  XML catalog to use [default: /etc/xml/catalog]
+  --catalog-cache <dir>
+                Store catalog lookups in <dir> and reuse them across runs.
+  -j <n>, --jobs <n>
+                Expand the includes of the input document with <n>
+                processes [default: 1]
+  --prefetch <threads>
+                Fetch include targets with <threads> threads before
+                processing [default: 0]
+  --host-limit <n>
+                Parallel requests per host when prefetching [default: 4]
+  --timeout <seconds>
+                Network timeout, also when prefetching [default: 30]
+  --http-cache <dir>
+                Store HTTP targets in <dir> and revalidate them in later runs.
+  --offline     Use HTTP targets from the --http-cache directory without
+                contacting the servers.
+  --no-pretty-print
+                Write the output without adding indentation.
+  --write-if-changed
+                Leave output files untouched if their content is unchanged.
+  --depfile <file>
+                Write the local files each output was made of to <file> as
+                Makefile rules, for make and ninja.
+  --stats <format>
+                Write where the time went, counters and cache statistics to
+                stderr at the end, as text or json.
+  --trace <file>
+                Write a trace of the includes and processing phases to
+                <file>, for Perfetto or chrome://tracing.
+  --watch       Process the inputs again whenever a file they include
+                changes, until interrupted.
+  --serve       Run the command lines of dbxincluder-client, keeping the
+                caches between them. <socket> defaults to $DBXINCLUDER_SOCKET
+                or dbxincluder-<uid>.sock in $XDG_RUNTIME_DIR or /tmp.
   -h --help     Show this screen.
   --version     Show the version.
 
 """
 
+import functools
+import io
+import json
+import os.path
+import signal
 import sys
 
 import docopt
 import lxml.etree
 
-from . import docbook, utils
+import dbxincluder_client
+from . import (
+    batch,
+    depfile,
+    docbook,
+    httpcache,
+    prefetch,
+    server,
+    stats,
+    utils,
+    watch,
+    xinclude,
+    xmlcat,
+)
 
 __version__ = "0.10.0"
 
 
-def main(argv=None):
+@stats.timed("serialize")
+def write_output(tree, outfile, pretty_print=True):
+    """Write tree UTF-8 encoded to outfile.
+
+    lxml writes to binary files incrementally, without building the whole
+    document in memory first. Text streams get their binary buffer.
+    """
+    if isinstance(outfile, io.TextIOBase):
+        if not hasattr(outfile, "buffer"):
+            outfile.write(
+                lxml.etree.tostring(tree, encoding="unicode", pretty_print=pretty_print)
+            )
+            return
+
+        outfile.flush()
+        outfile = outfile.buffer
+
+    tree.write(outfile, encoding="utf-8", pretty_print=pretty_print)
+    outfile.flush()
+
+
+@stats.timed("serialize")
+def write_if_changed(tree, output, pretty_print=True):
+    """Write tree to the file output like write_output, unless the file has
+    exactly that content already. Its modification time stays the same then,
+    so build tools don't rebuild what depends on it.
+
+    :return: Whether output was written
+    :raises IOError: Couldn't write output
+    """
+
+    buffer = io.BytesIO()
+    write_output(tree, buffer, pretty_print)
+    data = buffer.getvalue()
+    try:
+        if os.path.getsize(output) == len(data):
+            with open(output, "rb") as file:
+                if file.read() == data:
+                    return False
+    except OSError:
+        pass
+
+    with open(output, "wb") as file:
+        file.write(data)
+
+    return True
+
+
+def process_document(
+    path,
+    output,
+    xmlcatalog,
+    threads=0,
+    host_limit=4,
+    timeout=None,
+    pretty_print=True,
+    jobs=1,
+    only_changed=False,
+):
+    """Process the document path and write it to output. Errors are written
+    to stderr. The targets fetched for it are in xinclude.DEPENDENCIES
+    afterwards.
+
+    :param path: Input file, "-" for stdin
+    :param output: Output file, "-" for stdout
+    :param xmlcatalog: XML catalog to use (None means default)
+    :param threads: Number of threads to prefetch include targets with, 0 for none
+    :param host_limit: Parallel requests per host when prefetching
+    :param timeout: Network timeout in seconds, None for none
+    :param pretty_print: Indent the output
+    :param jobs: Number of processes to expand the includes with
+    :param only_changed: Leave output untouched if its content is unchanged
+    :return: Whether the document was processed successfully
+    """
+
+    use_stdin = path == "-"
+    base_url = None if use_stdin else path
+    name = "<stdin>" if use_stdin else path
+    xinclude.DEPENDENCIES.clear()
+    xinclude.TIMEOUT = timeout
+
+    outfile = None
+    span = stats.begin_span("document", "document", {"path": name})
+    try:
+        # Parse input
+        try:
+            file = sys.stdin if use_stdin else open(base_url, "r")
+            with stats.phase("parse"):
+                tree = lxml.etree.parse(file)
+            xinclude.count_parsed(tree.getroot())
+        except (lxml.etree.XMLSyntaxError, UnicodeDecodeError, IOError) as exc:
+            sys.stderr.write("Could not parse {0!r}: {1}\n".format(name, str(exc)))
+            return False
+
+        # Open output file only now, it might be the input. Unless it's only
+        # written if changed.
+        try:
+            if output == "-":
+                outfile = sys.stdout
+            elif not only_changed:
+                outfile = open(output, "wb")
+        except IOError as exc:  # pragma: nocover
+            sys.stderr.write("Could not open {0!r}: {1}\n".format(output, str(exc)))
+            return False
+
+        # Process XML and write output
+        try:
+            if threads > 0:
+                with stats.phase("prefetch"):
+                    prefetch.prefetch_tree(
+                        tree.getroot(),
+                        base_url,
+                        xmlcatalog,
+                        threads,
+                        host_limit,
+                        timeout,
+                    )
+            docbook.process_tree(tree.getroot(), base_url, xmlcatalog, name, jobs)
+            if outfile is None:
+                write_if_changed(tree, output, pretty_print)
+            else:
+                write_output(tree, outfile, pretty_print)
+        except utils.DBXIException as exc:
+            sys.stderr.write(str(exc) + "\n")
+            return False
+        except IOError as exc:
+            sys.stderr.write("Could not write {0!r}: {1}\n".format(output, str(exc)))
+            return False
+    finally:
+        if outfile not in (None, sys.stdout):
+            outfile.close()
+        stats.end_span(span)
+
+    return True
+
+
+def batch_jobs(opts):
+    """Return the list of tuples (input, output) to process for opts.
+
+    :raises ManifestError: Invalid manifest or inputs
+    :raises IOError: Couldn't read manifest
+    """
+
+    if opts["--batch"] is None and opts["--manifest"] is None:
+        return [(opts["<input>"][0], opts["-o"])]
+
+    if opts["--manifest"] is not None:
+        jobs = batch.read_manifest(opts["--manifest"], opts["--batch"])
+    else:
+        jobs = [
+            (path, batch.output_path(path, opts["--batch"])) for path in opts["<input>"]
+        ]
+
+    batch.check_jobs(jobs)
+    return jobs
+
+
+def serve(path):
+    """Answer the requests of dbxincluder-client on the Unix socket path until
+    interrupted.
+
+    :return: Exit status
+    """
+
+    try:
+        unix_server = server.Server(path, functools.partial(main, served=True))
+    except OSError as exc:
+        sys.stderr.write("Could not listen on {0!r}: {1}\n".format(path, str(exc)))
+        return 1
+
+    sys.stderr.write("Listening on {0!r}\n".format(path))
+    try:
+        run_until_interrupted(unix_server.serve_forever)
+    finally:
+        unix_server.server_close()
+
+    return 0
+
+
+def write_stats(output_format):
+    """Write stats.report() to stderr as "text" or "json"."""
+    report = stats.report()
+    if output_format == "json":
+        sys.stderr.write(json.dumps(report, indent=2) + "\n")
+    else:
+        sys.stderr.write(stats.format_text(report))
+
+
+def run_until_interrupted(function, *args):
+    """Call function(*args) until it's stopped by SIGINT or SIGTERM."""
+
+    # SIGTERM stops like ^C, so the finally blocks run
+    sigterm = signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        function(*args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, sigterm)
+
+
+def main(argv=None, served=False):
     """Default entry point.
 
     Parses argv (sys.argv if None) and does stuff.
+
+    :param served: argv comes from dbxincluder-client, refuse the options
+                   which would keep the server busy until interrupted
     """
     argv = argv if argv else sys.argv
 
@@ -57,31 +322,118 @@ def main(argv=None):
         sys.stderr.write(str(exc) + "\n")
         return 0 if exc.code is None else 1
 
-    use_stdin = opts["<input>"] == "-"
-    base_url = None if use_stdin else opts["<input>"]
-    path = "<stdin>" if use_stdin else opts["<input>"]
+    if served and (opts["--serve"] or opts["--watch"]):
+        sys.stderr.write("--serve and --watch can't be used with dbxincluder-client\n")
+        return 1
+    if opts["--serve"]:
+        return serve(opts["<socket>"] or dbxincluder_client.socket_path())
 
-    # Open output file
     try:
-        outfile = sys.stdout if opts["-o"] == "-" else open(opts["-o"], "w")
-    except IOError as exc:  # pragma: nocover
-        sys.stderr.write("Could not open {0!r}: {1}\n".format(opts["-o"], str(exc)))
+        threads = int(opts["--prefetch"])
+        host_limit = int(opts["--host-limit"])
+        timeout = float(opts["--timeout"])
+        processes = int(opts["--jobs"])
+        if threads < 0 or host_limit < 1 or timeout <= 0 or processes < 1:
+            raise ValueError("numbers must be positive")
+        if opts["--stats"] not in (None, "text", "json"):
+            raise ValueError("--stats must be text or json")
+    except ValueError as exc:
+        sys.stderr.write("Invalid option value: {0}\n".format(str(exc)))
         return 1
 
-    # Parse input
     try:
-        file = sys.stdin if use_stdin else open(base_url, "r")
-        tree = lxml.etree.parse(file)
-    except (lxml.etree.XMLSyntaxError, UnicodeDecodeError, IOError) as exc:
-        sys.stderr.write("Could not parse {0!r}: {1}\n".format(path, str(exc)))
+        jobs = batch_jobs(opts)
+    except batch.ManifestError as exc:
+        sys.stderr.write("Invalid batch: {0}\n".format(str(exc)))
+        return 1
+    except IOError as exc:
+        sys.stderr.write(
+            "Could not read {0!r}: {1}\n".format(opts["--manifest"], str(exc))
+        )
         return 1
 
-    # Process XML and write output
-    try:
-        docbook.process_tree(tree.getroot(), base_url, opts["-c"], path)
-        outfile.write(lxml.etree.tostring(tree, encoding="unicode", pretty_print=True))
-    except utils.DBXIException as exc:
-        sys.stderr.write(str(exc) + "\n")
+    single = opts["--batch"] is None and opts["--manifest"] is None
+    if opts["--depfile"] and single and opts["-o"] == "-":
+        sys.stderr.write("--depfile needs an output file\n")
+        return 1
+    if opts["--watch"] and (opts["--depfile"] or jobs[0][0] == "-"):
+        sys.stderr.write("--watch needs an input file and no --depfile\n")
         return 1
 
-    return 0
+    xmlcat.DISK_CACHE_DIR = opts["--catalog-cache"]
+    httpcache.CACHE_DIR = opts["--http-cache"]
+    httpcache.OFFLINE = opts["--offline"]
+    # Expansions are reused by the next documents or runs
+    xinclude.RECORD_EXPANSIONS = served or opts["--watch"] or not single
+
+    def run(path, output):
+        """Process one of the jobs and report the result if there are more."""
+        if not single and os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+
+        success = process_document(
+            path,
+            output,
+            opts["-c"],
+            threads,
+            host_limit,
+            timeout,
+            not opts["--no-pretty-print"],
+            processes,
+            opts["--write-if-changed"],
+        )
+        if not single or opts["--watch"]:
+            status = "OK" if success else "FAILED"
+            sys.stderr.write("{0}: {1} -> {2}\n".format(status, path, output))
+        return success
+
+    # The caches of all modules are shared by the documents
+    failed = 0
+    rules = []
+    stats.ENABLED = opts["--stats"] is not None
+    stats.TRACE = [] if opts["--trace"] else None
+    stats.reset()
+    try:
+        if opts["--watch"]:
+            run_until_interrupted(watch.watch, jobs, run)
+
+        for path, output in [] if opts["--watch"] else jobs:
+            if run(path, output):
+                rules.append((output, depfile.local_dependencies(path)))
+            else:
+                failed += 1
+    finally:
+        xmlcat.flush_disk_cache()
+        httpcache.CONNECTIONS.close()
+        xinclude.RECORD_EXPANSIONS = False
+        stats.ENABLED = False
+        events, stats.TRACE = stats.TRACE, None
+
+    if opts["--stats"] is not None:
+        write_stats(opts["--stats"])
+    if opts["--trace"]:
+        try:
+            stats.write_trace(opts["--trace"], events)
+        except IOError as exc:
+            sys.stderr.write(
+                "Could not write {0!r}: {1}\n".format(opts["--trace"], str(exc))
+            )
+            return 1
+    if opts["--watch"]:
+        return 0
+
+    if opts["--depfile"]:
+        try:
+            depfile.write_depfile(opts["--depfile"], rules)
+        except IOError as exc:
+            sys.stderr.write(
+                "Could not write {0!r}: {1}\n".format(opts["--depfile"], str(exc))
+            )
+            return 1
+
+    if not single:
+        sys.stderr.write(
+            "{0} documents processed, {1} failed\n".format(len(jobs), failed)
+        )
+
+    return 1 if failed else 0
@@ -0,0 +1,100 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Map the input documents of a batch run to their output files.
+
+All documents of a batch are processed in one process, so the catalog, target
+and document caches are shared between them.
+"""
+
+import os.path
+import shlex
+
+
+class ManifestError(ValueError):
+    """Raised for invalid manifests and input lists."""
+
+
+def output_path(path, outdir):
+    """Return the output file of the input file path in the directory outdir."""
+    return os.path.join(outdir, os.path.basename(path))
+
+
+def read_manifest(manifest, outdir=None):
+    """Return a list of tuples (input, output) read from the file manifest.
+
+    Each line contains an input file and optionally its output file, quoted
+    like in a shell if necessary. Empty lines and lines starting with # are
+    ignored. Relative paths are relative to the directory of the manifest.
+
+    :param outdir: Directory for inputs without output file, None to require one
+    :raises ManifestError: Invalid line or output file missing
+    :raises IOError: Couldn't read manifest
+    """
+
+    basedir = os.path.dirname(manifest)
+    jobs = []
+    with open(manifest, "r") as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+
+            try:
+                fields = shlex.split(line)
+            except ValueError as exc:
+                raise ManifestError("line {0}: {1}".format(number, str(exc)))
+
+            if len(fields) > 2:
+                raise ManifestError("line {0}: Too many fields".format(number))
+
+            path = os.path.join(basedir, fields[0])
+            if len(fields) == 2:
+                jobs.append((path, os.path.join(basedir, fields[1])))
+            elif outdir is not None:
+                jobs.append((path, output_path(path, outdir)))
+            else:
+                raise ManifestError("line {0}: Missing output file".format(number))
+
+    return jobs
+
+
+def check_jobs(jobs):
+    """Raise ManifestError if an input is stdin, two inputs share an output or
+    an output is one of the inputs.
+
+    :param jobs: List of tuples (input, output)
+    """
+
+    inputs = {os.path.realpath(path): path for path, _ in jobs}
+    outputs = {}
+    for path, output in jobs:
+        if path == "-":
+            raise ManifestError("Can't read stdin in batch mode")
+
+        if os.path.realpath(output) in inputs:
+            raise ManifestError(
+                "{0!r} would overwrite the input {1!r}".format(
+                    path, inputs[os.path.realpath(output)]
+                )
+            )
+
+        other = outputs.setdefault(os.path.normpath(output), path)
+        if other != path:
+            raise ManifestError(
+                "{0!r} and {1!r} are both written to {2!r}".format(other, path, output)
+            )
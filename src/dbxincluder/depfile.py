@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Write the files an output document depends on as Makefile rules.
+
+Such a depfile is what gcc -MD -MP writes: a rule with the output as target
+and all local files it was made of as prerequisites, and an empty rule for
+each of them, so make doesn't fail when one of them is removed. make includes
+it, ninja reads it with depfile = and deps = gcc.
+"""
+
+import re
+
+from . import xinclude
+
+# Characters which need a backslash, together with the backslashes before them
+MAKE_SPECIAL = re.compile(r"(\\*)([ \t#])")
+
+
+def escape(path):
+    """Return path escaped like gcc does for rules in a depfile."""
+    path = path.replace("$", "$$")
+    return MAKE_SPECIAL.sub(
+        lambda match: match.group(1) * 2 + "\\" + match.group(2), path
+    )
+
+
+def local_dependencies(path):
+    """Return the list of local files the document path was made of: path
+    itself and all targets in xinclude.DEPENDENCIES which are local files.
+
+    Targets which didn't exist are left out, make would always consider them
+    changed.
+
+    :param path: Input file, "-" for stdin
+    """
+
+    files = [] if path == "-" else [path]
+    for url, stamp in xinclude.DEPENDENCIES.items():
+        if stamp is not None:
+            files.append(xinclude.local_path(url))
+
+    return list(dict.fromkeys(files))
+
+
+def write_depfile(depfile, rules):
+    """Write the depfile with the given rules.
+
+    :param rules: List of tuples (output, list of files it depends on)
+    :raises IOError: Couldn't write depfile
+    """
+
+    lines = []
+    for output, files in rules:
+        lines.append(" \\\n  ".join([escape(output) + ":"] + list(map(escape, files))))
+
+    for file in dict.fromkeys(file for _, files in rules for file in files):
+        lines.append("\n{0}:".format(escape(file)))
+
+    with open(depfile, "w") as stream:
+        stream.write("".join(line + "\n" for line in lines))
@@ -19,10 +19,19 @@
 """Handle the DocBook specific part of transclusion."""
 
 import lxml.etree
-from lxml.etree import QName
 
-from . import xinclude
-from .utils import NS, QN, DBXIException, generate_id, get_inherited_attribute
+from . import parallel, stats, xinclude
+from .utils import (
+    NS,
+    PARENT_LINES,
+    QN,
+    SOURCE_LINES,
+    DBXIException,
+    child_path_steps,
+    generate_id,
+    get_inherited_attribute,
+    iter_inherited_attributes,
+)
 
 
 def check_linkscope(elem, linkscope):
@@ -51,78 +60,142 @@ def check_idfixup(elem, idfixup):
         )
 
 
-def associate_new_ids(subtree):
-    """Assign elements their new ids as new 'dbxi:newid' attribute.
+def associate_new_ids(tree, index=None):
+    """Compute the new ids of all elements in tree and index the old ones.
 
-    :param subtree: The XIncluded subtree to process
+    Walks tree once and passes the ID transformations of all enclosing
+    trans:idfixup elements down, so each new ID is computed only once.
+    xi:fallback elements are flattened during the walk as well.
+
+    :param tree: The XIncluded tree to process
+    :param index: Empty IDIndex to fill, a new one if None
+    :return: The IDIndex with the old and new IDs of the elements in tree
     """
 
-    if not isinstance(subtree.tag, str):
-        return
+    if index is None:
+        index = IDIndex()
 
-    idfixup = subtree.get(QName(NS["trans"], "idfixup"), "none")
+    parent = tree.getparent()
+    suffix = None
+    if parent is not None:
+        suffix, _ = get_inherited_attribute(parent, "trans:suffix")
 
-    check_idfixup(subtree, idfixup)
+    # Transformations are the suffixes to append, None for a generated one.
+    # The paths for generated IDs are built up along the way.
+    stack = [(tree, suffix, (), tree.getroottree().getpath(tree))]
+    while stack:
+        elem, suffix, transformations, path = stack.pop()
 
-    if idfixup == "none":
-        return  # Nothing to do here
+        # Flatten before the paths of the children are computed
+        xinclude.flatten_children(elem)
 
-    suffix = None
-    if idfixup == "suffix":
-        suffix, _ = get_inherited_attribute(subtree, "trans:suffix")
-        if suffix is None:
-            raise DBXIException(subtree, "no suffix found")
+        suffix = elem.get(QN["trans:suffix"], suffix)
+        idfixup = elem.get(QN["trans:idfixup"], "none")
 
-    for elem in subtree.iter():
-        cur_id = elem.get(QN["xml:id"])
-        if cur_id is None:
-            continue
+        check_idfixup(elem, idfixup)
 
-        new = elem.get(QN["dbxi:newid"], cur_id)
         if idfixup == "suffix":
-            new = new + suffix
+            if suffix is None:
+                raise DBXIException(elem, "no suffix found")
+            transformations += (suffix,)
         elif idfixup == "auto":
-            new = new + "--" + generate_id(elem)
-        else:
-            assert False, "This can't happen"  # pragma: no cover
+            transformations += (None,)
+
+        cur_id = elem.get(QN["xml:id"])
+        if cur_id is not None:
+            index.add(elem, cur_id)
+
+        if cur_id is not None and transformations:
+            auto = None
+            if None in transformations:
+                auto = "--" + generate_id(elem, path)
+            new = [cur_id] + [auto if t is None else t for t in transformations]
+            index.new_ids[elem] = "".join(new)
+
+        stack.extend(
+            (child, suffix, transformations, path + "/" + step)
+            for child, step in reversed(child_path_steps(elem))
+        )
+
+    return index
 
-        elem.set(QN["dbxi:newid"], new)
 
+class IDIndex:
+    """Lookup tables for the xml:id values of a document, to resolve references
+    without searching the document each time.
+
+    Build it after all xi:include elements are processed, the index does not
+    notice changes of the tree. new_ids maps elements to their new IDs, as
+    computed by associate_new_ids.
+    """
 
-def find_target(elem, subtree, value, linkscope):
+    def __init__(self, tree=None):
+        """Index all elements with xml:id in the document of tree.
+
+        Collects the first element for each ID in the document and, for each
+        parent element, the first child for each ID in a single pass.
+        Without tree, the index starts empty and gets filled with add.
+        """
+        self.ids = {}
+        self.new_ids = {}
+        self._children = {}
+        if tree is not None:
+            for elem in tree.xpath("//*[@xml:id]", namespaces=NS):
+                self.add(elem, elem.get(QN["xml:id"]))
+
+    def add(self, elem, xmlid):
+        """Add elem with xml:id value xmlid. Elements have to be added in
+        document order."""
+        self.ids.setdefault(xmlid, elem)
+        self._children.setdefault(elem.getparent(), {}).setdefault(xmlid, elem)
+
+    def find(self, value):
+        """Return the first element in the document with xml:id value or None."""
+        return self.ids.get(value)
+
+    def find_child(self, parent, value):
+        """Return the first child of parent with xml:id value or None."""
+        children = self._children.get(parent)
+        return None if children is None else children.get(value)
+
+
+def find_target(elem, subtree, value, linkscope, index=None):
     """Resolves reference to id value beginning from elem.
 
     :param elem: Source of reference
     :param subtree: XIncluded subtree
     :param value: ID of reference
     :param linkscope: DB transclusion linkscope (local/near/global)
+    :param index: IDIndex of the document, built if None
     :return: Target element or None
     """
+    if index is None:
+        index = IDIndex(elem)
+
     if linkscope == "local":
-        target = subtree.xpath("./*[@xml:id={0!r}]".format(value))
+        return index.find_child(subtree, value)
     elif linkscope == "near":
         for el in elem.iterancestors():
-            target = el.xpath("./*[@xml:id={0!r}]".format(value))
-            if target:
-                return target[0]
+            target = index.find_child(el, value)
+            if target is not None:
+                return target
+        return None
     elif linkscope == "global":
-        target = elem.xpath("//*[@xml:id={0!r}]".format(value))
+        return index.find(value)
     else:
         assert False, "linkscope not handled"  # pragma: no cover
 
-    return None if len(target) == 0 else target[0]
-
 
-def new_ref(elem, idfixup_elem, value, linkscope):
+def new_ref(elem, idfixup_elem, value, linkscope, index):
     """Returns the fixed reference as string or None.
 
-    Uses same parameters as find_target.
+    Uses same parameters as find_target, index is required.
     """
-    target = find_target(elem, idfixup_elem, value, linkscope)
+    target = find_target(elem, idfixup_elem, value, linkscope, index)
     if target is None:
         return None
 
-    new = target.get(QN["dbxi:newid"])
+    new = index.new_ids.get(target)
     if not new:
         new = target.get(QN["xml:id"])
         if not new:
@@ -133,18 +206,54 @@ def new_ref(elem, idfixup_elem, value, linkscope):
     return new
 
 
-def fixup_references(subtree):
+def cleanup_attributes(elem, index):
+    """Set the new ID of elem and remove all trans: attributes.
+
+    :param elem: Element to clean up
+    :param index: IDIndex with the new IDs
+    """
+    newid = index.new_ids.get(elem)
+    if newid:
+        elem.set(QN["xml:id"], newid)
+
+    trans_prefix = "{{{}}}".format(NS["trans"])
+    for name in elem.keys():
+        if name.startswith(trans_prefix):
+            del elem.attrib[name]
+
+
+def fixup_references(subtree, index, cleanup=False):
     """Fix all references if idfixup is set.
 
     :param subtree: subtree to process
+    :param index: IDIndex of the document, as returned by associate_new_ids
+    :param cleanup: Also apply cleanup_attributes to each element once all
+                    of its descendants are done
     """
 
-    for elem in subtree.iter("{{{}}}*".format(NS["db"])):
-        linkscope, _ = get_inherited_attribute(elem, "trans:linkscope", "near")
+    db_prefix = "{{{}}}".format(NS["db"])
+    inherited_attributes = iter_inherited_attributes(
+        subtree, ["trans:linkscope", "trans:idfixup"], leave=cleanup
+    )
+    for elem, inherited in inherited_attributes:
+        if inherited is None:
+            # Ancestors keep their attributes until the error messages
+            # of all their descendants are done.
+            cleanup_attributes(elem, index)
+            continue
+
+        if not elem.tag.startswith(db_prefix):
+            continue
+
+        linkscope = inherited["trans:linkscope"][0]
+        if linkscope is None:
+            linkscope = "near"
 
         check_linkscope(elem, linkscope)
 
-        (idfixup, idfixup_elem) = get_inherited_attribute(elem, "trans:idfixup", "none")
+        (idfixup, idfixup_elem) = inherited["trans:idfixup"]
+        if idfixup is None:
+            idfixup = "none"
 
         if idfixup == "none" or linkscope == "user":
             continue  # Nothing to do here
@@ -161,7 +270,9 @@ def fixup_references(subtree):
             if attr in idrefs_multi:
                 targets = value.split()
 
-            new_targets = [new_ref(elem, idfixup_elem, t, linkscope) for t in targets]
+            new_targets = [
+                new_ref(elem, idfixup_elem, t, linkscope, index) for t in targets
+            ]
             if None in new_targets:
                 ref = targets[new_targets.index(None)]
                 raise DBXIException(
@@ -171,7 +282,7 @@ def fixup_references(subtree):
             elem.set(attr, " ".join(new_targets))
 
 
-def process_tree(tree, base_url, xmlcatalog=None, file=None):
+def process_tree(tree, base_url, xmlcatalog=None, file=None, jobs=1):
     """Processes an ElementTree. Handles all xi:include with
     xinclude.process_tree and processes all docbook attributes on the output.
 
@@ -179,31 +290,33 @@ def process_tree(tree, base_url, xmlcatalog=None, file=None):
     :param base_url: xml:base to use if not set in the tree
     :param xmlcatalog: XML catalog to use (None means default)
     :param file: URL used to report errors
+    :param jobs: Number of processes to expand the top-level xi:include
+                 elements with, see parallel.process_xinclude
     :return: Nothing
     """
 
-    # Do XInclude processing first
-    xinclude.process_tree(tree, base_url, xmlcatalog, file)
-
-    # Three passes:
-    # First, assign all elements a new ID
-    for subtree in tree.iter():
-        associate_new_ids(subtree)
-
-    # Second, fixup all references
-    fixup_references(tree)
-
-    # Third, clean up our dbxi:newid and the docbook transclude attributes
-    for elem in tree.iter():
-        newid = elem.get(QN["dbxi:newid"])
-        if newid:
-            elem.set(QN["xml:id"], newid)
-            del elem.attrib[QN["dbxi:newid"]]
-
-        for name in elem.keys():
-            namespace = QName(name).namespace
-            if namespace in [NS["trans"], NS["dbxi"]]:
-                del elem.attrib[name]
-
-    # Remove unnecessary namespace declarations
-    lxml.etree.cleanup_namespaces(tree)
+    try:
+        # Do XInclude processing first, xi:fallback is flattened afterwards
+        with stats.phase("xinclude"):
+            if jobs > 1:
+                parallel.process_xinclude(tree, base_url, xmlcatalog, file, jobs)
+            else:
+                xinclude.process_xinclude(tree, base_url, xmlcatalog, file)
+
+        # Two passes:
+        # First, flatten xi:fallback, assign all elements a new ID and index
+        # the old ones
+        with stats.phase("docbook ids"):
+            index = associate_new_ids(tree)
+
+        # Second, fixup all references, set the new IDs and remove the
+        # docbook transclude attributes
+        with stats.phase("docbook references"):
+            fixup_references(tree, index, cleanup=True)
+    finally:
+        PARENT_LINES.clear()
+        SOURCE_LINES.clear()
+
+    # Remove namespace declarations for xi: and trans: of the sources
+    with stats.phase("docbook namespaces"):
+        lxml.etree.cleanup_namespaces(tree)
@@ -0,0 +1,228 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent cache for include targets on HTTP servers.
+
+Responses are stored in CACHE_DIR and revalidated with If-None-Match and
+If-Modified-Since on the next run, so unchanged targets are not downloaded
+again. Connections to each host are kept open and reused. In OFFLINE mode,
+cached responses are used without asking the server.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import os.path
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+
+# Directory for cached responses, None disables the cache
+CACHE_DIR = None
+
+# Serve cached responses without revalidation and fail for others
+OFFLINE = False
+
+# Number of redirects to follow for one request
+MAX_REDIRECTS = 5
+
+
+def enabled():
+    """Return whether HTTP targets should be fetched through this module."""
+    return CACHE_DIR is not None or OFFLINE
+
+
+class ConnectionPool:
+    """Idle keep-alive connections, keyed by scheme, host and port.
+
+    A connection is used by one thread at a time: get takes it out of the
+    pool and put returns it after the response is read completely.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc, timeout=None, reuse=True):
+        """Return a tuple of a connection to netloc and whether it was idle.
+
+        :param reuse: Use an idle connection if there is one
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if reuse and idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def put(self, scheme, netloc, connection):
+        """Return connection to the pool for reuse."""
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+CONNECTIONS = ConnectionPool()
+
+
+def cache_path(url):
+    """Return the path of the cache file for url."""
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, "http-{0}.cache".format(name))
+
+
+def read_entry(url):
+    """Return a tuple of metadata dict and body of the cached response for url
+    or None."""
+    if CACHE_DIR is None:
+        return None
+
+    try:
+        with open(cache_path(url), "rb") as file:
+            meta = json.loads(file.readline().decode("utf-8"))
+            body = file.read()
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(meta, dict) or meta.get("url") != url:
+        return None
+
+    return meta, body
+
+
+def write_entry(url, headers, body):
+    """Store the response for url with its validators, if CACHE_DIR is set.
+
+    The file is replaced atomically, so concurrent readers never see partial
+    content.
+    """
+    if CACHE_DIR is None or "no-store" in headers.get("Cache-Control", ""):
+        return
+
+    meta = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last-modified": headers.get("Last-Modified"),
+    }
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    handle, temp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(json.dumps(meta).encode("utf-8") + b"\n")
+            file.write(body)
+        os.replace(temp, cache_path(url))
+    except BaseException:  # pragma: no cover
+        os.unlink(temp)
+        raise
+
+
+def request(url, headers, timeout=None):
+    """Send a GET request for url over a pooled connection.
+
+    :return: Tuple of status, response headers and body
+    :raises URLError: Connection failed
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    # A kept-alive connection might have been closed by the server in the
+    # meantime, so retry once on a new one.
+    reuse = True
+    while True:
+        connection, idle = CONNECTIONS.get(parts.scheme, parts.netloc, timeout, reuse)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as exc:
+            connection.close()
+            if idle:
+                reuse = False
+                continue
+            raise urllib.error.URLError(exc)
+
+        if response.will_close:
+            connection.close()
+        else:
+            CONNECTIONS.put(parts.scheme, parts.netloc, connection)
+
+        return response.status, response.headers, body
+
+
+def fetch(url, timeout=None):
+    """Return the content of the HTTP(S) URL url as bytes, using the cache.
+
+    :param timeout: Timeout in seconds, None for none
+    :raises URLError: Couldn't fetch url, or not cached in OFFLINE mode
+    """
+
+    entry = read_entry(url)
+    if OFFLINE:
+        if entry is None:
+            raise urllib.error.URLError("{0!r} is not cached".format(url))
+        return entry[1]
+
+    headers = {}
+    if entry is not None:
+        if entry[0].get("etag"):
+            headers["If-None-Match"] = entry[0]["etag"]
+        if entry[0].get("last-modified"):
+            headers["If-Modified-Since"] = entry[0]["last-modified"]
+
+    location = url
+    for _ in range(MAX_REDIRECTS + 1):
+        status, response_headers, body = request(location, headers, timeout)
+        if status in (301, 302, 303, 307, 308) and "Location" in response_headers:
+            location = urllib.parse.urljoin(location, response_headers["Location"])
+            continue
+
+        if status == 304 and entry is not None:
+            return entry[1]
+
+        if status != 200:
+            raise urllib.error.HTTPError(
+                location,
+                status,
+                "HTTP status {0}".format(status),
+                response_headers,
+                None,
+            )
+
+        write_entry(url, response_headers, body)
+        return body
+
+    raise urllib.error.URLError("Too many redirects for {0!r}".format(url))
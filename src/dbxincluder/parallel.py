@@ -0,0 +1,240 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Expand the top-level xi:include elements of a document in worker processes.
+
+The xi:include elements of the input document itself don't depend on each
+other, only the DocBook processing afterwards needs the whole document. Each
+worker gets a copy of the document, expands some of them completely and sends
+back the resulting subtree serialized, together with the source lines of its
+nodes, the PARENT_LINES entries, what it wrote to stderr, the targets it
+fetched (xinclude.DEPENDENCIES) and what it measured for the statistics and
+the trace. The main process grafts the subtrees back in document order and
+replays stderr in that order, so the result is the same as with
+xinclude.process_xinclude.
+
+Where possible, the workers are forked and inherit the document. Otherwise
+it is serialized as well, which loses how libxml2 tracks lines from 65535 on,
+so messages about such lines might differ.
+"""
+
+import io
+import multiprocessing
+import sys
+
+import lxml.etree
+
+from . import httpcache, stats, xinclude, xmlcat
+from .utils import (
+    PARENT_LINES,
+    QN,
+    SOURCE_LINES,
+    DBXIException,
+    set_source_line,
+    source_line,
+)
+
+# State of a worker process, set by init_worker
+WORKER = {}
+
+# Parser for serialized subtrees, which can contain duplicate IDs before the
+# DocBook processing and huge text nodes
+PARSER = lxml.etree.XMLParser(collect_ids=False, huge_tree=True)
+
+
+def dump_tree(elem):
+    """Return elem serialized as tuple of the XML without tail, its tail, the
+    tags and source lines of all nodes and the PARENT_LINES entries by node
+    number."""
+
+    nodes = list(elem.iter())
+    # libxml2 doesn't write xmlns="" for elements without namespace in one
+    # with a default namespace, so parsing the XML puts them into it
+    tags = [node.tag if isinstance(node.tag, str) else None for node in nodes]
+    lines = [source_line(node) for node in nodes]
+    parents = [
+        (number, PARENT_LINES[node])
+        for number, node in enumerate(nodes)
+        if node in PARENT_LINES
+    ]
+    data = lxml.etree.tostring(elem, encoding="utf-8", with_tail=False)
+    return data, elem.tail, tags, lines, parents
+
+
+def load_tree(dump):
+    """Return the element serialized by dump_tree, with its tags, source lines
+    and PARENT_LINES entries restored."""
+
+    data, tail, tags, lines, parents = dump
+    elem = lxml.etree.fromstring(data, PARSER)
+    elem.tail = tail
+
+    nodes = list(elem.iter())
+    for node, tag, line in zip(nodes, tags, lines):
+        if tag is not None and node.tag != tag:
+            node.tag = tag
+        set_source_line(node, line)
+    for number, line in parents:
+        PARENT_LINES[nodes[number]] = line
+
+    return elem
+
+
+def top_level_includes(tree):
+    """Return the xi:include elements below tree in document order, except
+    the ones in another xi:include (e.g. in its xi:fallback)."""
+
+    return [
+        elem
+        for elem in tree.iterdescendants(QN["xi:include"].text)
+        if not any(
+            ancestor.tag == QN["xi:include"].text for ancestor in elem.iterancestors()
+        )
+    ]
+
+
+def is_xml_include(elem):
+    """Return whether the xi:include elem includes XML."""
+    return elem.get("parse", "xml") == "xml"
+
+
+def init_worker(dump, base_url, xmlcatalog, file, settings):
+    """Set up a worker process with the document serialized by dump_tree, or
+    the one inherited in WORKER["tree"] if dump is None."""
+    (
+        xmlcat.DISK_CACHE_DIR,
+        httpcache.CACHE_DIR,
+        httpcache.OFFLINE,
+        xinclude.TIMEOUT,
+        stats.ENABLED,
+        tracing,
+    ) = settings
+    stats.TRACE = [] if tracing else None
+    # Idle connections inherited by a fork share their sockets with the main
+    # process and the other workers. They are dropped without closing them,
+    # which would shut the sockets down for the main process as well.
+    httpcache.CONNECTIONS = httpcache.ConnectionPool()
+    tree = WORKER["tree"] if dump is None else load_tree(dump)
+    WORKER.update(
+        includes=top_level_includes(tree),
+        base_url=base_url,
+        xmlcatalog=xmlcatalog,
+        file=file,
+    )
+
+
+def expand_include(number):
+    """Expand the top-level xi:include with the given number. Runs in a worker.
+
+    :return: Tuple of the dump_tree of the element which replaced it (None on
+             error), the text written to stderr, the DBXIException or None,
+             the xinclude.DEPENDENCIES of the include and a tuple of the
+             stats.PHASES, stats.COUNTERS and stats.TRACE of the include
+    """
+
+    elem = WORKER["includes"][number]
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    xinclude.DEPENDENCIES.clear()
+    stats.reset()
+    try:
+        active_includes = set()
+        frame = xinclude.handle_xinclude(
+            elem,
+            WORKER["base_url"],
+            WORKER["xmlcatalog"],
+            WORKER["file"],
+            active_includes,
+        )
+        xinclude.process_subtree(frame, WORKER["xmlcatalog"], active_includes)
+        dump, error = dump_tree(frame.tree), None
+    except DBXIException as exc:
+        dump, error = None, exc
+    finally:
+        output = sys.stderr.getvalue()
+        sys.stderr = stderr
+        PARENT_LINES.clear()
+        SOURCE_LINES.clear()
+
+    measured = (stats.PHASES, stats.COUNTERS, stats.TRACE)
+    return dump, output, error, xinclude.DEPENDENCIES, measured
+
+
+def process_xinclude(tree, base_url=None, xmlcatalog=None, file=None, jobs=2):
+    """Same as xinclude.process_xinclude, but expands the top-level xi:include
+    elements with parse="xml" in jobs processes. Text includes are cheap and
+    change the text around them, they are handled by the calling process.
+
+    :param jobs: Number of worker processes
+    """
+
+    includes = top_level_includes(tree)
+    numbers = [number for number, elem in enumerate(includes) if is_xml_include(elem)]
+    if jobs < 2 or len(numbers) < 2:
+        xinclude.process_xinclude(tree, base_url, xmlcatalog, file)
+        return
+
+    xinclude.start_include(tree, base_url, file)
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context, dump = multiprocessing.get_context("fork"), None
+        WORKER["tree"] = tree
+    else:  # pragma: no cover
+        context, dump = multiprocessing.get_context("spawn"), dump_tree(tree)
+
+    settings = (
+        xmlcat.DISK_CACHE_DIR,
+        httpcache.CACHE_DIR,
+        httpcache.OFFLINE,
+        xinclude.TIMEOUT,
+        stats.ENABLED,
+        stats.TRACE is not None,
+    )
+    initargs = (dump, base_url, xmlcatalog, file, settings)
+    pool = context.Pool(min(jobs, len(numbers)), init_worker, initargs)
+    # The workers are started, they must not see the changes from here on
+    WORKER.clear()
+    try:
+        results = pool.imap(expand_include, numbers)
+
+        # Graft the results and handle the text includes in document order,
+        # like process_subtree does
+        for elem in includes:
+            if not is_xml_include(elem):
+                frame = xinclude.handle_xinclude(
+                    elem, base_url, xmlcatalog, file, set()
+                )
+                if frame is not None:
+                    xinclude.process_subtree(frame, xmlcatalog, set())
+                continue
+
+            dump, stderr, exc, dependencies, measured = next(results)
+            sys.stderr.write(stderr)
+            for url, stamp in dependencies.items():
+                xinclude.record_dependency(url, stamp)
+            stats.merge(*measured)
+            if exc is not None:
+                raise exc
+
+            elem.getparent().replace(elem, load_tree(dump))
+    finally:
+        # Pool.terminate can hang while tasks are queued, so even after an
+        # error the remaining includes are expanded. Waiting for the threads
+        # of the pool also keeps them from holding locks in later forks.
+        pool.close()
+        pool.join()
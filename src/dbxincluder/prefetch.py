@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Fetch the targets of xi:include elements concurrently before processing.
+
+Worker threads only read bytes. Catalog lookups, parsing and the caches are
+left to the calling thread, which stores the results in xinclude.TARGET_CACHE
+and xinclude.DOCUMENT_CACHE. Targets which could not be fetched are skipped,
+processing fetches them again and reports the error at the right place.
+Local text/plain targets are skipped, xinclude.fetch_text maps them into
+memory instead of reading them.
+"""
+
+import concurrent.futures
+import threading
+import urllib.parse
+
+from lxml.etree import XMLSyntaxError
+
+from . import xinclude
+from .utils import QN, get_inherited_attribute
+
+
+def find_hrefs(tree, base_url):
+    """Return a list of tuples (href, base URL, parse) for all xi:include
+    elements with href in tree.
+
+    :param tree: Element to search
+    :param base_url: xml:base to use if not specified in the document
+    """
+
+    result = []
+    for elem in tree.iter(QN["xi:include"].text):
+        href = elem.get("href")
+        base = get_inherited_attribute(elem, "xml:base", base_url)[0]
+        if href is not None and base is not None:
+            result.append((href, base, elem.get("parse", "xml")))
+
+    return result
+
+
+class Prefetcher:
+    """Fetches include targets with a bounded number of threads and parallel
+    requests per host."""
+
+    def __init__(self, xmlcatalog=None, jobs=4, host_limit=4, timeout=None):
+        """
+        :param xmlcatalog: XML catalog to use (None means default)
+        :param jobs: Number of threads
+        :param host_limit: Maximum number of parallel requests per host
+        :param timeout: Timeout in seconds for network requests, None for none
+        """
+        self.xmlcatalog = xmlcatalog
+        self.jobs = jobs
+        self.host_limit = host_limit
+        self.timeout = timeout
+        self.seen = set()
+        self._hosts = {}
+
+    def host_semaphore(self, url):
+        """Return the semaphore limiting the requests to the host of url."""
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = threading.BoundedSemaphore(self.host_limit)
+
+        return self._hosts[host]
+
+    def fetch(self, url, semaphore):
+        """Return a tuple of stamp and content of url. Runs in a worker."""
+        with semaphore:
+            stamp = xinclude.get_stamp(url)
+            return stamp, xinclude.read_url(url, self.timeout)
+
+    def run(self, tree, base_url):
+        """Fetch the targets of all xi:include elements in tree and, for XML
+        targets, the targets of their xi:include elements. Local text targets
+        are not fetched.
+
+        Stops scheduling new targets once TARGET_CACHE is full.
+
+        :param tree: Element to start with
+        :param base_url: xml:base to use if not specified in the document
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            pending = {}
+
+            def submit(tree, base_url):
+                for href, base, parse in find_hrefs(tree, base_url):
+                    url = xinclude.resolve_href(href, base, self.xmlcatalog)
+                    if url in self.seen:
+                        continue
+                    if parse != "xml" and xinclude.local_path(url) is not None:
+                        continue
+                    if len(self.seen) >= xinclude.TARGET_CACHE.maxsize:
+                        return
+
+                    self.seen.add(url)
+                    future = pool.submit(self.fetch, url, self.host_semaphore(url))
+                    pending[future] = (url, parse)
+
+            submit(tree, base_url)
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    url, parse = pending.pop(future)
+                    try:
+                        stamp, content = future.result()
+                    except (OSError, ValueError):
+                        continue
+
+                    xinclude.store_target(url, content, stamp)
+                    if parse != "xml":
+                        continue
+
+                    try:
+                        target = xinclude.parse_target(content, url)
+                    except (XMLSyntaxError, UnicodeDecodeError):
+                        continue
+
+                    submit(target.root, url)
+
+
+def prefetch_tree(tree, base_url, xmlcatalog=None, jobs=4, host_limit=4, timeout=None):
+    """Fetch the targets of all xi:include elements in tree and in the
+    included documents. See Prefetcher for the parameters.
+
+    :return: Set of the URLs which were tried
+    """
+
+    prefetcher = Prefetcher(xmlcatalog, jobs, host_limit, timeout)
+    prefetcher.run(tree, base_url)
+    return prefetcher.seen
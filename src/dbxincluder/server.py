@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Answer the requests of dbxincluder-client on a Unix socket.
+
+Each request is a command line, run in the working directory of the client
+like dbxincluder would. As the server process stays alive, the module level
+caches (catalog lookups, fetched and parsed targets, expanded includes) are
+reused by the next request. Before each request, entries which can't be valid
+anymore are dropped: all catalog data and expansions if a catalog file
+changed, and targets which are not local files. Local files are validated by
+their mtime and size anyway.
+"""
+
+import io
+import os
+import socketserver
+import stat
+import sys
+import traceback
+
+import dbxincluder_client as client
+
+from . import xinclude, xmlcat
+
+
+def refresh_caches():
+    """Drop the cached data which might be outdated since the last request."""
+    if xmlcat.check_catalogs():
+        # Expansions depend on the targets the catalogs resolved to
+        xinclude.EXPANSION_CACHE.clear()
+    xinclude.TARGET_CACHE.discard_unstamped()
+    xinclude.TEXT_CACHE.discard_unstamped()
+
+
+class RemoteStdin(io.RawIOBase):
+    """Standard input of the client, requested when it's read first."""
+
+    def __init__(self, rfile, wfile):
+        super().__init__()
+        self._rfile = rfile
+        self._wfile = wfile
+        self._data = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._data is None:
+            client.send_message(self._wfile, {"stdin": True})
+            self._data = io.BytesIO(client.read_message(self._rfile)[1])
+
+        return self._data.readinto(buffer)
+
+
+def run_request(request, run, stdin):
+    """Call run with the argv of request in its working directory.
+
+    sys.stdin is replaced by stdin, stdout and stderr are captured. Exceptions
+    are reported on the captured stderr, so the server keeps running.
+
+    :param request: Dict with argv and cwd
+    :param run: Function taking argv and returning the exit status
+    :param stdin: Binary stream to use as standard input
+    :return: Tuple of exit status, stdout as bytes and stderr as str
+    """
+
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    stderr = io.StringIO()
+    saved = (os.getcwd(), sys.stdin, sys.stdout, sys.stderr)
+    sys.stdin = io.TextIOWrapper(stdin, encoding="utf-8")
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        os.chdir(request["cwd"])
+        status = run(request["argv"])
+    except Exception:
+        stderr.write(traceback.format_exc())
+        status = 1
+    finally:
+        os.chdir(saved[0])
+        sys.stdin, sys.stdout, sys.stderr = saved[1:]
+
+    stdout.flush()
+    return status, stdout.buffer.getvalue(), stderr.getvalue()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Runs one request of a client."""
+
+    def handle(self):
+        try:
+            request, _ = client.read_message(self.rfile)
+        except (EOFError, ValueError):
+            return
+
+        refresh_caches()
+        stdin = io.BufferedReader(RemoteStdin(self.rfile, self.wfile))
+        status, stdout, stderr = run_request(request, self.server.run, stdin)
+
+        try:
+            client.send_message(
+                self.wfile, {"status": status, "stderr": stderr}, stdout
+            )
+        except OSError:
+            # The client is gone
+            pass
+
+
+class Server(socketserver.UnixStreamServer):
+    """Unix socket server handling one request after another, as they share
+    the caches, the working directory and sys.stdout.
+
+    :param path: Path of the socket. A socket file left behind by a server
+                 which is not running anymore is replaced.
+    :param run: Function taking argv and returning the exit status
+    """
+
+    def __init__(self, path, run):
+        self.run = run
+        self.bound = False
+        remove_stale_socket(path)
+        super().__init__(path, RequestHandler)
+
+    def server_bind(self):
+        # Only the user may connect, requests can write any file they can
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        self.bound = True
+
+    def server_close(self):
+        super().server_close()
+        # Not if the socket belongs to another server
+        if self.bound:
+            self.bound = False
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+
+
+def remove_stale_socket(path):
+    """Remove the socket file path if no server listens on it."""
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        return
+
+    sock = client.connect(path)
+    if sock is None:
+        os.unlink(path)
+    else:
+        sock.close()
@@ -0,0 +1,366 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Statistics of a run: wall and CPU time per phase, counters and caches.
+
+Nothing is measured unless ENABLED is set. Phases can be nested, e.g. fetch
+and parse happen during xinclude, and the outer phase includes the time of
+the inner ones. A phase entered again while it is active is not measured
+twice. Only the calling thread is measured, the CPU time includes all threads.
+
+If TRACE is a list, each phase and each span started with begin_span is
+appended to it as trace event when it ends, in the Trace Event Format of
+Chrome and Perfetto. Spans of one process nest like the calls, so they
+end in the reverse order they began.
+"""
+
+import collections
+import functools
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: nocover
+    resource = None
+
+# Whether phases and counters are measured
+ENABLED = False
+
+# Phase name -> [calls, wall seconds, CPU seconds]
+PHASES = {}
+
+# Counter name -> value
+COUNTERS = collections.Counter()
+
+# Counters which are always reported, others follow sorted by name
+COUNTER_NAMES = [
+    "includes",
+    "fetched_bytes",
+    "parsed_documents",
+    "parsed_elements",
+    "catalog_lookups",
+    "catalog_cache_hits",
+    "catalog_subprocesses",
+]
+
+# Trace events of the phases and spans which ended, None unless tracing
+TRACE = None
+
+# Spans which began and didn't end yet, the innermost last
+SPANS = []
+
+# Names of the phases being measured
+ACTIVE = set()
+
+# Caches to report, name -> LRUCache
+CACHES = {}
+
+# LRUCache.stats() of the CACHES and the time and CPU time at the last reset
+BASELINE = {}
+
+# Order of the phases in the report, others follow in the order they started
+PHASE_ORDER = [
+    "prefetch",
+    "parse",
+    "xinclude",
+    "catalog",
+    "fetch",
+    "fragid",
+    "flatten",
+    "docbook ids",
+    "docbook references",
+    "docbook namespaces",
+    "serialize",
+]
+
+
+class Phase:
+    """Context manager adding its wall and CPU time to PHASES[name] and
+    recording it as trace event."""
+
+    __slots__ = ("name", "wall", "cpu")
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = self.cpu = None
+
+    def __enter__(self):
+        ACTIVE.add(self.name)
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        if ENABLED:
+            entry = PHASES.setdefault(self.name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += end - self.wall
+            entry[2] += time.process_time() - self.cpu
+        if TRACE is not None:
+            trace_event(self.name, "phase", self.wall, end, {})
+        ACTIVE.discard(self.name)
+
+
+class Span:
+    """Interval between begin_span and end_span, with arguments to show."""
+
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = time.perf_counter()
+
+
+class NoPhase:
+    """Context manager doing nothing, used when not measuring."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_PHASE = NoPhase()
+
+
+def phase(name):
+    """Return a context manager measuring the code in it as phase name."""
+    if (not ENABLED and TRACE is None) or name in ACTIVE:
+        return NO_PHASE
+
+    return Phase(name)
+
+
+def timed(name):
+    """Decorator measuring each call of the function as phase name."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """Add value to the counter name."""
+    if ENABLED:
+        COUNTERS[name] += value
+
+
+def trace_event(name, category, start, end, args):
+    """Append a complete event from start to end (perf_counter values) to TRACE."""
+    pid = os.getpid()
+    TRACE.append(
+        {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": pid,
+            "args": args,
+        }
+    )
+
+
+def begin_span(name, category, args=None):
+    """Begin a span inside the current one.
+
+    :param args: Dict of arguments to show with the span
+    :return: Span to pass to end_span, None unless tracing
+    """
+
+    if TRACE is None:
+        return None
+
+    span = Span(name, category, {} if args is None else args)
+    SPANS.append(span)
+    return span
+
+
+def annotate(**args):
+    """Add args to the arguments of the innermost span, if any."""
+    if SPANS:
+        SPANS[-1].args.update(args)
+
+
+def end_span(span):
+    """End span, spans inside it which didn't end yet are dropped.
+
+    :param span: Span returned by begin_span, or None
+    """
+
+    if span is None or span not in SPANS:
+        return
+
+    del SPANS[SPANS.index(span) :]
+    trace_event(span.name, span.category, span.start, time.perf_counter(), span.args)
+
+
+def write_trace(path, events):
+    """Write the trace events to the file path as JSON object, with the names
+    of the processes they came from.
+
+    :raises IOError: Couldn't write path
+    """
+
+    names = [
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": pid,
+            "args": {
+                "name": "dbxincluder" if pid == os.getpid() else "dbxincluder worker"
+            },
+        }
+        for pid in sorted({event["pid"] for event in events})
+    ]
+    with open(path, "w") as stream:
+        json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, stream)
+
+
+def reset():
+    """Forget all phases, counters, trace events and open spans and start
+    counting cache accesses."""
+    PHASES.clear()
+    COUNTERS.clear()
+    ACTIVE.clear()
+    if TRACE is not None:
+        del TRACE[:]
+    del SPANS[:]
+    BASELINE.clear()
+    BASELINE.update((name, cache.stats()) for name, cache in CACHES.items())
+    BASELINE[None] = (time.perf_counter(), time.process_time())
+
+
+def merge(phases, counters, events=None):
+    """Add the PHASES, COUNTERS and TRACE of another process, e.g. a worker."""
+    for name, (calls, wall, cpu) in phases.items():
+        entry = PHASES.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += wall
+        entry[2] += cpu
+    COUNTERS.update(counters)
+    if TRACE is not None and events:
+        TRACE.extend(events)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process and of its
+    terminated child processes in bytes, None where unknown."""
+    if resource is None:  # pragma: nocover
+        return None, None
+
+    # Linux reports KiB, macOS bytes
+    unit = 1 if sys.platform == "darwin" else 1024
+    return tuple(
+        resource.getrusage(who).ru_maxrss * unit or None
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+
+def report():
+    """Return the statistics since the last reset as dict for JSON.
+
+    The total time is since the last reset. Cache accesses are counted since
+    the last reset, their size is the current one. The peak RSS is the one of
+    the whole process lifetime.
+    """
+
+    names = [name for name in PHASE_ORDER if name in PHASES]
+    names += [name for name in PHASES if name not in PHASE_ORDER]
+    phases = collections.OrderedDict(
+        (name, dict(zip(("calls", "wall", "cpu"), PHASES[name]))) for name in names
+    )
+    start_wall, start_cpu = BASELINE.get(None, (time.perf_counter(), 0.0))
+    phases["total"] = {
+        "calls": 1,
+        "wall": time.perf_counter() - start_wall,
+        "cpu": time.process_time() - start_cpu,
+    }
+
+    caches = collections.OrderedDict()
+    for name, cache in CACHES.items():
+        current = cache.stats()
+        baseline = BASELINE.get(name, {})
+        caches[name] = {
+            key: (
+                value - baseline.get(key, 0)
+                if key in ("hits", "misses", "evictions")
+                else value
+            )
+            for key, value in current.items()
+        }
+
+    counters = collections.OrderedDict((name, COUNTERS[name]) for name in COUNTER_NAMES)
+    counters.update(sorted(COUNTERS.items()))
+
+    rss, children_rss = peak_rss()
+    return collections.OrderedDict(
+        [
+            ("phases", phases),
+            ("counters", counters),
+            ("caches", caches),
+            ("peak_rss", rss),
+            ("peak_rss_children", children_rss),
+        ]
+    )
+
+
+def format_text(stats):
+    """Return the dict returned by report as tables for humans."""
+
+    row = "{0:<20} {1:>8} {2:>10} {3:>10} {4:>10}"
+    lines = [row.format("Phase", "Calls", "Wall s", "CPU s", "")]
+    for name, entry in stats["phases"].items():
+        wall, cpu = "{0:.3f}".format(entry["wall"]), "{0:.3f}".format(entry["cpu"])
+        lines.append(row.format(name, entry["calls"], wall, cpu, ""))
+
+    lines.append("")
+    for name, value in stats["counters"].items():
+        lines.append(row.format(name.replace("_", " "), "", "", "", value))
+
+    lines.append("")
+    lines.append(row.format("Cache", "Hits", "Misses", "Evictions", "Size"))
+    for name, entry in stats["caches"].items():
+        values = (entry["hits"], entry["misses"], entry["evictions"], entry["size"])
+        lines.append(row.format(name, *values))
+
+    lines.append("")
+    for label, key in (
+        ("Peak RSS", "peak_rss"),
+        ("Peak RSS children", "peak_rss_children"),
+    ):
+        if stats[key] is not None:
+            size = "{0:.1f} MiB".format(stats[key] / 2**20)
+            lines.append(row.format(label, "", "", "", size))
+
+    return "\n".join(line.rstrip() for line in lines) + "\n"
@@ -19,6 +19,7 @@
 """Utility functions and classes used throughout dbxincluder."""
 
 import base64
+import collections
 
 from lxml.etree import QName
 
@@ -29,8 +30,6 @@ NS = {
     "xi": "http://www.w3.org/2001/XInclude",
     "trans": "http://docbook.org/ns/transclude",
     "db": "http://docbook.org/ns/docbook",
-    # Custom namespace for temporary attributes
-    "dbxi": "dbxincluder",
 }
 
 # Commonly used attributes
@@ -39,10 +38,21 @@ QN = {
     "xml:base": QName(NS["xml"], "base"),
     "xi:include": QName(NS["xi"], "include"),
     "xi:fallback": QName(NS["xi"], "fallback"),
-    "dbxi:newid": QName(NS["dbxi"], "newid"),
-    "dbxi:parentline": QName(NS["dbxi"], "line"),
+    "trans:idfixup": QName(NS["trans"], "idfixup"),
+    "trans:suffix": QName(NS["trans"], "suffix"),
 }
 
+# Line of the xi:include element each included root element replaced,
+# used for the "Included by" messages. Cleared after processing a document.
+PARENT_LINES = {}
+
+# Source lines of elements which were parsed again, where libxml2 can't store
+# them (65535 and above). Cleared after processing a document.
+SOURCE_LINES = {}
+
+# Largest line number libxml2 stores in the element itself
+MAX_SOURCE_LINE = 65534
+
 
 def get_inherited_attribute(elem, attribute, default=None):
     """Return the value of the inherited or directly set attribute or default.
@@ -59,6 +69,89 @@ def get_inherited_attribute(elem, attribute, default=None):
     return (values[0].xpath("@" + attribute, namespaces=NS)[0], values[0])
 
 
+def get_id_index(tree):
+    """Return a dict which maps all xml:id values in the document of tree to the
+    list of elements with that ID, in document order.
+
+    :param tree: Any element of the document to index
+    """
+
+    index = {}
+    for elem in tree.xpath("//*[@xml:id]", namespaces=NS):
+        index.setdefault(elem.get(QN["xml:id"]), []).append(elem)
+
+    return index
+
+
+def qualified_name(attribute):
+    """Return the name of attribute like 'trans:idfixup' in Clark notation."""
+    prefix, _, localname = attribute.rpartition(":")
+    return QName(NS[prefix], localname).text if prefix else localname
+
+
+def iter_inherited_attributes(tree, attributes, leave=False):
+    """Iterate over all elements of tree in document order, together with the
+    inherited values of attributes.
+
+    Gives the same results as calling get_inherited_attribute for each element,
+    but the values are passed down the tree in a single walk.
+
+    :param tree: Root of the walk
+    :param attributes: List of attribute names, like 'trans:idfixup'
+    :param leave: Also yield (element, None) after all descendants of element
+    :return: Iterator of tuples (element, dict), the dict maps each attribute
+             to a tuple (value or None, element with value or None)
+    """
+
+    names = [(attribute, qualified_name(attribute)) for attribute in attributes]
+
+    # Values inherited from outside of tree
+    parent = tree.getparent()
+    inherited = {
+        attribute: get_inherited_attribute(parent, attribute)
+        if parent is not None
+        else (None, None)
+        for attribute in attributes
+    }
+
+    stack = [(tree, inherited)]
+    while stack:
+        elem, inherited = stack.pop()
+        if inherited is None:
+            yield elem, None
+            continue
+
+        own = [(attribute, elem.get(name)) for attribute, name in names]
+        own = [(attribute, value) for attribute, value in own if value is not None]
+        if own:
+            inherited = dict(inherited)
+            for attribute, value in own:
+                inherited[attribute] = (value, elem)
+
+        yield elem, inherited
+
+        if leave:
+            stack.append((elem, None))
+
+        children = [child for child in elem if isinstance(child.tag, str)]
+        stack.extend((child, inherited) for child in reversed(children))
+
+
+def source_line(elem):
+    """Return the line elem was parsed from, see SOURCE_LINES."""
+    return SOURCE_LINES.get(elem, elem.sourceline)
+
+
+def set_source_line(elem, line):
+    """Set the line elem was parsed from, None for unknown."""
+    if line is None:
+        elem.sourceline = 0
+    elif line > MAX_SOURCE_LINE:
+        SOURCE_LINES[elem] = line
+    else:
+        elem.sourceline = line
+
+
 def create_xinclude_stack(elem):
     """Return a formatted string which prints the xml:base attributes in inverted order.
     Example:
@@ -73,11 +166,11 @@ def create_xinclude_stack(elem):
         return ""
 
     xml_bases = [elem.get(QN["xml:base"], "<unknown>") for elem in parent_elems][:-1]
-    lines = [elem.get(QN["dbxi:parentline"]) for elem in parent_elems][1:]
+    lines = [PARENT_LINES.get(elem) for elem in parent_elems][1:]
 
     result = [""]
     for filename, line in zip(xml_bases, lines):
-        parent = ":" + line if line is not None else ""
+        parent = ":{0}".format(line) if line is not None else ""
         result.insert(1, "Included by %s%s" % (filename, parent))
 
     return "\n".join(result)
@@ -103,17 +196,150 @@ class DBXIException(Exception):
 
         message = ": " + message if message else ""
         self.error = "{0} at {1}:{2}{3}{4}".format(
-            severity, file, elem.sourceline, message, stack
+            severity, file, source_line(elem), message, stack
         )
         super().__init__(self.error)
 
+    def __reduce__(self):
+        # The element can't be pickled, only the message is kept
+        return (restore_exception, (type(self), self.error))
+
+
+def restore_exception(cls, error):
+    """Return a DBXIException of type cls with the message error, without an
+    element. Used to unpickle them."""
+    exc = Exception.__new__(cls)
+    Exception.__init__(exc, error)
+    exc.error = error
+    return exc
 
-def generate_id(elem):
+
+def child_path_steps(elem):
+    """Return a list of tuples (child, step) for all child elements of elem,
+    where step is the last component of the child's path as returned by
+    ElementTree.getpath.
+
+    This allows computing the paths of all elements top-down, without
+    walking to the root and counting siblings for each element again.
+    """
+
+    children = [child for child in elem if isinstance(child.tag, str)]
+    if not children:
+        return []
+
+    # Same rules as libxml2's xmlGetNodePath: Elements in a default namespace
+    # are named "*" and counted among all siblings, other elements only among
+    # siblings with the same name and prefix.
+    names = []
+    for child in children:
+        if child.tag[0] != "{":
+            names.append(child.tag)
+        elif child.prefix is None:
+            names.append(None)
+        else:
+            names.append(child.prefix + ":" + child.tag.rpartition("}")[2])
+
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+
+    positions = {}
+    steps = []
+    for index, (child, name) in enumerate(zip(children, names)):
+        if name is None:
+            step, count, position = "*", len(children), index + 1
+        else:
+            positions[name] = positions.get(name, 0) + 1
+            step, count, position = name, counts[name], positions[name]
+
+        if count > 1:
+            step += "[{0}]".format(position)
+        steps.append((child, step))
+
+    return steps
+
+
+def generate_id(elem, path=None):
     """Generate a (per-document) unique ID for the XML element elem.
 
+    :param path: Path of elem as returned by getpath, computed if None
     :return: str
     """
 
+    if path is None:
+        path = elem.getroottree().getpath(elem)
+
     # If you change this algorithm, you need to regenerate all testcase outputs
-    path = bytes(elem.getroottree().getpath(elem), encoding="utf-8")
+    path = bytes(path, encoding="utf-8")
     return str(base64.urlsafe_b64encode(path), encoding="utf-8").replace("=", "-")
+
+
+class LRUCache:
+    """Bounded mapping which discards the least recently used entries first.
+
+    Every entry can carry a stamp (e.g. mtime and size of a file). A lookup
+    with a different stamp is treated as miss and drops the outdated entry.
+    The hits, misses and evictions counters can be used to tune maxsize.
+    """
+
+    def __init__(self, maxsize=128):
+        """Construct an empty LRUCache.
+
+        :param maxsize: Maximum number of entries, 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, stamp=None):
+        """Return the value stored for key or None if missing or outdated.
+
+        :param key: Key of the entry
+        :param stamp: Expected stamp of the entry
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, stamp=None):
+        """Store value under key and evict entries exceeding maxsize."""
+        if self.maxsize <= 0:
+            return
+
+        self._entries[key] = (stamp, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard_unstamped(self):
+        """Remove the entries without stamp, which can't be validated."""
+        for key in [key for key, entry in self._entries.items() if entry[0] is None]:
+            del self._entries[key]
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict with the current size and counters."""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
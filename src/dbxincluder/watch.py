@@ -0,0 +1,157 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""Process documents again whenever one of the files they were made of changes.
+
+The files of a document are the input and the local targets in
+xinclude.DEPENDENCIES after processing it, including targets which didn't
+exist, so the set changes with the includes. Files are compared by their stamp
+(see xinclude.get_stamp). On Linux, inotify wakes up on changes in their
+directories, elsewhere or if a directory can't be watched they are polled.
+The caches keep everything that didn't change, so only the includes leading
+to changed files are processed again.
+"""
+
+import ctypes
+import os
+import os.path
+import select
+import time
+
+from . import server, xinclude
+
+# Events of directory entries which might change a stamp
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+
+# Seconds to let a writer finish after the first event before comparing stamps
+SETTLE_TIME = 0.05
+
+
+def dependency_stamps(path, stamp):
+    """Return a dict of the local files the document path was made of and
+    their stamps, read from xinclude.DEPENDENCIES after processing it.
+
+    :param path: Input file, "-" for stdin
+    :param stamp: Stamp of path before processing it
+    """
+
+    stamps = {} if path == "-" else {path: stamp}
+    for url, target_stamp in xinclude.DEPENDENCIES.items():
+        file = xinclude.local_path(url)
+        if file is not None:
+            stamps.setdefault(file, target_stamp)
+
+    return stamps
+
+
+def changed_files(stamps):
+    """Return the set of files in the dict stamps which have another stamp now."""
+    return {file for file, stamp in stamps.items() if xinclude.get_stamp(file) != stamp}
+
+
+def inotify_fd(directories):
+    """Return an inotify file descriptor watching directories for changes of
+    their entries, or None if inotify or one of the directories is unavailable.
+    """
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:  # pragma: nocover
+        return None
+
+    for directory in directories:
+        if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+
+    return fd
+
+
+def wait_for_changes(stamps, interval=1.0, timeout=None):
+    """Wait until one of the files in stamps doesn't have its stamp anymore.
+
+    :param stamps: Dict of local files and their stamps
+    :param interval: Seconds between checks if inotify is unavailable
+    :param timeout: Seconds to wait at most, None to wait forever
+    :return: Set of the changed files, empty after the timeout
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    directories = {os.path.dirname(os.path.abspath(file)) for file in stamps}
+    fd = inotify_fd(directories)
+    try:
+        while True:
+            changed = changed_files(stamps)
+            if changed:
+                return changed
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return set()
+
+            if fd is None:
+                time.sleep(interval if remaining is None else min(interval, remaining))
+            elif select.select([fd], [], [], remaining)[0]:
+                time.sleep(SETTLE_TIME)
+                while select.select([fd], [], [], 0)[0]:
+                    os.read(fd, 65536)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def watch(jobs, run, interval=1.0):
+    """Call run(input, output) for each tuple of the list jobs, and again for
+    each job whenever one of the files it was made of changes. Only returns
+    by exception, e.g. KeyboardInterrupt.
+
+    :param run: Function processing a document and leaving the targets it
+                fetched in xinclude.DEPENDENCIES
+    :param interval: Seconds between checks if inotify is unavailable
+    """
+
+    stamps = {}
+    while True:
+        pending = [
+            job for job in jobs if job not in stamps or changed_files(stamps[job])
+        ]
+        if not pending:
+            watched = {}
+            for job_stamps in stamps.values():
+                watched.update(job_stamps)
+            wait_for_changes(watched, interval)
+            continue
+
+        # Drops what inotify doesn't notice, e.g. changed catalogs
+        server.refresh_caches()
+        for path, output in pending:
+            stamp = None if path == "-" else xinclude.get_stamp(path)
+            run(path, output)
+            stamps[(path, output)] = dependency_stamps(path, stamp)
@@ -18,16 +18,85 @@
 
 """xinclude module: Processes raw XInclude 1.1 elements."""
 
+import array
+import copy
+import functools
+import mmap
 import os.path
 import re
 import sys
+import urllib.parse
 import urllib.request
 
-from lxml.etree import QName, XMLSyntaxError, fromstring
-
-from .utils import NS, QN, DBXIException, get_inherited_attribute
+from lxml.etree import Element, QName, XMLSyntaxError, fromstring
+
+from . import httpcache, stats
+from .utils import (
+    NS,
+    PARENT_LINES,
+    QN,
+    SOURCE_LINES,
+    DBXIException,
+    LRUCache,
+    create_xinclude_stack,
+    get_id_index,
+    get_inherited_attribute,
+    source_line,
+)
 from .xmlcat import lookup_url
 
+# Content of fetched targets, keyed by URL
+TARGET_CACHE = LRUCache(256)
+# Parsed target documents, keyed by URL and validated by their content
+DOCUMENT_CACHE = LRUCache(128)
+# TextTargets of text/plain includes, keyed by URL
+TEXT_CACHE = LRUCache(64)
+# Expansions of xi:include elements with further includes in their target,
+# keyed by target, XML catalog, attributes and namespace context and
+# validated by the content of the target
+EXPANSION_CACHE = LRUCache(256)
+
+stats.CACHES.update(
+    targets=TARGET_CACHE,
+    documents=DOCUMENT_CACHE,
+    texts=TEXT_CACHE,
+    expansions=EXPANSION_CACHE,
+)
+
+# Keys of EXPANSION_CACHE seen before, validated like its entries
+INCLUDED = LRUCache(1024)
+
+# Whether to record the expansions of all includes, for documents processed
+# more than once. Otherwise only includes of keys in INCLUDED are recorded,
+# copying every expanded subtree would slow down single runs.
+RECORD_EXPANSIONS = False
+
+# Expansions being recorded, innermost last
+EXPANDING = []
+
+# Targets fetched since this was last cleared, with their stamp (see get_stamp)
+DEPENDENCIES = {}
+
+# Timeout in seconds for network requests, None for none
+TIMEOUT = None
+
+# Number of nested includes to record expansions for, each level keeps a copy
+MAX_EXPANSION_DEPTH = 8
+
+# RFC 5147 fragment identifiers, the integrity check is validated but ignored
+FRAGID_RFC5147 = re.compile(
+    r"^(char|line)=(?:(?:(\d+)(?:,(\d+)?)?)|(?:,(\d+)))"
+    r"(?:;(?:length=(\d+)|md5=[0-9a-fA-F]{32})(?:,(\w+)?)?)?$"
+)
+
+# Line boundaries as recognized by str.splitlines, in UTF-8 encoded bytes and
+# in decoded text (without "\\n", which needs no conversion). None of the bytes
+# can be part of another UTF-8 sequence.
+LINE_BREAKS_UTF8 = re.compile(
+    rb"\r\n|[\n\r\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]"
+)
+LINE_BREAKS = re.compile(r"\r\n|[\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]")
+
 
 class ResourceError(DBXIException):
     """Same as DBXIException, just for resource errors."""
@@ -78,13 +147,264 @@ def copy_attributes(elem, subtree):
             subtree.set(name, value)
 
 
-def get_target(elem, base_url, xmlcatalog=None, file=None):
+def local_path(url):
+    """Return the local file system path of url or None if it is not a local file."""
+    if "://" not in url:
+        return url
+
+    if url.startswith("file://"):
+        return urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+
+    return None
+
+
+def get_stamp(url):
+    """Return a tuple of mtime and size of the local file url or None."""
+    path = local_path(url)
+    if path is None:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_url(url, timeout=None):
+    """Return the content of url as bytes, without caching.
+
+    :param timeout: Timeout in seconds for network requests, None for none
+    :raises URLError: Couldn't fetch url
+    """
+
+    if "://" not in url:  # Add file:// for URLs without scheme
+        url = "file://" + os.path.abspath(url)
+    elif url.startswith(("http://", "https://")) and httpcache.enabled():
+        return httpcache.fetch(url, timeout)
+
+    if timeout is None:
+        target = urllib.request.urlopen(url)
+    else:
+        target = urllib.request.urlopen(url, timeout=timeout)
+    content = target.read()
+    target.close()
+
+    return content
+
+
+def store_target(url, content, stamp):
+    """Store the content of url fetched with stamp in TARGET_CACHE."""
+    stats.count("fetched_bytes", len(content))
+
+    # Local files which vanished in between are not cached
+    if stamp is not None or local_path(url) is None:
+        TARGET_CACHE.put(url, content, stamp)
+
+
+@stats.timed("fetch")
+def fetch_url(url):
+    """Return the content of url as bytes. Results are stored in TARGET_CACHE,
+    local files are validated by their mtime and size.
+
+    :raises URLError: Couldn't fetch url
+    """
+
+    stamp = get_stamp(url)
+    record_dependency(url, stamp)
+    content = TARGET_CACHE.get(url, stamp)
+    if content is not None:
+        return content
+
+    content = read_url(url, TIMEOUT)
+    store_target(url, content, stamp)
+
+    return content
+
+
+class TextTarget:
+    """Content of a text/plain target with an index of its line offsets.
+
+    Lines are split like str.splitlines and joined with "\\n". The index and
+    the normalized text are built on first use, so a fragid only decodes the
+    part of the content it selects.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: Content as UTF-8 encoded bytes or mmap
+        """
+        self.data = data
+        self._starts = None
+        self._ends = None
+        self._text = None
+
+    def _index(self):
+        """Build the start and end (without line break) offsets of all lines."""
+        self._starts = array.array("q")
+        self._ends = array.array("q")
+        pos = 0
+        for match in LINE_BREAKS_UTF8.finditer(self.data):
+            self._starts.append(pos)
+            self._ends.append(match.start())
+            pos = match.end()
+
+        # Like splitlines, there is no empty line after a trailing line break.
+        # Lines are counted in the normalized text, which lost the line break
+        # after an empty last line.
+        if pos < len(self.data):
+            self._starts.append(pos)
+            self._ends.append(len(self.data))
+        elif self._starts and self._starts[-1] == self._ends[-1]:
+            self._starts.pop()
+            self._ends.pop()
+
+    def text(self):
+        """Return the complete content with normalized line breaks.
+
+        :raises UnicodeDecodeError: Content is not valid UTF-8
+        """
+        if self._text is None:
+            self._text = "\n".join(str(self.data, encoding="utf-8").splitlines())
+
+        return self._text
+
+    def lines(self, start, end=None):
+        """Return lines start to end (exclusive, None for all) joined with "\\n".
+
+        :raises UnicodeDecodeError: Selected lines are not valid UTF-8
+        """
+        if self._starts is None:
+            self._index()
+
+        count = len(self._starts)
+        end = min(end, count) if end is not None else count
+        start = min(start, end)
+        if start == end:
+            return ""
+
+        content = str(self.data[self._starts[start] : self._ends[end - 1]], "utf-8")
+        return LINE_BREAKS.sub("\n", content)
+
+    def fragment(self, fragid=None):
+        """Same as text_fragid for the normalized content.
+
+        :return tuple: (Result as str, Success as bool)
+        :raises UnicodeDecodeError: Content is not valid UTF-8
+        """
+        parsed = parse_fragid_rfc5147(fragid) if fragid is not None else None
+        if parsed is None:
+            return self.text(), fragid is None
+
+        rtype, start, end = parsed
+        if rtype == "line":
+            return self.lines(start, end), True
+
+        text = self.text()
+        end = min(end, len(text)) if end is not None else len(text)
+        return text[min(start, end) : end], True
+
+
+@stats.timed("fetch")
+def fetch_text(url):
+    """Return the TextTarget of url. Results are stored in TEXT_CACHE, local
+    files are memory-mapped instead of read and validated like in fetch_url.
+
+    :raises URLError: Couldn't fetch url
+    """
+
+    stamp = get_stamp(url)
+    record_dependency(url, stamp)
+    target = TEXT_CACHE.get(url, stamp)
+    if target is not None:
+        return target
+
+    if stamp is None:
+        target = TextTarget(fetch_url(url))
+    elif stamp[1] == 0:
+        # Empty files can't be mapped
+        target = TextTarget(b"")
+    else:
+        with open(local_path(url), "rb") as file:
+            target = TextTarget(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        stats.count("fetched_bytes", stamp[1])
+    TEXT_CACHE.put(url, target, stamp)
+
+    return target
+
+
+class ParsedTarget:
+    """A parsed target document together with its xml:id index.
+
+    Instances are shared through DOCUMENT_CACHE, so the tree must not be modified.
+    Use copy.deepcopy on the parts which get included.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._ids = None
+
+    def find_id(self, xmlid):
+        """Return the list of elements with the given xml:id. The index is built
+        on the first call and reused for all further lookups."""
+        if self._ids is None:
+            self._ids = get_id_index(self.root)
+
+        return self._ids.get(xmlid, [])
+
+
+def parse_target(content, url):
+    """Return the ParsedTarget of the document content fetched from url.
+
+    :raises XMLSyntaxError: Content is not well-formed
+    """
+
+    target = DOCUMENT_CACHE.get(url, content)
+    if target is None:
+        with stats.phase("parse"):
+            target = ParsedTarget(fromstring(content, base_url=url))
+        count_parsed(target.root)
+        DOCUMENT_CACHE.put(url, target, content)
+
+    return target
+
+
+def count_parsed(root):
+    """Count the parsed document root and its elements for the statistics."""
+    if stats.ENABLED:
+        stats.count("parsed_documents")
+        stats.count("parsed_elements", sum(1 for _ in root.iter()))
+
+
+def resolve_href(href, base_url, xmlcatalog=None):
+    """Return the URL of href, looked up in the XML catalog or relative to
+    base_url.
+
+    :param href: href attribute of an xi:include
+    :param base_url: xml:base of the xi:include
+    :param xmlcatalog: XML catalog to use (None means default)
+    """
+
+    url = lookup_url(href, xmlcatalog)
+
+    if url == href and "://" not in href:
+        # Build full URL
+        urlparts = base_url.split("/")
+        if len(urlparts) > 1:
+            url = "/".join(urlparts[:-1]) + "/" + url
+
+    return url
+
+
+def get_target(elem, base_url, xmlcatalog=None, file=None, fetch=fetch_url):
     """Return tuple of the content of the target document as string and the URL
     that was used.
 
     :param elem: XInclude element
     :param base_url: xml:base of the element
     :param xmlcatalog: XML catalog to use (None means default)
+    :param fetch: Function returning the content of a URL
     :raises DBXIException: href attribute is missing
     :raises ResourceError: Couldn't fetch target
     """
@@ -98,21 +418,10 @@ def get_target(elem, base_url, xmlcatalog=None, file=None):
                 elem, "Missing href attribute and no fragid provided", file
             )
     else:
-        url = lookup_url(href, xmlcatalog)
-
-        if url == href:
-            # Build full URL
-            urlparts = base_url.split("/")
-            if len(urlparts) > 1:
-                url = "/".join(urlparts[:-1]) + "/" + url
+        url = resolve_href(href, base_url, xmlcatalog)
 
     try:
-        if "://" in url:
-            target = urllib.request.urlopen(url)
-        else:  # Add file:// for URLs without scheme
-            target = urllib.request.urlopen("file://" + os.path.abspath(url))
-        content = target.read()
-        target.close()
+        content = fetch(url)
     except urllib.error.URLError:
         raise ResourceError(
             elem, "Could not get target {0!r}".format(url), file, severity="Warning"
@@ -128,15 +437,13 @@ def get_target(elem, base_url, xmlcatalog=None, file=None):
     return content, url
 
 
-def handle_xifallback(elem, xmlcatalog=None, file=None, xinclude_stack=None):
-    """Process the xi:include tag elem. It will be replaced by the content of
-    the xi:fallback subelement.
+def handle_xifallback(elem, file=None):
+    """Prepare the xi:include tag elem to be replaced by the content of the
+    xi:fallback subelement.
 
     :param elem: The XInclude element to process
-    :param xmlcatalog: XML catalog to use (None means default)
     :param file: URL used to report errors
-    :param xinclude_stack: List (or None) of str with url and fragid to detect infinite recursion
-    :return: True if xi:fallback found
+    :return: IncludeFrame for the xi:fallback or None if there is none
     """
 
     # There can be only xi:fallback in a xi:include, so just use the first child
@@ -145,17 +452,15 @@ def handle_xifallback(elem, xmlcatalog=None, file=None, xinclude_stack=None):
         or not isinstance(elem.tag, str)
         or QName(elem[0]) != QN["xi:fallback"]
     ):
-        return False
+        return None
 
     # Save the tailing text
     append_to_tail(elem[0], elem.tail)
 
-    # process_xinclude before replacement to not lose xml:base on xi:include or xi:fallback
-    process_xinclude(elem[0], None, xmlcatalog, file, xinclude_stack)
-
-    # Two passes for fallback processing, flatten them after process_xinclude in process_tree
-    elem.getparent().replace(elem, elem[0])
-    return True
+    # Process the content before replacement to not lose xml:base on
+    # xi:include or xi:fallback, the frame replaces elem when leaving.
+    # Two passes for fallback processing, flatten them after process_xinclude
+    return IncludeFrame(elem[0], None, file, replaces=elem)
 
 
 def validate_xinclude(elem, file):
@@ -190,13 +495,7 @@ def parse_fragid_rfc5147(fragid):
     :return: None or tuple('line'/'char', start, end/None)
     """
 
-    # Validated, but ignored
-    integrity = r";(?:length=(\d+)|md5=[0-9a-fA-F]{32})(?:,(\w+)?)?"
-    regex = re.compile(
-        r"^(char|line)=(?:(?:(\d+)(?:,(\d+)?)?)|(?:,(\d+)))(?:" + integrity + r")?$"
-    )
-
-    match = regex.match(fragid)
+    match = FRAGID_RFC5147.match(fragid)
     if not match:
         return None
 
@@ -246,14 +545,44 @@ def text_fragid(content, fragid=None):
         return content[start:end], True
 
 
-def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=None):
+def traced_include(function):
+    """Decorator for handle_xinclude recording each include as span, which
+    ends when the returned IncludeFrame is left, so spans nest like includes."""
+
+    @functools.wraps(function)
+    def wrapper(elem, *args, **kwargs):
+        if stats.TRACE is None:
+            return function(elem, *args, **kwargs)
+
+        attributes = {
+            "href": elem.get("href"),
+            "fragid": elem.get("fragid"),
+            "parse": elem.get("parse", "xml"),
+        }
+        name = attributes["href"] or "xi:include"
+        span = stats.begin_span(name, "include", attributes)
+        frame = function(elem, *args, **kwargs)
+        if frame is None:
+            stats.end_span(span)
+        else:
+            frame.span = span
+        return frame
+
+    return wrapper
+
+
+@traced_include
+def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, active_includes=None):
     """Process the xi:include tag elem.
 
     :param elem: The XInclude element to process
     :param base_url: xml:base to use if not specified in the document
     :param xmlcatalog: XML catalog to use (None means default)
     :param file: URL used to report errors
-    :param xinclude_stack: List (or None) of str with url and fragid to detect infinite recursion
+    :param active_includes: Set (or None) of str with url and fragid of the
+                            includes being processed to detect infinite recursion
+    :return: IncludeFrame for the included content, None if there is nothing
+             left to process
     """
 
     assert QName(elem) == QN["xi:include"], "Not an XInclude"
@@ -262,6 +591,8 @@ def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=N
     if elem.get("xpointer") is not None:
         assert False, "xpointer not implemented. Use fragid instead"  # pragma: no cover
 
+    stats.count("includes")
+
     # Validate attributes
     validate_xinclude(elem, file)
 
@@ -270,19 +601,24 @@ def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=N
     if base_url is None:
         raise DBXIException(elem, "Could not get base URL", file)  # pragma: no cover
 
-    # Load target
+    # Load target, text is indexed instead of parsed
+    parse = elem.get("parse", "xml")
+    fetch = fetch_url if parse == "xml" else fetch_text
     try:
-        content, url = get_target(elem, base_url, xmlcatalog, file)
+        content, url = get_target(elem, base_url, xmlcatalog, file, fetch)
+        stats.annotate(url=url, bytes=len(content if parse == "xml" else content.data))
     except ResourceError as rex:
         # Is this output appropriate?
-        print(str(rex), file=sys.stderr)
+        report_warning(str(rex))
+        stats.annotate(fallback=True)
 
-        if not handle_xifallback(elem, xmlcatalog, file, xinclude_stack):
+        fallback = handle_xifallback(elem, file)
+        if fallback is None:
             raise DBXIException(
                 elem, "Target not available and no fallback provided", file
             )
 
-        return
+        return fallback
 
     # Save text after element
     saved_tail = elem.tail if elem.tail else ""
@@ -291,20 +627,24 @@ def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=N
     fragid = elem.get("fragid", None)
 
     # Include as text
-    if elem.get("parse", "xml") != "xml":
-        # Convert line endings
-        content = "\n".join(str(content, encoding="utf-8").splitlines())
-        content, success = text_fragid(content, fragid)
+    if parse != "xml":
+        # Line endings are converted by the TextTarget
+        try:
+            content, success = content.fragment(fragid)
+        except UnicodeDecodeError as exc:
+            raise DBXIException(
+                elem, "Could not decode {0!r}: {1}".format(url, str(exc)), file
+            )
+        stats.annotate(characters=len(content))
         if not success:
-            print(
+            report_warning(
                 str(
                     DBXIException(
                         elem,
                         "Invalid fragid for text/plain: {0!r}".format(fragid),
                         severity="Warning",
                     )
-                ),
-                file=sys.stderr,
+                )
             )
 
         prev = elem.getprevious()
@@ -314,27 +654,29 @@ def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=N
             append_to_text(elem.getparent(), content + saved_tail)
 
         elem.getparent().remove(elem)
-        return
+        return None
 
     # Check for infinite recursion
-    if xinclude_stack is None:
-        xinclude_stack = []
+    if active_includes is None:
+        active_includes = set()
 
     xinclude_id = "{0!r}>{1!r}".format(url, fragid)
-    if xinclude_id in xinclude_stack:
+    if xinclude_id in active_includes:
         raise DBXIException(elem, "Infinite recursion detected", file)
 
     # Parse as XML
     try:
-        subtree = fromstring(content, base_url=url)
+        target = parse_target(content, url)
     except (XMLSyntaxError, UnicodeDecodeError) as exc:
         raise DBXIException(
             elem, "Could not parse {0!r}: {1}".format(url, str(exc)), file
         )
 
     # Get subdocument
+    subtree = target.root
     if fragid is not None:
-        subtree = subtree.xpath("//*[@xml:id={0!r}]".format(fragid))
+        with stats.phase("fragid"):
+            subtree = target.find_id(fragid)
         if len(subtree) == 1:
             subtree = subtree[0]
             # Get xml:base of subdocument
@@ -348,67 +690,318 @@ def handle_xinclude(elem, base_url, xmlcatalog=None, file=None, xinclude_stack=N
                 ),
             )
 
-    # Copy certain attributes from xi:include to the target tree
-    copy_attributes(elem, subtree)
+    for expansion in EXPANDING:
+        expansion.nested_ids.add(xinclude_id)
+
+    # The namespaces in scope decide which declarations the subtree keeps
+    key = (
+        xinclude_id,
+        xmlcatalog,
+        tuple(elem.items()),
+        frozenset(elem.getparent().nsmap.items()),
+    )
+    expansion = EXPANSION_CACHE.get(key, content)
+    if expansion is not None and not expansion.is_valid(active_includes):
+        expansion = None
+
+    if expansion is None:
+        # Work on a copy, the parsed document is cached
+        subtree = copy.deepcopy(subtree)
+
+        # Copy certain attributes from xi:include to the target tree
+        copy_attributes(elem, subtree)
+    else:
+        subtree = expansion.restore()
 
     subtree.tail = saved_tail
 
     # Replace XInclude by subtree
     elem.getparent().replace(elem, subtree)
 
-    process_xinclude(
-        subtree, url, xmlcatalog, url, elem.sourceline, xinclude_stack + [xinclude_id]
+    frame = start_include(subtree, url, url, source_line(elem), xinclude_id)
+    stats.annotate(cached=expansion is not None)
+    if expansion is not None:
+        # Its includes are processed already
+        frame.children = iter(())
+        expansion.replay(subtree)
+        return frame
+
+    if len(EXPANDING) < MAX_EXPANSION_DEPTH:
+        if RECORD_EXPANSIONS or INCLUDED.get(key, content):
+            frame.expansion = Expansion(subtree, key, content)
+        else:
+            INCLUDED.put(key, True, content)
+    return frame
+
+
+def record_dependency(url, stamp):
+    """Record in DEPENDENCIES and the expansions in progress that they depend
+    on url in the version with the given stamp (see get_stamp)."""
+    DEPENDENCIES.setdefault(url, stamp)
+    local = local_path(url) is not None
+    for expansion in EXPANDING:
+        expansion.dependencies.setdefault(url, stamp)
+        expansion.cacheable = expansion.cacheable and local
+
+
+def report_warning(message):
+    """Print the warning message and record it for the expansions in progress."""
+    print(message, file=sys.stderr)
+    for expansion in EXPANDING:
+        # Without the part depending on where the expansion is included
+        stack = create_xinclude_stack(expansion.tree)
+        expansion.messages.append(message[: len(message) - len(stack)])
+
+
+class Expansion:
+    """An included subtree with all xi:include elements below it processed,
+    recorded to reuse it for other includes of the same target.
+
+    While the includes are processed, tree is the subtree in the document and
+    everything it depends on is recorded. When stored in EXPANSION_CACHE, tree
+    is replaced by a copy.
+    """
+
+    __slots__ = (
+        "tree",
+        "key",
+        "content",
+        "dependencies",
+        "nested_ids",
+        "parent_lines",
+        "messages",
+        "cacheable",
     )
 
+    def __init__(self, tree, key, content):
+        """
+        :param tree: Root element of the included subtree
+        :param key: Key in EXPANSION_CACHE
+        :param content: Content of the target, to validate the entry
+        """
+        self.tree = tree
+        self.key = key
+        self.content = content
+        # Stamps of all targets of the includes in tree, None if missing
+        self.dependencies = {}
+        # IDs of the includes in tree, to detect infinite recursion
+        self.nested_ids = set()
+        # PARENT_LINES of the elements in tree, by position in tree.iter()
+        self.parent_lines = []
+        # Warnings without the "Included by" lines of tree itself
+        self.messages = []
+        # Whether all targets are local files, others can't be validated
+        self.cacheable = True
+
+    def store(self):
+        """Store a copy in EXPANSION_CACHE, if tree has includes and all of
+        them are local files."""
+        if not self.cacheable or not self.dependencies:
+            return
+
+        self.parent_lines = [
+            (number, PARENT_LINES[node])
+            for number, node in enumerate(self.tree.iter())
+            if number > 0 and node in PARENT_LINES
+        ]
+        self.tree = copy.deepcopy(self.tree)
+        self.tree.tail = None
+        EXPANSION_CACHE.put(self.key, self, self.content)
+
+    def is_valid(self, active_includes):
+        """Return whether none of the targets changed and none of the includes
+        in tree is in the set active_includes."""
+        return self.nested_ids.isdisjoint(active_includes) and all(
+            get_stamp(url) == stamp for url, stamp in self.dependencies.items()
+        )
 
-def process_subtree(tree, base_url, xmlcatalog, file, xinclude_stack):
-    """Like process_xinclude, but for subtrees."""
+    def restore(self):
+        """Return a copy of tree and add the PARENT_LINES of its elements."""
+        tree = copy.deepcopy(self.tree)
+        if self.parent_lines:
+            nodes = list(tree.iter())
+            for number, line in self.parent_lines:
+                PARENT_LINES[nodes[number]] = line
 
-    # for elem in tree.getiterator() does not work here, as we modify tree in-place
-    for elem in tree:
-        if not isinstance(elem.tag, str):
-            continue
+        return tree
 
-        if QName(elem) == QN["xi:include"]:
-            handle_xinclude(elem, base_url, xmlcatalog, file, xinclude_stack)
-            # handle_xinclude calls process_tree itself if required
-        else:
-            process_subtree(elem, base_url, xmlcatalog, file, xinclude_stack)
+    def replay(self, tree):
+        """Report the warnings and record the dependencies again, as if the
+        includes in tree (restored and included) were just processed."""
+        for url, stamp in self.dependencies.items():
+            record_dependency(url, stamp)
+        for expansion in EXPANDING:
+            expansion.nested_ids.update(self.nested_ids)
 
+        for message in self.messages:
+            report_warning(message + create_xinclude_stack(tree))
 
-def flatten_subtree(tree):
-    """Remove all xi:fallback elements in tree by replacing them with their
-    content."""
 
-    i = 0
-    while i < len(tree):
-        elem = tree[i]
-        if not isinstance(elem.tag, str):
-            i += 1
-            continue
+class IncludeFrame:
+    """Children of an element which are still to be processed, together with
+    the context to process them in.
 
-        if QName(elem) == QN["xi:fallback"]:
-            # Copy tail
-            if len(elem):
-                append_to_tail(elem[-1], elem.tail)
-            else:
-                append_to_text(elem, elem.tail)
+    Used as work stack entries by process_subtree, instead of recursing for
+    each element and include.
+    """
+
+    __slots__ = (
+        "tree",
+        "children",
+        "base_url",
+        "file",
+        "xinclude_id",
+        "replaces",
+        "expansion",
+        "span",
+    )
 
-            # Copy text
-            prev = elem.getprevious()
-            if prev is not None:
-                append_to_tail(prev, elem.text)
+    def __init__(self, tree, base_url, file, xinclude_id=None, replaces=None):
+        """
+        :param tree: Element to process the children of
+        :param base_url: xml:base to use if not specified in the document
+        :param file: URL used to report errors
+        :param xinclude_id: Include to mark active while processing tree
+        :param replaces: Element to replace by tree when done
+        """
+        self.tree = tree
+        # Not tree.iter(), as elements are replaced in-place
+        self.children = iter(tree)
+        self.base_url = base_url
+        self.file = file
+        self.xinclude_id = xinclude_id
+        self.replaces = replaces
+        # Expansion to record while processing tree
+        self.expansion = None
+        # stats.Span of the include to end when done
+        self.span = None
+
+    def enter(self, active_includes):
+        """Mark the include of this frame as active."""
+        if self.xinclude_id is not None:
+            active_includes.add(self.xinclude_id)
+        if self.expansion is not None:
+            EXPANDING.append(self.expansion)
+
+    def leave(self, active_includes):
+        """Finish the frame after all children are processed."""
+        if self.xinclude_id is not None:
+            active_includes.discard(self.xinclude_id)
+        if self.expansion is not None:
+            EXPANDING.pop()
+            self.expansion.store()
+        if self.span is not None:
+            # xi:fallback elements are replaced by their content later
+            elements = self.tree.iter(Element)
+            fallback = QN["xi:fallback"].text
+            self.span.args["elements"] = sum(1 for e in elements if e.tag != fallback)
+            stats.end_span(self.span)
+
+        if self.replaces is not None:
+            self.replaces.getparent().replace(self.replaces, self.tree)
+
+
+def start_include(tree, base_url, file, parent_line=None, xinclude_id=None):
+    """Add xml:base (=source) and the parent line to the root element tree.
+
+    :return: IncludeFrame to process the children of tree
+    """
+
+    if base_url and not tree.get(QN["xml:base"]):
+        tree.set(QN["xml:base"], base_url)
+
+    if parent_line is not None:
+        PARENT_LINES[tree] = parent_line
+
+    return IncludeFrame(tree, base_url, file, xinclude_id)
+
+
+def process_subtree(frame, xmlcatalog, active_includes):
+    """Process all xi:include elements below the element of frame.
+
+    Walks the elements with an explicit stack of frames, so the nesting depth
+    of elements and includes is only limited by memory.
+
+    :param frame: IncludeFrame to start with
+    :param xmlcatalog: XML catalog to use (None means default)
+    :param active_includes: Set of the includes being processed
+    """
+
+    # Expansions left unfinished by errors are not recorded any further
+    depth = len(EXPANDING)
+    frame.enter(active_includes)
+    stack = [frame]
+    try:
+        while stack:
+            frame = stack[-1]
+            elem = next(frame.children, None)
+            if elem is None:
+                stack.pop()
+                frame.leave(active_includes)
+                continue
+
+            if not isinstance(elem.tag, str):
+                continue
+
+            if elem.tag == QN["xi:include"].text:
+                child = handle_xinclude(
+                    elem, frame.base_url, xmlcatalog, frame.file, active_includes
+                )
+                if child is None:
+                    continue
             else:
-                append_to_text(tree, elem.text)
+                child = IncludeFrame(elem, frame.base_url, frame.file)
 
-            # Copy child elements
-            for subelem in elem:
-                tree.insert(tree.index(elem), subelem)
+            child.enter(active_includes)
+            stack.append(child)
+    finally:
+        del EXPANDING[depth:]
+
+
+def flatten_children(tree):
+    """Replace all xi:fallback children of tree by their content. Does not
+    descend into other children."""
+
+    elem = next(iter(tree), None)
+    while elem is not None:
+        if elem.tag != QN["xi:fallback"].text:
+            elem = elem.getnext()
+            continue
 
-            tree.remove(elem)
+        # Continue with the content, it might contain xi:fallback as well
+        following = elem[0] if len(elem) else elem.getnext()
+
+        # Copy tail
+        if len(elem):
+            append_to_tail(elem[-1], elem.tail)
+        else:
+            append_to_text(elem, elem.tail)
+
+        # Copy text
+        prev = elem.getprevious()
+        if prev is not None:
+            append_to_tail(prev, elem.text)
         else:
-            i += 1
-            flatten_subtree(elem)
+            append_to_text(tree, elem.text)
+
+        # Copy child elements
+        for subelem in elem:
+            elem.addprevious(subelem)
+
+        tree.remove(elem)
+        elem = following
+
+
+@stats.timed("flatten")
+def flatten_subtree(tree):
+    """Remove all xi:fallback elements in tree by replacing them with their
+    content."""
+
+    stack = [tree]
+    while stack:
+        elem = stack.pop()
+        flatten_children(elem)
+        stack.extend(child for child in elem if isinstance(child.tag, str))
 
 
 def process_xinclude(
@@ -417,13 +1010,13 @@ def process_xinclude(
     xmlcatalog=None,
     file=None,
     parent_line=None,
-    xinclude_stack=None,
+    active_includes=None,
 ):
     """Processes an ElementTree:
 
     - Search and process xi:include
     - Add xml:base (=source) to the root element
-    - Add dbxi:parentline to the root element to show where it was included at
+    - Record in PARENT_LINES where the root element was included at
 
     This does not resolve xi:fallback correctly.
     Use process_tree for that.
@@ -433,31 +1026,33 @@ def process_xinclude(
     :param xmlcatalog: XML catalog to use (None means default)
     :param file: URL used to report errors
     :param parent_line: line in the document where the source xi:include is
-    :param xinclude_stack: Internal
+    :param active_includes: Internal
     """
 
-    if base_url and not tree.get(QN["xml:base"]):
-        tree.set(QN["xml:base"], base_url)
-
-    if parent_line is not None:
-        tree.set(QN["dbxi:parentline"], str(parent_line))
+    if active_includes is None:
+        active_includes = set()
 
-    process_subtree(tree, base_url, xmlcatalog, file, xinclude_stack)
+    frame = start_include(tree, base_url, file, parent_line)
+    process_subtree(frame, xmlcatalog, active_includes)
 
 
-def process_tree(tree, base_url=None, xmlcatalog=None, file=None, xinclude_stack=None):
+def process_tree(tree, base_url=None, xmlcatalog=None, file=None, active_includes=None):
     """Processes an ElementTree:
 
     - Search and process xi:include
     - Add xml:base (=source) to the root element
-    - Add dbxi:line to show where the source xi:include is
+    - Remove xi:fallback elements by replacing them with their content
 
     :param tree: ElementTree to process (gets modified)
     :param base_url: xml:base to use if not set in the tree
     :param xmlcatalog: XML catalog to use (None means default)
     :param file: URL used to report errors
-    :param xinclude_stack: Internal
+    :param active_includes: Internal
     """
 
-    process_xinclude(tree, base_url, xmlcatalog, file, None, xinclude_stack)
-    flatten_subtree(tree)
+    try:
+        process_xinclude(tree, base_url, xmlcatalog, file, None, active_includes)
+        flatten_subtree(tree)
+    finally:
+        PARENT_LINES.clear()
+        SOURCE_LINES.clear()
@@ -16,12 +16,315 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 #
 
-"""xmlcat module: Provide xml-catalog lookups."""
+"""xmlcat module: Provide xml-catalog lookups.
 
+Catalogs are parsed and resolved natively where possible. Only constructs
+which are not handled here (delegation, public identifiers, non-OASIS
+catalogs) are passed to the xmlcatalog tool of libxml2.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import re
 import subprocess
+import tempfile
+import urllib.parse
+import urllib.request
+
+import lxml.etree
 
+from . import stats
+
+# Lookup results, keyed by catalog and URL
 XMLCAT_CACHE = {}
 
+# Parsed catalog files, keyed by their path or URL
+CATALOG_CACHE = {}
+
+# Modification time and size of the files in CATALOG_CACHE when they were read
+CATALOG_STAMPS = {}
+
+# Directory for lookup results which persist across processes, None disables it
+DISK_CACHE_DIR = None
+
+# PersistentCache instances, keyed by directory and catalog, None for
+# catalogs which can't be stored
+DISK_CACHES = {}
+
+CATALOG_NS = "urn:oasis:names:tc:entity:xmlns:xml:catalog"
+QN_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+
+# Characters allowed in URI references, anything else is a public identifier
+URI_REGEX = re.compile(r"^[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]*$")
+
+
+class UnsupportedCatalog(Exception):
+    """The catalog needs features the native resolver does not implement."""
+
+
+class PrefixIndex:
+    """Maps strings to the value of the longest matching prefix (or suffix).
+
+    Instead of testing every entry, only the distinct prefix lengths are
+    probed, longest first.
+    """
+
+    def __init__(self, suffix=False):
+        self.suffix = suffix
+        self._entries = {}
+        self._lengths = []
+
+    def add(self, key, value):
+        """Add an entry. If key is already known, the first entry wins."""
+        if not key or key in self._entries:
+            return
+
+        self._entries[key] = value
+        if len(key) not in self._lengths:
+            self._lengths.append(len(key))
+            self._lengths.sort(reverse=True)
+
+    def values(self):
+        """Return the values of all entries."""
+        return self._entries.values()
+
+    def lookup(self, string):
+        """Return tuple (key, value) of the longest match or None."""
+        for length in self._lengths:
+            if length > len(string):
+                continue
+
+            key = string[-length:] if self.suffix else string[:length]
+            if key in self._entries:
+                return key, self._entries[key]
+
+        return None
+
+
+def local_catalog_path(path):
+    """Return the file system path of the catalog file or URL path or None if
+    it is not local."""
+    if "://" in path and not path.startswith("file://"):
+        return None
+
+    return urllib.request.url2pathname(path[7:]) if "://" in path else path
+
+
+def read_catalog_file(path):
+    """Return the content of the local catalog file or file URL path as bytes
+    or None if it can't be read."""
+    try:
+        with open(local_catalog_path(path), "rb") as file:
+            return file.read()
+    except IOError:
+        return None
+
+
+def catalog_stamp(path):
+    """Return a tuple of mtime and size of the catalog file or URL path or None
+    if it is not local or does not exist."""
+    local = local_catalog_path(path)
+    if local is None:
+        return None
+
+    try:
+        stat = os.stat(local)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class Catalog:
+    """Compiled form of an OASIS XML catalog file."""
+
+    def __init__(self, path):
+        """Load the catalog at path. A file which does not exist yields an empty
+        catalog.
+
+        :raises UnsupportedCatalog: The file can't be handled natively
+        """
+        self.path = path
+        self.system = {}
+        self.uri = {}
+        self.rewrite_system = PrefixIndex()
+        self.rewrite_uri = PrefixIndex()
+        self.system_suffix = PrefixIndex(suffix=True)
+        self.uri_suffix = PrefixIndex(suffix=True)
+        self.delegate_system = PrefixIndex()
+        self.delegate_uri = PrefixIndex()
+        self.next_catalogs = []
+        self.has_public = False
+
+        if "://" in path and not path.startswith("file://"):
+            raise UnsupportedCatalog("remote catalog {0!r}".format(path))
+
+        content = read_catalog_file(path)
+        if content is None:
+            return
+
+        try:
+            root = lxml.etree.fromstring(content)
+        except lxml.etree.XMLSyntaxError as exc:
+            raise UnsupportedCatalog(str(exc))
+
+        if root.tag != "{{{0}}}catalog".format(CATALOG_NS):
+            raise UnsupportedCatalog("not an OASIS XML catalog: {0!r}".format(path))
+
+        self._compile(root, path)
+
+    def _compile(self, parent, base):
+        """Add the entries of parent (catalog or group) to the lookup tables."""
+        base = urllib.parse.urljoin(base, parent.get(QN_BASE, ""))
+
+        for elem in parent:
+            if not isinstance(elem.tag, str):
+                continue
+
+            namespace, _, name = elem.tag[1:].partition("}")
+            if namespace != CATALOG_NS:
+                continue
+
+            elem_base = urllib.parse.urljoin(base, elem.get(QN_BASE, ""))
+
+            def resolve(attribute, elem=elem, elem_base=elem_base):
+                """Return the value of attribute relative to the catalog."""
+                return urllib.parse.urljoin(elem_base, elem.get(attribute, ""))
+
+            if name == "group":
+                self._compile(elem, base)
+            elif name == "system" and elem.get("systemId"):
+                self.system.setdefault(elem.get("systemId"), resolve("uri"))
+            elif name == "uri" and elem.get("name"):
+                self.uri.setdefault(elem.get("name"), resolve("uri"))
+            elif name == "rewriteSystem":
+                self.rewrite_system.add(
+                    elem.get("systemIdStartString"), resolve("rewritePrefix")
+                )
+            elif name == "rewriteURI":
+                self.rewrite_uri.add(
+                    elem.get("uriStartString"), resolve("rewritePrefix")
+                )
+            elif name == "systemSuffix":
+                self.system_suffix.add(elem.get("systemIdSuffix"), resolve("uri"))
+            elif name == "uriSuffix":
+                self.uri_suffix.add(elem.get("uriSuffix"), resolve("uri"))
+            elif name == "delegateSystem":
+                self.delegate_system.add(
+                    elem.get("systemIdStartString"), resolve("catalog")
+                )
+            elif name == "delegateURI":
+                self.delegate_uri.add(elem.get("uriStartString"), resolve("catalog"))
+            elif name == "nextCatalog":
+                self.next_catalogs.append(resolve("catalog"))
+            elif name in ("public", "delegatePublic"):
+                self.has_public = True
+
+    def resolve(self, url, kind):
+        """Look url up in this catalog file only, without nextCatalog.
+
+        :param kind: Either 'system' or 'uri'
+        :return: Either None on failure or a URL
+        :raises UnsupportedCatalog: url would be delegated
+        """
+        exact = self.system if kind == "system" else self.uri
+        if url in exact:
+            return exact[url]
+
+        rewrite = self.rewrite_system if kind == "system" else self.rewrite_uri
+        match = rewrite.lookup(url)
+        if match is not None:
+            return match[1] + url[len(match[0]) :]
+
+        suffix = self.system_suffix if kind == "system" else self.uri_suffix
+        match = suffix.lookup(url)
+        if match is not None:
+            return match[1]
+
+        delegate = self.delegate_system if kind == "system" else self.delegate_uri
+        if delegate.lookup(url) is not None:
+            raise UnsupportedCatalog("delegation of {0!r}".format(url))
+
+        return None
+
+
+def load_catalog(path):
+    """Return the Catalog for path, parsing it only once."""
+    try:
+        return CATALOG_CACHE[path]
+    except KeyError:
+        # Before parsing, so a change while it's read is noticed later
+        CATALOG_STAMPS[path] = catalog_stamp(path)
+        CATALOG_CACHE[path] = Catalog(path)
+        return CATALOG_CACHE[path]
+
+
+def check_catalogs():
+    """Drop all parsed catalogs and lookup results if one of the catalog files
+    changed since it was read. For processes which do many lookups over time.
+
+    :return: Whether the caches were dropped
+    """
+
+    if all(catalog_stamp(path) == stamp for path, stamp in CATALOG_STAMPS.items()):
+        return False
+
+    flush_disk_cache()
+    CATALOG_CACHE.clear()
+    CATALOG_STAMPS.clear()
+    XMLCAT_CACHE.clear()
+    DISK_CACHES.clear()
+    return True
+
+
+def iter_catalog_chain(catalog):
+    """Yield the Catalog for catalog and all catalogs referenced by nextCatalog,
+    in the order they are consulted."""
+    pending = [catalog]
+    seen = set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+
+        seen.add(path)
+        current = load_catalog(path)
+        yield current
+        pending[0:0] = current.next_catalogs
+
+
+def native_lookup(url, catalog):
+    """Resolve url like xmlcatalog does: As system identifier first, then as URI.
+
+    :return: Either None on failure or a URL
+    :raises UnsupportedCatalog: The lookup needs the xmlcatalog tool
+    """
+
+    catalog = catalog if catalog else "/etc/xml/catalog"
+
+    if url.startswith("urn:publicid:"):
+        raise UnsupportedCatalog("public identifier {0!r}".format(url))
+
+    chain = list(iter_catalog_chain(catalog))
+
+    if not URI_REGEX.match(url):
+        # Not a URI, so xmlcatalog would look for a public identifier
+        if any(current.has_public for current in chain):
+            raise UnsupportedCatalog("public identifier {0!r}".format(url))
+
+        return None
+
+    for kind in ("system", "uri"):
+        for current in chain:
+            target = current.resolve(url, kind)
+            if target is not None:
+                return target
+
+    return None
+
 
 def xmlcatalog_lookup(url, catalog):
     """Run the xmlcatalog tool to lookup url in catalog. The code for xml
@@ -33,27 +336,182 @@ def xmlcatalog_lookup(url, catalog):
 
     catalog = catalog if catalog else "/etc/xml/catalog"
 
+    stats.count("catalog_subprocesses")
     try:
-        return subprocess.check_output(
+        output = subprocess.check_output(
             ["xmlcatalog", catalog, url], universal_newlines=True
         )
     except subprocess.CalledProcessError:
         return None
 
+    # Failed lookups (e.g. as system identifier) are reported before the result
+    return output.splitlines()[-1]
+
+
+def catalog_chain_hash(catalog):
+    """Return a hash over the content of catalog and all catalogs it refers to
+    with nextCatalog or delegation.
+
+    :return str: Hex digest, None if one of the catalogs is not local, as its
+                 changes can't be detected
+    """
+
+    digest = hashlib.sha256()
+    pending = [catalog]
+    seen = set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+
+        seen.add(path)
+        if local_catalog_path(path) is None:
+            return None
+
+        content = read_catalog_file(path)
+        digest.update(path.encode("utf-8") + b"\0")
+        digest.update(b"-" if content is None else content + b"\0")
+
+        try:
+            current = load_catalog(path)
+        except UnsupportedCatalog:
+            continue
+
+        delegates = [
+            target
+            for index in (current.delegate_system, current.delegate_uri)
+            for target in index.values()
+        ]
+        pending[0:0] = current.next_catalogs + delegates
 
+    return digest.hexdigest()
+
+
+class PersistentCache:
+    """Lookup results for one catalog chain, stored as JSON file.
+
+    The file name contains the hash of the catalog chain, so changes of any
+    catalog file lead to a different, empty cache.
+    """
+
+    def __init__(self, directory, digest):
+        """
+        :param directory: Directory of the file
+        :param digest: catalog_chain_hash of the catalog
+        """
+        self.path = os.path.join(directory, "xmlcat-{0}.json".format(digest))
+        self.entries = self._read()
+        self.new_entries = {}
+
+    def _read(self):
+        """Return the entries stored on disk, ignoring unreadable files."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, url):
+        """Return the cached lookup result for url or None."""
+        return self.entries.get(url)
+
+    def set(self, url, target):
+        """Store the lookup result for url, written on the next flush."""
+        self.entries[url] = target
+        self.new_entries[url] = target
+
+    def flush(self):
+        """Write new entries to disk.
+
+        Entries written by other processes in the meantime are merged. The file
+        is replaced atomically, so concurrent readers never see partial content,
+        and concurrent writers wait for each other on a lock file, so none of
+        their entries get lost.
+        """
+        if not self.new_entries:
+            return
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            entries.update(self.new_entries)
+
+            handle, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(handle, "w", encoding="utf-8") as file:
+                    json.dump(entries, file)
+                os.replace(temp, self.path)
+            except BaseException:  # pragma: no cover
+                os.unlink(temp)
+                raise
+
+        self.entries = entries
+        self.new_entries = {}
+
+
+def get_disk_cache(catalog):
+    """Return the PersistentCache for catalog or None if DISK_CACHE_DIR is not
+    set or the catalog chain includes remote catalogs."""
+    if DISK_CACHE_DIR is None:
+        return None
+
+    key = (DISK_CACHE_DIR, catalog)
+    try:
+        return DISK_CACHES[key]
+    except KeyError:
+        digest = catalog_chain_hash(catalog)
+        cache = None if digest is None else PersistentCache(DISK_CACHE_DIR, digest)
+        DISK_CACHES[key] = cache
+        return cache
+
+
+def flush_disk_cache():
+    """Write the new lookup results of all catalogs to DISK_CACHE_DIR."""
+    for cache in DISK_CACHES.values():
+        if cache is not None:
+            cache.flush()
+
+
+@stats.timed("catalog")
 def lookup_url(url, catalog):
-    """Looks up url in the xml catalog.
+    """Looks up url in the xml catalog. Uses native_lookup and falls back to
+    xmlcatalog_lookup for unsupported catalogs.
 
-    Warning: This caches lookups, so if you lookup the same URL for different catalogs,
-    the result will be the same.
+    Results are cached for each catalog. If DISK_CACHE_DIR is set, they are
+    also stored there by flush_disk_cache and reused by other processes until
+    one of the catalog files changes.
     """
 
+    catalog = catalog if catalog else "/etc/xml/catalog"
+
+    stats.count("catalog_lookups")
     try:
-        return XMLCAT_CACHE[url]
+        target = XMLCAT_CACHE[(catalog, url)]
     except KeyError:
-        target = xmlcatalog_lookup(url, catalog)
+        pass
+    else:
+        stats.count("catalog_cache_hits")
+        return target
+
+    persistent = get_disk_cache(catalog)
+    target = persistent.get(url) if persistent is not None else None
+
+    if target is None:
+        try:
+            target = native_lookup(url, catalog)
+        except UnsupportedCatalog:
+            target = xmlcatalog_lookup(url, catalog)
+
         if target is None:
             target = url
 
-        XMLCAT_CACHE[url] = target
-        return XMLCAT_CACHE[url]
+        if persistent is not None:
+            persistent.set(url, target)
+
+    XMLCAT_CACHE[(catalog, url)] = target
+    return target
@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2016 SUSE Linux GmbH
+#
+# This file is part of dbxincluder.
+#
+# dbxincluder is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbxincluder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
+
+"""dbxincluder-client: Run dbxincluder in a server started with --serve.
+
+Takes the same arguments as dbxincluder. The server runs them in the current
+directory and sends back the output, so its caches stay warm between runs. If
+no server is listening, the document is processed by this process instead.
+So is it if the socket is not owned by the current user, the server could
+read and write any file the user can.
+
+This is a separate module using only the standard library, importing the
+dbxincluder package would cost more time than the server saves for small
+documents.
+
+Messages on the socket are a JSON object in one line, followed by as many
+bytes of data as its "length" member says. The client sends its arguments
+and working directory. The server may ask for standard input with "stdin"
+and answers with "status" and "stderr", the data is the standard output.
+"""
+
+import json
+import os
+import os.path
+import socket
+import stat
+import sys
+import tempfile
+
+# Environment variable with the path of the socket
+SOCKET_ENV = "DBXINCLUDER_SOCKET"
+
+
+def socket_path():
+    """Return the path of the server socket: $DBXINCLUDER_SOCKET or a file in
+    $XDG_RUNTIME_DIR or the temporary directory."""
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, "dbxincluder-{0}.sock".format(os.getuid()))
+
+
+def send_message(stream, header, data=b""):
+    """Write the dict header and the bytes data to the binary stream."""
+    header = dict(header, length=len(data))
+    stream.write(json.dumps(header).encode("utf-8") + b"\n")
+    stream.write(data)
+    stream.flush()
+
+
+def read_message(stream):
+    """Return a tuple of the header dict and the data read from the binary stream.
+
+    :raises EOFError: The connection was closed before the end of the message
+    :raises ValueError: Invalid header
+    """
+
+    line = stream.readline()
+    if not line.endswith(b"\n"):
+        raise EOFError("connection closed")
+
+    header = json.loads(line.decode("utf-8"))
+    if not isinstance(header, dict) or not isinstance(header.get("length"), int):
+        raise ValueError("invalid header {0!r}".format(line))
+
+    data = stream.read(header["length"])
+    if len(data) != header["length"]:
+        raise EOFError("connection closed")
+
+    return header, data
+
+
+def connect(path):
+    """Return a socket connected to the server at path or None if there is none
+    or path is not a socket owned by the current user."""
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(status.st_mode) or status.st_uid != os.getuid():
+        sys.stderr.write(
+            "Not using {0!r}: not a socket of the current user\n".format(path)
+        )
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def run_remote(sock, argv):
+    """Let the server connected to sock process argv and write its output.
+
+    :return: Exit status
+    :raises EOFError: The server closed the connection
+    :raises ValueError: Invalid message from the server
+    """
+
+    stdin = sys.stdin.buffer
+    with sock.makefile("rwb") as stream:
+        send_message(stream, {"argv": argv, "cwd": os.getcwd()})
+        while True:
+            header, data = read_message(stream)
+            if header.get("stdin"):
+                send_message(stream, {}, stdin.read())
+                continue
+
+            sys.stderr.write(header["stderr"])
+            sys.stdout.flush()
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+            return header["status"]
+
+
+def main(argv=None):
+    """Entry point of dbxincluder-client.
+
+    Passes argv (sys.argv if None) to the server or to dbxincluder.main.
+    """
+    argv = argv if argv else sys.argv
+    path = socket_path()
+
+    sock = connect(path)
+    if sock is None:
+        # Only imported when needed, see above
+        import dbxincluder
+
+        return dbxincluder.main(argv)
+
+    try:
+        with sock:
+            return run_remote(sock, argv)
+    except (EOFError, ValueError, OSError) as exc:
+        sys.stderr.write("Lost connection to {0!r}: {1}\n".format(path, str(exc)))
+        return 1
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -16,16 +16,35 @@
 # You should have received a copy of the GNU General Public License
 # along with dbxincluder. If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import http.client
+import http.server
+import io
+import json
 import os.path
+import pickle
 import shutil
+import signal
+import socket
+import socketserver
 import sys
+import threading
+import time
+import urllib.error
 from operator import eq, is_
 
 import lxml.etree
 import pytest
 
 import dbxincluder
+import dbxincluder.httpcache
+import dbxincluder.parallel
+import dbxincluder.prefetch
+import dbxincluder.server
+import dbxincluder.stats
+import dbxincluder.watch
 import dbxincluder.xinclude
+import dbxincluder_client
 from dbxincluder.utils import DBXIException
 
 
@@ -79,6 +98,204 @@ def test_stdin(capsys):
     assert outputxml == capsys.readouterr()[0]
 
 
+def test_output_file(tmpdir, capsys):
+    """-o writes the same bytes as stdout, --no-pretty-print omits indentation"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    case = location + "/cases/transclusion.case.xml"
+    output = tmpdir.join("out.xml")
+    assert dbxincluder.main(["", "-o", str(output), case]) == 0
+    expected = open(location + "/cases/transclusion.out.xml", "rb").read()
+    assert output.read_binary() == expected
+
+    assert dbxincluder.main(["", "--no-pretty-print", "-o", str(output), case]) == 0
+    tree = lxml.etree.parse(case)
+    dbxincluder.docbook.process_tree(tree.getroot(), case, file=case)
+    compact = lxml.etree.tostring(tree, encoding="utf-8", xml_declaration=False)
+    assert output.read_binary() == compact != expected
+    assert capsys.readouterr() == ("", "")
+
+
+def test_output_text_stream():
+    """Text streams without binary buffer get the document as str"""
+    tree = lxml.etree.ElementTree(lxml.etree.fromstring("<a>\u00e4<b/></a>"))
+    stream = io.StringIO()
+    dbxincluder.write_output(tree, stream)
+    assert stream.getvalue() == "<a>\u00e4<b/></a>\n"
+
+
+def test_write_if_changed(tmpdir, capsys):
+    """--write-if-changed keeps the output file if the content is the same"""
+    tmpdir.join("in.xml").write("<a/>")
+    output = tmpdir.join("out.xml")
+    argv = ["", "--write-if-changed", "-o", str(output), str(tmpdir.join("in.xml"))]
+    assert dbxincluder.main(argv) == 0
+    expected = output.read()
+    assert expected.startswith("<a ")
+
+    os.utime(str(output), ns=(0, 0))
+    assert dbxincluder.main(argv) == 0
+    assert os.stat(str(output)).st_mtime_ns == 0
+
+    output.write("<b/>\n")
+    os.utime(str(output), ns=(0, 0))
+    assert dbxincluder.main(argv) == 0
+    assert output.read() == expected
+
+    argv[3] = str(tmpdir.join("missing", "out.xml"))
+    assert dbxincluder.main(argv) == 1
+    assert capsys.readouterr()[1].splitlines()[-1].startswith("Could not write")
+
+
+def test_depfile(tmpdir, capsys):
+    """--depfile writes the local files each output was made of"""
+    depfile = dbxincluder.depfile
+    assert depfile.escape("a b\\ c\\\\#$d") == "a\\ b\\\\\\ c\\\\\\\\\\#$$d"
+
+    tmpdir.join("in.xml").write(
+        "<a xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='my part.xml'/>"
+        "<xi:include href='text.txt' parse='text/plain'/>"
+        "<xi:include href='missing.xml'><xi:fallback>x<b/></xi:fallback></xi:include>"
+        "<xi:include href='http://localhost:1/'><xi:fallback>x<b/></xi:fallback></xi:include>"
+        "</a>"
+    )
+    tmpdir.join("my part.xml").write("<part/>")
+    tmpdir.join("text.txt").write("text")
+    tmpdir.join("other.xml").write("<other/>")
+    deps = tmpdir.join("deps.d")
+    argv = ["", "--depfile", str(deps), "--batch", str(tmpdir.join("out"))]
+    inputs = [str(tmpdir.join("in.xml")), str(tmpdir.join("other.xml"))]
+    assert dbxincluder.main(argv + inputs) == 0
+    capsys.readouterr()
+
+    path = "{0}/{1}".format(str(tmpdir).replace(" ", "\\ "), "{0}")
+    assert deps.read().splitlines() == [
+        path.format("out/in.xml: \\"),
+        "  " + path.format("in.xml \\"),
+        "  " + path.format("my\\ part.xml \\"),
+        "  " + path.format("text.txt"),
+        path.format("out/other.xml: \\"),
+        "  " + path.format("other.xml"),
+        "",
+        path.format("in.xml:"),
+        "",
+        path.format("my\\ part.xml:"),
+        "",
+        path.format("text.txt:"),
+        "",
+        path.format("other.xml:"),
+    ]
+
+    # With jobs, the dependencies come from the workers
+    lines = deps.read().splitlines()
+    output = str(tmpdir.join("single.xml"))
+    assert dbxincluder.main(argv[:3] + ["-j", "2", "-o", output, inputs[0]]) == 0
+    assert deps.read().splitlines()[:4] == [path.format("single.xml: \\")] + lines[1:4]
+    capsys.readouterr()
+
+    assert dbxincluder.main(argv[:3] + inputs[:1]) == 1
+    assert capsys.readouterr()[1] == "--depfile needs an output file\n"
+
+    argv[2] = str(tmpdir.join("missing", "deps.d"))
+    assert dbxincluder.main(argv + inputs) == 1
+    assert "Could not write" in capsys.readouterr()[1]
+
+
+def test_batch(tmpdir, capsys):
+    """--batch processes all inputs, reports each and shares the caches"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    cases = [location + "/cases/" + name for name in ("basicxml", "syntaxerr")]
+    outdir = tmpdir.join("out")
+    dbxincluder.xinclude.TARGET_CACHE.clear()
+    argv = ["", "--batch", str(outdir), cases[0] + ".case.xml", cases[1] + ".case.xml"]
+    assert dbxincluder.main(argv + [location + "/cases/transclusion.case.xml"]) == 1
+
+    assert capsys.readouterr()[1].splitlines() == [
+        "OK: {0}.case.xml -> {1}/basicxml.case.xml".format(cases[0], outdir),
+        open(cases[1] + ".err.xml").read().rstrip("\n"),
+        "FAILED: {0}.case.xml -> {1}/syntaxerr.case.xml".format(cases[1], outdir),
+        "OK: {0}/cases/transclusion.case.xml -> {1}/transclusion.case.xml".format(
+            location, outdir
+        ),
+        "3 documents processed, 1 failed",
+    ]
+    expected = open(cases[0] + ".out.xml", "rb").read()
+    assert outdir.join("basicxml.case.xml").read_binary() == expected
+
+    # The second run finds its targets in the cache
+    misses = dbxincluder.xinclude.TARGET_CACHE.stats()["misses"]
+    assert dbxincluder.main(argv[:4]) == 0
+    assert dbxincluder.xinclude.TARGET_CACHE.stats()["misses"] == misses
+    assert capsys.readouterr()[1].endswith("1 documents processed, 0 failed\n")
+
+
+def test_manifest(tmpdir, capsys):
+    """--manifest reads inputs and outputs relative to the manifest"""
+    location = os.path.dirname(os.path.realpath(__file__))
+    manifest = tmpdir.join("manifest")
+    manifest.write(
+        "# Books\n\n"
+        "{0}/cases/basicxml.case.xml 'out dir/basic.xml'\n"
+        "{0}/cases/transclusion.case.xml\n".format(location)
+    )
+    argv = ["", "--batch", str(tmpdir.join("default")), "--manifest", str(manifest)]
+    assert dbxincluder.main(argv) == 0
+    capsys.readouterr()
+    expected = open(location + "/cases/basicxml.out.xml", "rb").read()
+    assert tmpdir.join("out dir", "basic.xml").read_binary() == expected
+    case = location + "/cases/transclusion.case.xml"
+    assert dbxincluder.main(["", "-o", str(tmpdir.join("single.xml")), case]) == 0
+    expected = tmpdir.join("single.xml").read_binary()
+    assert tmpdir.join("default", "transclusion.case.xml").read_binary() == expected
+
+    # Without --batch, every line needs an output
+    assert dbxincluder.main([""] + argv[3:]) == 1
+    assert capsys.readouterr()[1] == "Invalid batch: line 4: Missing output file\n"
+
+    for content, error in [
+        ("a.xml b.xml c.xml\n", "line 1: Too many fields"),
+        ("'a.xml\n", "line 1: No closing quotation"),
+        ("a.xml out.xml\nb.xml out.xml\n", "'{0}/a.xml' and '{0}/b.xml' are both"),
+    ]:
+        manifest.write(content.replace("{0}", str(tmpdir)))
+        assert dbxincluder.main([""] + argv[3:]) == 1
+        err = capsys.readouterr()[1]
+        assert err.startswith("Invalid batch: " + error.format(tmpdir))
+
+    assert dbxincluder.main(argv[:3] + ["-"]) == 1
+    assert capsys.readouterr()[1] == "Invalid batch: Can't read stdin in batch mode\n"
+
+    assert dbxincluder.main(["", "--manifest", str(tmpdir.join("missing"))]) == 1
+    assert capsys.readouterr()[1].startswith("Could not read")
+
+
+def test_batch_overwrite(tmpdir, capsys, monkeypatch):
+    """Outputs which are inputs are refused, outputs are opened after parsing"""
+    book = tmpdir.join("book.xml")
+    book.write("<book/>")
+    monkeypatch.chdir(tmpdir)
+    assert dbxincluder.main(["", "--batch", ".", "book.xml"]) == 1
+    assert capsys.readouterr()[1] == (
+        "Invalid batch: 'book.xml' would overwrite the input 'book.xml'\n"
+    )
+    tmpdir.join("manifest").write("a.xml out.xml\nbook.xml ./a.xml\n")
+    assert dbxincluder.main(["", "--manifest", "manifest"]) == 1
+    assert capsys.readouterr()[1] == (
+        "Invalid batch: 'book.xml' would overwrite the input 'a.xml'\n"
+    )
+    assert book.read() == "<book/>"
+
+    # A single document can be replaced by its output
+    assert dbxincluder.main(["", "-o", "book.xml", "book.xml"]) == 0
+    assert book.read() == '<book xml:base="book.xml"/>\n'
+
+    # Outputs of documents which can't be parsed are left alone
+    tmpdir.join("bad.xml").write("<bad>")
+    assert dbxincluder.main(["", "-o", "book.xml", "bad.xml"]) == 1
+    assert capsys.readouterr()[1].startswith("Could not parse 'bad.xml'")
+    assert book.read() == '<book xml:base="book.xml"/>\n'
+
+
 @pytest.mark.parametrize(
     "func,configstr,expected",
     [
@@ -165,3 +382,1487 @@ def test_xml(xmltestcase, capsys):
     out, err = capsys.readouterr()
     assert outputerr == err
     assert outputxml == out
+    assert dbxincluder.utils.PARENT_LINES == {}
+
+
+def test_lrucache():
+    """Test eviction, stamps and counters of utils.LRUCache"""
+    cache = dbxincluder.utils.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2, stamp=1)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # Evicts "b"
+    assert cache.get("b", stamp=1) is None
+    assert cache.get("c") == 3
+    cache.put("c", 4, stamp=1)
+    assert cache.get("c", stamp=2) is None  # Outdated
+    assert len(cache) == 1
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 2,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 1,
+    }
+    cache.put("c", 4, stamp=1)
+    cache.put("d", 5)
+    cache.discard_unstamped()
+    assert cache.get("c", stamp=1) == 4 and cache.get("d") is None
+    cache.clear()
+    assert cache.stats()["hits"] == 0 and len(cache) == 0
+
+    disabled = dbxincluder.utils.LRUCache(0)
+    disabled.put("a", 1)
+    assert disabled.get("a") is None
+
+
+def test_target_cache(tmpdir):
+    """Included documents are read and parsed only once"""
+    xinclude = dbxincluder.xinclude
+    xinclude.TARGET_CACHE.clear()
+    xinclude.DOCUMENT_CACHE.clear()
+
+    part = tmpdir.join("part.xml")
+    part.write("<part><a xml:id='a'>1</a><b xml:id='b'>2</b></part>")
+    source = lxml.etree.fromstring(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='part.xml' fragid='a'/>"
+        "<xi:include href='part.xml' fragid='b'/>"
+        "<xi:include href='part.xml' fragid='a'/></doc>"
+    )
+    xinclude.process_tree(source, str(tmpdir.join("doc.xml")))
+    assert [elem.text for elem in source] == ["1", "2", "1"]
+    assert xinclude.TARGET_CACHE.stats()["misses"] == 1
+    assert xinclude.TARGET_CACHE.stats()["hits"] == 2
+    assert xinclude.DOCUMENT_CACHE.stats()["hits"] == 2
+
+    # Changes to the file are noticed
+    part.write("<part><a xml:id='a'>changed</a></part>")
+    os.utime(str(part), ns=(0, 0))
+    source = lxml.etree.fromstring(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='part.xml' fragid='a'/></doc>"
+    )
+    xinclude.process_tree(source, str(tmpdir.join("doc.xml")))
+    assert source[0].text == "changed"
+
+
+def test_parsed_target_ids():
+    """The xml:id index of a target is built once and reused"""
+    content = b"<doc><a xml:id='a'/><b><c xml:id='c'/></b></doc>"
+    target = dbxincluder.xinclude.parse_target(content, "urn:x-dbxi:ids.xml")
+    assert target is dbxincluder.xinclude.parse_target(content, "urn:x-dbxi:ids.xml")
+    assert [elem.tag for elem in target.find_id("c")] == ["c"]
+    index = target._ids
+    assert target.find_id("nonexistant") == []
+    assert target._ids is index
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "\n",
+        "one",
+        "one\ntwo\n\nfour\n\n",
+        "dos\r\nline\r\n\r\nend",
+        "mac\rline\r\r",
+        "mixed\r\n\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029end",
+        "\ufeffBOM \u00e4\u00f6\u00fc\n\u20ac \U0001d11e x",
+    ],
+)
+def test_text_target(content):
+    """TextTarget gives the same results as text_fragid on normalized content"""
+    target = dbxincluder.xinclude.TextTarget(content.encode("utf-8"))
+    normalized = "\n".join(content.splitlines())
+    fragids = [None, "invalid", "line=,1", "char=,3", "line=100", "char=100"]
+    for start in range(6):
+        for end in [None] + list(range(7)):
+            suffix = "" if end is None else str(end)
+            fragids += ["line={0},{1}".format(start, suffix)]
+            fragids += ["char={0},{1}".format(start, suffix)]
+
+    for fragid in fragids:
+        expected = dbxincluder.xinclude.text_fragid(normalized, fragid)
+        assert target.fragment(fragid) == expected
+
+
+def test_text_cache(tmpdir):
+    """Local text targets are mapped and indexed once and revalidated"""
+    xinclude = dbxincluder.xinclude
+    xinclude.TEXT_CACHE.clear()
+    text = tmpdir.join("text.txt")
+    text.write_binary(b"one\r\ntwo\r\nthree\r\n")
+    empty = tmpdir.join("empty.txt")
+    empty.write_binary(b"")
+
+    target = xinclude.fetch_text(str(text))
+    assert target.fragment("line=1,2") == ("two", True)
+    assert xinclude.fetch_text(str(text)) is target
+    assert xinclude.fetch_text(str(empty)).fragment() == ("", True)
+
+    text.write_binary(b"changed")
+    os.utime(str(text), ns=(0, 0))
+    assert xinclude.fetch_text(str(text)).fragment() == ("changed", True)
+
+    # Remote targets are read through TARGET_CACHE
+    url = "http://localhost/text.txt"
+    xinclude.TARGET_CACHE.put(url, b"cached\r\n", None)
+    assert xinclude.fetch_text(url).fragment("line=0") == ("cached", True)
+    xinclude.TEXT_CACHE.clear()
+    xinclude.TARGET_CACHE.clear()
+
+
+def test_handle_xinclude(tmpdir):
+    """handle_xinclude returns the frame to process the included tree with"""
+    tmpdir.join("a.xml").write("<a><b/></a>")
+    xinclude = dbxincluder.xinclude
+    tree = lxml.etree.fromstring(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='a.xml'/><xi:include href='a.xml'/></doc>"
+    )
+    base_url = str(tmpdir.join("doc.xml"))
+    frame = xinclude.handle_xinclude(tree[0], base_url)
+    url = str(tmpdir.join("a.xml"))
+    assert frame.tree is tree[0] and frame.base_url == frame.file == url
+    assert frame.xinclude_id == "{0!r}>None".format(url)
+    assert dbxincluder.utils.PARENT_LINES.pop(tree[0]) == 1
+
+    active = set()
+    xinclude.process_subtree(frame, None, active)
+    assert active == set()
+    with pytest.raises(DBXIException):
+        active = {frame.xinclude_id}
+        xinclude.handle_xinclude(tree[1], base_url, active_includes=active)
+
+
+def test_deep_include_chain(tmpdir):
+    """Include chains are not limited by the recursion limit"""
+    depth = sys.getrecursionlimit() + 100
+    template = (
+        "<section xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='{0}.xml'/></section>"
+    )
+    for i in range(depth):
+        tmpdir.join("{0}.xml".format(i)).write(template.format(i + 1))
+    tmpdir.join("{0}.xml".format(depth)).write("<para/>")
+
+    tree = lxml.etree.parse(str(tmpdir.join("0.xml"))).getroot()
+    dbxincluder.xinclude.process_tree(tree, str(tmpdir.join("0.xml")))
+    assert len(tree.xpath("//section")) == depth
+    assert len(tree.xpath("//para")) == 1
+    assert dbxincluder.utils.PARENT_LINES == {}
+
+
+def test_expansion_cache(tmpdir, capsys, monkeypatch):
+    """Reused expansions give the same result as processing everything again"""
+    xinclude = dbxincluder.xinclude
+    xinclude.EXPANSION_CACHE.clear()
+    xinclude.INCLUDED.clear()
+    header = "xmlns:xi='http://www.w3.org/2001/XInclude'"
+    book = tmpdir.join("book.xml")
+    book.write(
+        "<book {0}>\n<xi:include href='chapter.xml'/>\n"
+        "<sub xmlns='urn:sub'><xi:include href='chapter.xml'/></sub>\n"
+        "<xi:include href='chapter.xml'/><xi:include href='part.xml'/></book>".format(
+            header
+        )
+    )
+    tmpdir.join("part.xml").write(
+        "<part {0}><xi:include href='chapter.xml'/></part>".format(header)
+    )
+    tmpdir.join("chapter.xml").write(
+        "<chapter {0}>\n<xi:include href='leaf.xml'/>\n"
+        "<xi:include href='text.txt' parse='text/plain' fragid='invalid'/>\n"
+        "<xi:include href='new.xml'><xi:fallback>missing<new/></xi:fallback>"
+        "</xi:include>\n</chapter>".format(header)
+    )
+    leaf = tmpdir.join("leaf.xml")
+    leaf.write("<leaf>1</leaf>")
+    tmpdir.join("text.txt").write("text")
+
+    def run(cached):
+        if not cached:
+            xinclude.EXPANSION_CACHE.clear()
+            xinclude.INCLUDED.clear()
+        tree = lxml.etree.parse(str(book)).getroot()
+        xinclude.process_tree(tree, str(book))
+        return lxml.etree.tostring(tree), capsys.readouterr().err
+
+    # In single runs, only targets included before are recorded
+    result = run(True)
+    assert xinclude.EXPANSION_CACHE.stats()["hits"] == 1
+    assert result == run(False)
+
+    monkeypatch.setattr(xinclude, "RECORD_EXPANSIONS", True)
+    result = run(False)
+    assert xinclude.EXPANSION_CACHE.stats()["hits"] == 2
+    assert result[1].count("Invalid fragid") == 4
+    assert result == run(False)
+    assert run(True) == result
+
+    leaf.write("<leaf>changed</leaf>")
+    os.utime(str(leaf), ns=(0, 0))
+    result = run(True)
+    assert b"changed" in result[0] and result == run(False)
+
+    tmpdir.join("new.xml").write("<new/>")
+    result = run(True)
+    assert b"<new" in result[0] and result == run(False)
+    assert dbxincluder.utils.PARENT_LINES == {}
+
+    # A valid expansion is not used if it would hide infinite recursion
+    run(True)
+    tree = lxml.etree.fromstring(
+        "<doc {0}><xi:include href='chapter.xml'/></doc>".format(header)
+    )
+    leaf_id = "{0!r}>None".format(str(leaf))
+    frame = xinclude.handle_xinclude(tree[0], str(book), active_includes={leaf_id})
+    with pytest.raises(DBXIException):
+        xinclude.process_subtree(frame, None, {leaf_id})
+    assert xinclude.EXPANDING == []
+
+    # Targets which can't be validated make expansions uncacheable
+    expansion = xinclude.Expansion(tree, None, None)
+    xinclude.EXPANDING.append(expansion)
+    xinclude.record_dependency("http://localhost/leaf.xml", None)
+    assert not expansion.cacheable
+    xinclude.EXPANDING.clear()
+    xinclude.EXPANSION_CACHE.clear()
+    xinclude.INCLUDED.clear()
+    dbxincluder.utils.PARENT_LINES.clear()
+    capsys.readouterr()
+
+
+def write_parallel_book(tmpdir):
+    """Write a book with XML and text includes, fallbacks and warnings."""
+    chapter = (
+        "<chapter xmlns='http://docbook.org/ns/docbook'"
+        " xmlns:xi='http://www.w3.org/2001/XInclude' xml:id='c{0}'>"
+        "<para xml:id='p'>{0}<xref linkend='p'/></para>"
+        "<xi:include href='dup.xml'/><xi:include href='dup.xml'/>"
+        "<xi:include href='missing{0}.xml'><xi:fallback>fb "
+        "<xi:include href='text.txt' parse='text/plain' fragid='bad'/> "
+        "</xi:fallback></xi:include>\n" + "\n" * 70000 + "<para>{1}</para></chapter>"
+    )
+    tmpdir.join("text.txt").write("one\ntwo\n")
+    tmpdir.join("dup.xml").write("<para xml:id='dup'/>")
+    for number in range(3):
+        tmpdir.join("c{0}.xml".format(number)).write(chapter.format(number, ""))
+    tmpdir.join("error.xml").write(chapter.format(3, "<xi:include href='none'/>"))
+    tmpdir.join("book.xml").write(
+        "<book xmlns='http://docbook.org/ns/docbook'"
+        " xmlns:xi='http://www.w3.org/2001/XInclude'"
+        " xmlns:trans='http://docbook.org/ns/transclude'>\n"
+        "<xi:include href='c0.xml' trans:idfixup='auto'/> "
+        "<xi:include href='text.txt' parse='text/plain' fragid='nope'/> "
+        + "\n" * 70000
+        + "<part><xi:include href='c1.xml' trans:idfixup='auto'/> </part>"
+        "<xi:include href='missing.xml'><xi:fallback> "
+        "<xi:include href='c2.xml'/> </xi:fallback></xi:include>\n"
+        "<xi:include href='c2.xml' trans:idfixup='auto'/> "
+        "<xi:include href='missing.txt' parse='text/plain'>"
+        "<xi:fallback>missing</xi:fallback></xi:include> </book>"
+    )
+    return str(tmpdir.join("book.xml"))
+
+
+def test_parallel(tmpdir, capsys):
+    """Expanding the top-level includes in processes gives the same result"""
+    book = write_parallel_book(tmpdir)
+    results = []
+    for jobs in (1, 2):
+        tree = lxml.etree.parse(book).getroot()
+        dbxincluder.docbook.process_tree(tree, book, None, book, jobs)
+        results.append((lxml.etree.tostring(tree), capsys.readouterr()))
+        assert dbxincluder.utils.PARENT_LINES == dbxincluder.utils.SOURCE_LINES == {}
+
+    assert results[0] == results[1]
+    assert results[0][1][1].count("Warning") == 11
+
+    # Nothing to do in parallel
+    tree = lxml.etree.fromstring(
+        "<a xmlns:xi='http://www.w3.org/2001/XInclude'><xi:include href='c0.xml'/></a>"
+    )
+    dbxincluder.parallel.process_xinclude(tree, book, jobs=2)
+    assert tree[0].get("{http://www.w3.org/XML/1998/namespace}id") == "c0"
+    capsys.readouterr()
+
+    # The first error in document order is raised with the same message
+    book = tmpdir.join("book.xml")
+    book.write(book.read().replace("c2.xml' trans", "error.xml' trans"))
+    errors = []
+    for jobs in (1, 2):
+        tree = lxml.etree.parse(str(book)).getroot()
+        with pytest.raises(DBXIException) as excinfo:
+            dbxincluder.docbook.process_tree(tree, str(book), None, str(book), jobs)
+        errors.append((str(excinfo.value), capsys.readouterr()))
+
+    assert errors[0] == errors[1]
+    assert "Target not available" in errors[0][0]
+
+    # Errors of the DocBook processing refer to the included elements
+    for number in (0, 1):
+        chapter = tmpdir.join("c{0}.xml".format(number))
+        chapter.write(chapter.read().replace("linkend='p'", "linkend='nope'"))
+    book.write(book.read().replace("error.xml' trans", "c2.xml' trans"))
+    errors = []
+    for jobs in (1, 2):
+        tree = lxml.etree.parse(str(book)).getroot()
+        with pytest.raises(DBXIException) as excinfo:
+            dbxincluder.docbook.process_tree(tree, str(book), None, str(book), jobs)
+        errors.append((str(excinfo.value), capsys.readouterr()))
+
+    assert errors[0] == errors[1]
+    assert "c0.xml:1: Could not resolve reference 'nope'" in errors[0][0]
+
+
+def test_parallel_worker(tmpdir):
+    """Workers expand includes of their copy of the document"""
+    parallel = dbxincluder.parallel
+    book = write_parallel_book(tmpdir)
+    tree = lxml.etree.parse(book).getroot()
+    includes = parallel.top_level_includes(tree)
+    assert [elem.get("href") for elem in includes] == [
+        "c0.xml",
+        "text.txt",
+        "c1.xml",
+        "missing.xml",
+        "c2.xml",
+        "missing.txt",
+    ]
+
+    settings = (None, None, False, None, False, False)
+    parallel.init_worker(parallel.dump_tree(tree), book, None, book, settings)
+    dump, stderr, exc, dependencies, _ = parallel.expand_include(2)
+    assert exc is None and stderr.count("Warning") == 2
+    assert str(tmpdir.join("c1.xml")) in dependencies
+    chapter = parallel.load_tree(dump)
+    assert chapter.get(dbxincluder.utils.QN["xml:base"]) == str(tmpdir.join("c1.xml"))
+    assert dbxincluder.utils.PARENT_LINES[chapter] == 70002
+    assert chapter[1].tag == "para"
+    assert chapter[0].sourceline == 1 and chapter[-1].sourceline is None
+    dbxincluder.utils.PARENT_LINES.clear()
+    dbxincluder.utils.SOURCE_LINES.clear()
+
+    tmpdir.join("c0.xml").write("<chapter>")
+    dump, stderr, exc, dependencies, _ = parallel.expand_include(0)
+    assert dump is None and stderr == ""
+    assert str(exc).startswith("Error at {0}:2: Could not parse".format(book))
+
+    # Elements without source line
+    elem = parallel.load_tree(parallel.dump_tree(lxml.etree.Element("a")))
+    assert elem.sourceline is None
+
+
+def test_exception_pickle():
+    """DBXIException keeps its type and message when pickled"""
+    elem = lxml.etree.fromstring("<a xml:base='a.xml'/>")
+    exc = dbxincluder.xinclude.ResourceError(elem, "Missing", severity="Warning")
+    copied = pickle.loads(pickle.dumps(exc))
+    assert type(copied) is dbxincluder.xinclude.ResourceError
+    assert str(copied) == copied.error == "Warning at a.xml:1: Missing"
+
+
+def test_jobs_option(tmpdir, capsys):
+    """-j gives the same output"""
+    book = write_parallel_book(tmpdir)
+    outputs = []
+    for jobs in ("1", "3"):
+        output = str(tmpdir.join("out{0}.xml".format(jobs)))
+        assert dbxincluder.main(["", "-j", jobs, "-o", output, book]) == 0
+        outputs.append((open(output, "rb").read(), capsys.readouterr()))
+
+    assert outputs[0] == outputs[1]
+    assert dbxincluder.main(["", "--jobs", "0", book]) == 1
+    assert capsys.readouterr()[1].startswith("Invalid option value")
+
+
+@pytest.fixture
+def dbxi_server(tmpdir, monkeypatch):
+    """Run a server on a socket in tmpdir, which dbxincluder_client uses"""
+    path = str(tmpdir.join("s.sock"))
+    monkeypatch.setenv("DBXINCLUDER_SOCKET", path)
+    run = functools.partial(dbxincluder.main, served=True)
+    unix_server = dbxincluder.server.Server(path, run)
+    thread = threading.Thread(target=unix_server.serve_forever, daemon=True)
+    thread.start()
+    yield unix_server
+    unix_server.shutdown()
+    unix_server.server_close()
+    thread.join()
+    assert not os.path.exists(path)
+
+
+def test_server(dbxi_server, tmpdir, capsys, monkeypatch):
+    """The client gets the same output from the server, which reuses caches"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    for case in ("transclusion", "invref"):
+        argv = ["", location + "/cases/{0}.case.xml".format(case)]
+        expected = (dbxincluder.main(argv), capsys.readouterr())
+        assert dbxincluder_client.main(argv) == expected[0]
+        assert capsys.readouterr() == expected[1]
+
+    # Standard input and relative paths in the working directory of the client
+    stdin = open(location + "/cases/basicxml.case.xml", "rb").read()
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(stdin)))
+    cwd = os.getcwd()
+    monkeypatch.chdir(tmpdir)
+    assert dbxincluder_client.main(["", "-o", "out.xml", "-"]) == 0
+    assert os.getcwd() == str(tmpdir)
+    expected = open(os.path.join(cwd, location, "cases/basicxml.out.xml")).read()
+    assert tmpdir.join("out.xml").read() == expected
+
+    # Changed files are read again
+    tmpdir.join("doc.xml").write(
+        "<a xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='t.txt' parse='text/plain'/></a>"
+    )
+    for text in ("one", "two!"):
+        tmpdir.join("t.txt").write(text)
+        assert dbxincluder_client.main(["", "doc.xml"]) == 0
+        assert text in capsys.readouterr()[0]
+    assert capsys.readouterr() == ("", "")
+
+    # Options which would keep the server busy are refused
+    for option in ("--watch", "--serve"):
+        assert dbxincluder_client.main(["", option, "doc.xml"]) == 1
+        assert capsys.readouterr() == (
+            "",
+            "--serve and --watch can't be used with dbxincluder-client\n",
+        )
+
+    # Errors of the server process are reported
+    dbxi_server.run = None
+    assert dbxincluder_client.main(["", "doc.xml"]) == 1
+    assert "TypeError" in capsys.readouterr()[1]
+
+
+def test_server_connection(dbxi_server):
+    """Broken connections on either side"""
+    path = dbxi_server.server_address
+
+    # Invalid request
+    sock = dbxincluder_client.connect(path)
+    sock.sendall(b"[]\n")
+    assert sock.recv(10) == b""
+    sock.close()
+
+    # Client gone before the response
+    finished = threading.Event()
+    dbxi_server.run = lambda argv: finished.wait() and 0
+    sock = dbxincluder_client.connect(path)
+    with sock.makefile("wb") as stream:
+        dbxincluder_client.send_message(stream, {"argv": [], "cwd": "/"})
+    sock.close()
+    finished.set()
+
+
+def test_client_lost_connection(tmpdir, capsys, monkeypatch):
+    """The client reports servers closing the connection"""
+    path = str(tmpdir.join("s.sock"))
+    monkeypatch.setenv("DBXINCLUDER_SOCKET", path)
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(path)
+    listener.listen(1)
+
+    def close_after_request():
+        connection, _ = listener.accept()
+        with connection, connection.makefile("rb") as stream:
+            dbxincluder_client.read_message(stream)
+
+    thread = threading.Thread(target=close_after_request)
+    thread.start()
+    assert dbxincluder_client.main(["", "-"]) == 1
+    thread.join()
+    listener.close()
+    assert "Lost connection to {0!r}".format(path) in capsys.readouterr()[1]
+
+
+def test_client_fallback(tmpdir, capsys, monkeypatch):
+    """Without server, the client processes the document itself"""
+    monkeypatch.setenv("DBXINCLUDER_SOCKET", str(tmpdir.join("none.sock")))
+    assert dbxincluder_client.main(["", "--version"]) == 0
+    assert capsys.readouterr()[0] == "dbxincluder {0}\n".format(dbxincluder.__version__)
+
+    # Nor does it use files which aren't sockets or sockets of other users
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(str(tmpdir.join("s.sock")))
+    listener.listen(1)
+    tmpdir.join("file").write("")
+    for path, uid in (("file", os.getuid()), ("s.sock", os.getuid() + 1)):
+        monkeypatch.setenv("DBXINCLUDER_SOCKET", str(tmpdir.join(path)))
+        monkeypatch.setattr(os, "getuid", lambda uid=uid: uid)
+        assert dbxincluder_client.main(["", "--version"]) == 0
+        out, err = capsys.readouterr()
+        assert out == "dbxincluder {0}\n".format(dbxincluder.__version__)
+        assert err.startswith(
+            "Not using {0!r}: not a socket of the current user\n".format(
+                str(tmpdir.join(path))
+            )
+        )
+    listener.close()
+    monkeypatch.undo()
+
+    monkeypatch.delenv("DBXINCLUDER_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmpdir))
+    assert dbxincluder_client.socket_path() == str(
+        tmpdir.join("dbxincluder-{0}.sock".format(os.getuid()))
+    )
+
+    stream = io.BytesIO(b'{"length": 3}\nab')
+    with pytest.raises(EOFError):
+        dbxincluder_client.read_message(stream)
+    with pytest.raises(ValueError):
+        dbxincluder_client.read_message(io.BytesIO(b"[]\n"))
+
+
+def test_serve_option(tmpdir, capsys, monkeypatch):
+    """--serve replaces stale sockets and removes its own"""
+    path = str(tmpdir.join("s.sock"))
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    def interrupt(self):
+        # Running, so another server can't use the socket
+        assert dbxincluder.main(["", "--serve", path]) == 1
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(dbxincluder.server.Server, "serve_forever", interrupt)
+    assert dbxincluder.main(["", "--serve", path]) == 0
+    assert not os.path.exists(path)
+    err = capsys.readouterr()[1].splitlines()
+    assert err[0] == "Listening on {0!r}".format(path)
+    assert err[1].startswith("Could not listen on {0!r}".format(path))
+
+    # Other files are not replaced
+    tmpdir.join("file").write("")
+    monkeypatch.setenv("DBXINCLUDER_SOCKET", str(tmpdir.join("file")))
+    assert dbxincluder.main(["", "--serve"]) == 1
+    assert tmpdir.join("file").check()
+    capsys.readouterr()
+
+    # The socket might be gone already
+    monkeypatch.setattr(
+        dbxincluder.server.Server, "serve_forever", lambda self: os.unlink(path)
+    )
+    assert dbxincluder.main(["", "--serve", path]) == 0
+    capsys.readouterr()
+
+
+def test_wait_for_changes(tmpdir, monkeypatch):
+    """wait_for_changes returns the changed files, with or without inotify"""
+    watch = dbxincluder.watch
+    part = tmpdir.join("part.xml")
+    part.write("<part/>")
+    missing = tmpdir.join("sub", "missing.xml")
+
+    def change_later(function):
+        thread = threading.Timer(0.1, function)
+        thread.start()
+        return thread
+
+    stamps = {str(part): dbxincluder.xinclude.get_stamp(str(part))}
+    assert watch.wait_for_changes(stamps, timeout=0) == set()
+    thread = change_later(lambda: part.write("<changed/>"))
+    assert watch.wait_for_changes(stamps, timeout=10) == {str(part)}
+    thread.join()
+
+    # The directory of missing can't be watched, so it's polled
+    assert watch.wait_for_changes({str(missing): None}, 0.01, timeout=0.05) == set()
+    thread = change_later(lambda: missing.write("<new/>", ensure=True))
+    assert watch.wait_for_changes({str(missing): None}, 0.01) == {str(missing)}
+    thread.join()
+
+    def no_libc(*args, **kwargs):
+        raise OSError("no libc")
+
+    monkeypatch.setattr(watch.ctypes, "CDLL", no_libc)
+    assert watch.inotify_fd([str(tmpdir)]) is None
+
+
+def test_watch_option(tmpdir, capsys, monkeypatch):
+    """--watch processes the documents again which include changed files"""
+    header = "xmlns:xi='http://www.w3.org/2001/XInclude'"
+    book = tmpdir.join("book.xml")
+    book.write(
+        "<book {0}><xi:include href='part.xml'/>"
+        "<xi:include href='missing.xml'><xi:fallback>x<a/></xi:fallback>"
+        "</xi:include></book>".format(header)
+    )
+    part = tmpdir.join("part.xml")
+    part.write("<part/>")
+    other = tmpdir.join("other.xml")
+    other.write("<other/>")
+    outdir = tmpdir.join("out")
+    watched = []
+
+    def wait(stamps, interval):
+        watched.append(set(stamps))
+        if len(watched) == 1:
+            part.write("<part {0}><xi:include href='new.xml'/></part>".format(header))
+            tmpdir.join("new.xml").write("<new/>")
+        else:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(dbxincluder.watch, "wait_for_changes", wait)
+    argv = ["", "--watch", "--batch", str(outdir), str(book), str(other)]
+    assert dbxincluder.main(argv) == 0
+
+    files = {str(book), str(part), str(tmpdir.join("missing.xml")), str(other)}
+    assert watched == [files, files | {str(tmpdir.join("new.xml"))}]
+    assert "<new " in outdir.join("book.xml").read()
+    ok = "OK: {0} -> {1}"
+    err = capsys.readouterr()[1].splitlines()
+    assert [line for line in err if not line.startswith("Warning")] == [
+        ok.format(book, outdir.join("book.xml")),
+        ok.format(other, outdir.join("other.xml")),
+        ok.format(book, outdir.join("book.xml")),
+    ]
+
+    assert dbxincluder.main(["", "--watch", "-"]) == 1
+    assert capsys.readouterr()[1] == "--watch needs an input file and no --depfile\n"
+
+
+def test_stats(tmpdir, capsys):
+    """--stats reports phases, counters and caches of the run"""
+    stats = dbxincluder.stats
+    tmpdir.join("book.xml").write(
+        "<book xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='part.xml' fragid='p'/><xi:include href='part.xml'/>"
+        "<xi:include href='text.txt' parse='text/plain'/></book>"
+    )
+    tmpdir.join("part.xml").write("<part xml:id='p'><para/></part>")
+    tmpdir.join("text.txt").write("text")
+    output = str(tmpdir.join("out.xml"))
+    argv = ["", "--stats", "json", "-o", output, str(tmpdir.join("book.xml"))]
+    assert dbxincluder.main(argv) == 0
+    assert not stats.ENABLED
+    report = json.loads(capsys.readouterr()[1])
+    assert list(report["phases"]) == [
+        "parse",
+        "xinclude",
+        "catalog",
+        "fetch",
+        "fragid",
+        "docbook ids",
+        "docbook references",
+        "docbook namespaces",
+        "serialize",
+        "total",
+    ]
+    assert report["phases"]["fetch"]["calls"] == 3
+    assert report["counters"]["includes"] == 3
+    assert report["counters"]["parsed_documents"] == 2
+    assert report["counters"]["parsed_elements"] == 6
+    assert report["counters"]["catalog_lookups"] == 3
+    assert report["caches"]["targets"]["misses"] == 1
+    assert report["caches"]["targets"]["hits"] == 1
+    assert report["peak_rss"] > 0
+
+    # The workers send their statistics back
+    assert dbxincluder.main(argv[:3] + ["-j", "2"] + argv[3:]) == 0
+    parallel = json.loads(capsys.readouterr()[1])
+    assert parallel["counters"]["includes"] == 3
+
+    argv[2] = "text"
+    assert dbxincluder.main(argv) == 0
+    text = capsys.readouterr()[1].splitlines()
+    assert text[0].split() == ["Phase", "Calls", "Wall", "s", "CPU", "s"]
+    assert text[text.index("") + 1].split() == ["includes", "3"]
+
+    argv[2] = "xml"
+    assert dbxincluder.main(argv) == 1
+    err = capsys.readouterr()[1]
+    assert err == "Invalid option value: --stats must be text or json\n"
+
+    # Nested phases of the same name are measured once
+    stats.ENABLED = True
+    stats.reset()
+    with stats.phase("custom"):
+        with stats.phase("custom"):
+            pass
+    stats.ENABLED = False
+    assert list(stats.report()["phases"]) == ["custom", "total"]
+    assert stats.PHASES["custom"][0] == 1
+
+
+def test_trace(tmpdir, capsys):
+    """--trace writes nested spans of the includes and phases"""
+    stats = dbxincluder.stats
+    tmpdir.join("book.xml").write(
+        "<book xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='part.xml'/><xi:include href='part.xml'/>"
+        "<xi:include href='part.xml'/>"
+        "<xi:include href='text.txt' parse='text/plain'/></book>"
+    )
+    tmpdir.join("part.xml").write(
+        "<part xmlns:xi='http://www.w3.org/2001/XInclude'><para/>"
+        "<xi:include href='chapter.xml' fragid='c'/>"
+        "<xi:include href='missing.xml'><xi:fallback>x<b/></xi:fallback>"
+        "</xi:include>y</part>"
+    )
+    tmpdir.join("chapter.xml").write("<chapter xml:id='c'><para/></chapter>")
+    tmpdir.join("text.txt").write("text")
+    trace = tmpdir.join("trace.json")
+    output = str(tmpdir.join("out.xml"))
+    argv = ["", "--trace", str(trace), "-o", output, str(tmpdir.join("book.xml"))]
+    assert dbxincluder.main(argv) == 0
+    assert stats.TRACE is None
+    err = capsys.readouterr()[1]
+    assert "part.xml:1: Could not get target" in err
+
+    # Tracing doesn't change the result
+    result = tmpdir.join("out.xml").read()
+    assert dbxincluder.main(argv[:1] + argv[3:]) == 0
+    assert capsys.readouterr()[1] == err
+    assert tmpdir.join("out.xml").read() == result
+
+    events = json.loads(trace.read())["traceEvents"]
+    assert events[0]["ph"] == "M"
+    assert events[0]["args"] == {"name": "dbxincluder"}
+    spans = [event for event in events if event["ph"] == "X"]
+    includes = [event for event in spans if event["cat"] == "include"]
+    # The second include of part.xml is recorded, the third reuses it
+    assert [event["name"] for event in includes] == [
+        "chapter.xml",
+        "missing.xml",
+        "part.xml",
+        "chapter.xml",
+        "missing.xml",
+        "part.xml",
+        "part.xml",
+        "text.txt",
+    ]
+    chapter, missing, part = (event["args"] for event in includes[:3])
+    cached, text = (event["args"] for event in includes[-2:])
+    assert chapter == {
+        "href": "chapter.xml",
+        "fragid": "c",
+        "parse": "xml",
+        "url": str(tmpdir.join("chapter.xml")),
+        "bytes": 37,
+        "cached": False,
+        "elements": 2,
+    }
+    assert missing["fallback"] and missing["elements"] == 1
+    assert part["elements"] == cached["elements"] == 5
+    assert not part["cached"] and cached["cached"]
+    assert text["bytes"] == text["characters"] == 4
+
+    def inside(inner, outer):
+        end = outer["ts"] + outer["dur"]
+        return outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= end
+
+    by_name = {event["name"]: event for event in spans}
+    assert inside(includes[0], includes[2]) and inside(includes[1], includes[2])
+    assert not inside(includes[-2], includes[2])
+    assert inside(includes[2], by_name["xinclude"])
+    for name in ("xinclude", "docbook ids", "docbook references", "serialize"):
+        assert inside(by_name[name], by_name["document"])
+    assert by_name["document"]["args"] == {"path": str(tmpdir.join("book.xml"))}
+
+    # The workers send their spans back
+    assert dbxincluder.main(argv[:3] + ["-j", "2"] + argv[3:]) == 0
+    capsys.readouterr()
+    events = json.loads(trace.read())["traceEvents"]
+    workers = {event["pid"] for event in events if event["name"] == "part.xml"}
+    assert os.getpid() not in workers
+    names = [event["args"]["name"] for event in events if event["ph"] == "M"]
+    assert sorted(names)[-1] == "dbxincluder worker"
+
+    argv[2] = str(tmpdir)
+    assert dbxincluder.main(argv) == 1
+    assert capsys.readouterr()[1].splitlines()[-1].startswith("Could not write")
+
+    # Ending a span drops the ones left open inside it
+    stats.TRACE = []
+    outer = stats.begin_span("outer", "test")
+    inner = stats.begin_span("inner", "test")
+    stats.end_span(outer)
+    stats.end_span(inner)
+    assert [event["name"] for event in stats.TRACE] == ["outer"]
+    stats.TRACE = None
+    assert stats.begin_span("outer", "test") is None
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("urn:x-dbxi:uri.xml", "uri.xml"),
+        ("urn:x-dbxi:both.xml", "system.xml"),
+        ("http://dbxi.example/a.xml", "short/a.xml"),
+        ("http://dbxi.example/long/b.xml", "long/b.xml"),
+        ("http://dbxi-uri.example/c.xml", "/uri/c.xml"),
+        ("urn:x-dbxi:group.xml", "file:///group/group.xml"),
+        ("urn:x-dbxi:next.xml", "subdir/next.xml"),
+        ("http://x.example/suffix.xml", "suffix.xml"),
+        ("http://x.example/urisuffix.xml", "urisuffix.xml"),
+        ("urn:x-dbxi:nonexistant.xml", None),
+    ],
+)
+def test_native_catalog(url, expected):
+    """Test the native catalog resolver"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    catalog = location + "/cases/xmlcatalog-chain.xml"
+    if expected is not None and ":" not in expected and expected[0] != "/":
+        expected = location + "/cases/" + expected  # Relative to the catalog
+    assert dbxincluder.xmlcat.native_lookup(url, catalog) == expected
+
+
+def test_native_catalog_unsupported():
+    """Constructs the native resolver doesn't handle need xmlcatalog"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    xmlcat = dbxincluder.xmlcat
+    catalog = location + "/cases/xmlcatalog-chain.xml"
+
+    for url, unsupported in [
+        ("http://delegated.example/a.xml", catalog),
+        ("-//DBXI//Test Document//EN", catalog),
+        ("urn:publicid:-:DBXI:Test:EN", catalog),
+        ("urn:x-dbxi:file.xml", location + "/cases/text.txt"),
+        ("urn:x-dbxi:file.xml", location + "/cases/basicxml.case.xml"),
+        ("urn:x-dbxi:file.xml", "http://dbxi.example/catalog.xml"),
+    ]:
+        with pytest.raises(xmlcat.UnsupportedCatalog):
+            xmlcat.native_lookup(url, unsupported)
+
+    # Not a URI and no public entries
+    assert xmlcat.native_lookup("not a uri", location + "/cases/xmlcatalog.xml") is None
+    # Catalog missing
+    assert xmlcat.native_lookup("urn:x-dbxi:file.xml", "file:///nonexistant") is None
+    # Falls back to xmlcatalog
+    assert xmlcat.lookup_url("http://delegated-uri.example/x.xml", catalog) == (
+        "http://delegated-uri.example/x.xml"
+    )
+    assert xmlcat.xmlcatalog_lookup("urn:x-dbxi:file.xml", catalog) == (
+        location + "/cases/text.txt"
+    )
+
+
+def test_catalog_disk_cache(tmpdir, monkeypatch):
+    """Catalog lookups are stored on disk, per version of the catalog chain"""
+    xmlcat = dbxincluder.xmlcat
+    location = os.path.dirname(os.path.realpath(__file__))
+    catalog = tmpdir.join("catalog.xml")
+    shutil.copy(location + "/cases/xmlcatalog.xml", str(catalog))
+    cachedir = tmpdir.join("cache")
+
+    monkeypatch.setattr(xmlcat, "DISK_CACHE_DIR", str(cachedir))
+    monkeypatch.setattr(xmlcat, "DISK_CACHES", {})
+    monkeypatch.setattr(xmlcat, "XMLCAT_CACHE", {})
+    monkeypatch.setattr(xmlcat, "CATALOG_CACHE", {})
+
+    assert xmlcat.lookup_url("urn:x-dbxi:file.xml", str(catalog)) == str(
+        tmpdir.join("text.txt")
+    )
+    xmlcat.flush_disk_cache()
+    xmlcat.flush_disk_cache()  # Nothing new
+    assert len(cachedir.listdir("*.json")) == 1
+
+    # Another process which doesn't need to resolve anything
+    monkeypatch.setattr(xmlcat, "DISK_CACHES", {})
+    monkeypatch.setattr(xmlcat, "XMLCAT_CACHE", {})
+    monkeypatch.setattr(xmlcat, "native_lookup", None)
+    assert xmlcat.lookup_url("urn:x-dbxi:file.xml", str(catalog)) == str(
+        tmpdir.join("text.txt")
+    )
+
+    # Concurrent writers merge their results
+    digest = xmlcat.catalog_chain_hash(str(catalog))
+    first = xmlcat.PersistentCache(str(cachedir), digest)
+    second = xmlcat.PersistentCache(str(cachedir), digest)
+    first.set("urn:first", "1")
+    second.set("urn:second", "2")
+    first.flush()
+    second.flush()
+    assert xmlcat.PersistentCache(str(cachedir), digest).entries == {
+        "urn:x-dbxi:file.xml": str(tmpdir.join("text.txt")),
+        "urn:first": "1",
+        "urn:second": "2",
+    }
+
+    # Writers flushing at the same time wait for each other
+    first.set("urn:shared", "first")
+    second.set("urn:shared", "second")
+    first.set("urn:third", "3")
+    second.set("urn:fourth", "4")
+    read = first._read
+    reading = threading.Event()
+
+    def slow_read():
+        entries = read()
+        reading.set()
+        time.sleep(0.2)
+        return entries
+
+    monkeypatch.setattr(first, "_read", slow_read)
+    thread = threading.Thread(target=first.flush)
+    thread.start()
+    reading.wait(5)
+    second.flush()
+    thread.join()
+    entries = xmlcat.PersistentCache(str(cachedir), digest).entries
+    assert entries["urn:shared"] == "second"
+    assert entries["urn:third"] == "3" and entries["urn:fourth"] == "4"
+    assert entries["urn:first"] == "1" and entries["urn:second"] == "2"
+
+    # Changing the catalog invalidates the results
+    catalog.write(catalog.read().replace("text.txt", "other.txt"))
+    monkeypatch.undo()
+    monkeypatch.setattr(xmlcat, "DISK_CACHE_DIR", str(cachedir))
+    monkeypatch.setattr(xmlcat, "DISK_CACHES", {})
+    monkeypatch.setattr(xmlcat, "XMLCAT_CACHE", {})
+    monkeypatch.setattr(xmlcat, "CATALOG_CACHE", {})
+    assert xmlcat.get_disk_cache(str(catalog)).get("urn:x-dbxi:file.xml") is None
+
+    # Catalogs which can't be parsed are hashed as well
+    other = xmlcat.catalog_chain_hash(location + "/cases/text.txt")
+    assert other != xmlcat.catalog_chain_hash(str(tmpdir.join("missing.xml")))
+
+    # Changes of remote catalogs can't be detected, their lookups aren't stored
+    remote = tmpdir.join("remote.xml")
+    remote.write(
+        "<catalog xmlns='urn:oasis:names:tc:entity:xmlns:xml:catalog'>"
+        "<nextCatalog catalog='http://dbxi.example/catalog.xml'/></catalog>"
+    )
+    assert xmlcat.catalog_chain_hash(str(remote)) is None
+    assert xmlcat.get_disk_cache(str(remote)) is None
+    assert xmlcat.get_disk_cache(str(remote)) is None
+    xmlcat.flush_disk_cache()
+
+    # Unreadable cache files are ignored
+    cachedir.join("broken").write("[]")
+    broken = xmlcat.PersistentCache(str(cachedir), digest)
+    broken.path = str(cachedir.join("broken"))
+    assert broken._read() == {}
+
+
+def test_check_catalogs(tmpdir, monkeypatch):
+    """Catalog data is dropped when a catalog file changes"""
+    xmlcat = dbxincluder.xmlcat
+    location = os.path.dirname(os.path.realpath(__file__))
+    catalog = tmpdir.join("catalog.xml")
+    shutil.copy(location + "/cases/xmlcatalog.xml", str(catalog))
+
+    monkeypatch.setattr(xmlcat, "DISK_CACHES", {})
+    monkeypatch.setattr(xmlcat, "XMLCAT_CACHE", {})
+    monkeypatch.setattr(xmlcat, "CATALOG_CACHE", {})
+    monkeypatch.setattr(xmlcat, "CATALOG_STAMPS", {})
+
+    assert xmlcat.lookup_url("urn:x-dbxi:file.xml", str(catalog)) == str(
+        tmpdir.join("text.txt")
+    )
+    assert xmlcat.check_catalogs() is False
+    # A remote catalog can't be checked
+    assert xmlcat.catalog_stamp("http://dbxi.example/catalog.xml") is None
+
+    catalog.write(catalog.read().replace("text.txt", "other.txt"))
+    assert xmlcat.check_catalogs() is True
+    assert xmlcat.XMLCAT_CACHE == xmlcat.CATALOG_STAMPS == {}
+    assert xmlcat.lookup_url("urn:x-dbxi:file.xml", str(catalog)) == str(
+        tmpdir.join("other.txt")
+    )
+
+    # Removing it counts as change as well
+    catalog.remove()
+    assert xmlcat.check_catalogs() is True
+    assert xmlcat.check_catalogs() is False
+
+
+def test_catalog_cache_option(tmpdir, capsys, monkeypatch):
+    """--catalog-cache writes the lookups of a run"""
+    # main sets it, it's restored afterwards
+    monkeypatch.setattr(dbxincluder.xmlcat, "DISK_CACHE_DIR", None)
+    monkeypatch.setattr(dbxincluder.xmlcat, "DISK_CACHES", {})
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    assert (
+        dbxincluder.main(
+            [
+                "",
+                "--catalog-cache",
+                str(tmpdir),
+                "-c",
+                location + "/cases/xmlcatalog-chain.xml",
+                location + "/cases/xmlinclude.case.xml",
+            ]
+        )
+        == 0
+    )
+    capsys.readouterr()
+    assert len(tmpdir.listdir("*.json")) == 1
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Local stand-in for a documentation server."""
+
+    daemon_threads = True
+
+
+def start_server(handler):
+    """Return a ThreadingServer with handler, serving in a thread."""
+    server = ThreadingServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CachingHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the class attribute files with validators and counts requests."""
+
+    protocol_version = "HTTP/1.1"
+    files = {}
+    log = []
+    connections = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        if self.path in ("/redirect", "/loop"):
+            target = "/a.xml" if self.path == "/redirect" else "/loop"
+            self.respond(302, b"", {"Location": target})
+            return
+        if self.path == "/bye":
+            self.respond(200, b"bye", {"Connection": "close"})
+            return
+        if self.path == "/close":
+            # Close without telling the client, like an idle timeout
+            self.respond(200, b"closed")
+            self.close_connection = True
+            return
+        if self.path not in self.files:
+            self.respond(404, b"not found")
+            return
+
+        body, headers = self.files[self.path]
+        etag = headers.get("ETag")
+        modified = headers.get("Last-Modified")
+        if (etag and self.headers.get("If-None-Match") == etag) or (
+            modified and self.headers.get("If-Modified-Since") == modified
+        ):
+            self.respond(304, b"", headers)
+        else:
+            self.respond(200, body, headers)
+
+    def respond(self, status, body, headers=None):
+        self.log.append((self.path, status))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_httpcache(tmpdir):
+    """HTTP targets are revalidated, kept across runs and served offline"""
+    httpcache = dbxincluder.httpcache
+    CachingHandler.files = {
+        "/a.xml": (b"<a/>", {"ETag": '"1"'}),
+        "/b.xml": (b"<b/>", {"Last-Modified": "Mon, 02 Jan 2017 00:00:00 GMT"}),
+        "/c.xml": (b"<c/>", {"Cache-Control": "no-store"}),
+        "/d.xml?v=1": (b"<d/>", {}),
+    }
+    CachingHandler.log = log = []
+    CachingHandler.connections = connections = []
+    server = start_server(CachingHandler)
+    url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+    httpcache.CACHE_DIR = str(tmpdir)
+    try:
+        assert httpcache.fetch(url + "a.xml") == b"<a/>"
+        assert httpcache.fetch(url + "b.xml", timeout=5) == b"<b/>"
+        assert httpcache.fetch(url + "c.xml") == b"<c/>"
+        assert httpcache.fetch(url + "a.xml") == b"<a/>"
+        assert httpcache.fetch(url + "b.xml") == b"<b/>"
+        assert httpcache.fetch(url + "c.xml") == b"<c/>"
+        assert httpcache.fetch(url + "redirect") == b"<a/>"
+        assert [status for _, status in log] == [200, 200, 200, 304, 304, 200, 302, 200]
+        assert len(connections) == 1
+
+        # Changed on the server
+        CachingHandler.files["/a.xml"] = (b"<new/>", {"ETag": '"2"'})
+        assert httpcache.fetch(url + "a.xml") == b"<new/>"
+
+        with pytest.raises(urllib.error.HTTPError):
+            httpcache.fetch(url + "missing.xml")
+        with pytest.raises(urllib.error.URLError):
+            httpcache.fetch(url + "loop")
+
+        assert httpcache.fetch(url + "d.xml?v=1") == b"<d/>"
+        assert httpcache.fetch(url + "bye") == b"bye"
+        assert len(connections) == 1
+        assert httpcache.fetch(url + "a.xml") == b"<new/>"
+        assert len(connections) == 2
+
+        # The server closed the kept-alive connection in the meantime
+        assert httpcache.fetch(url + "close") == b"closed"
+        assert httpcache.fetch(url + "a.xml") == b"<new/>"
+        assert len(connections) == 3
+    finally:
+        httpcache.CONNECTIONS.close()
+        server.shutdown()
+        server.server_close()
+
+    with pytest.raises(urllib.error.URLError):
+        httpcache.fetch(url + "a.xml")
+
+    httpcache.OFFLINE = True
+    try:
+        assert httpcache.fetch(url + "a.xml") == b"<new/>"
+        with pytest.raises(urllib.error.URLError):
+            httpcache.fetch(url + "c.xml")
+
+        # Unreadable and foreign entries are ignored
+        tmpdir.join(os.path.basename(httpcache.cache_path(url + "a.xml"))).write("x")
+        os.replace(httpcache.cache_path(url + "b.xml"), httpcache.cache_path(url + "x"))
+        for name in ("a.xml", "x"):
+            with pytest.raises(urllib.error.URLError):
+                httpcache.fetch(url + name)
+
+        # Offline without cache directory
+        httpcache.CACHE_DIR = None
+        with pytest.raises(urllib.error.URLError):
+            httpcache.fetch(url + "d.xml?v=1")
+    finally:
+        httpcache.OFFLINE = False
+        httpcache.CACHE_DIR = None
+
+
+def test_httpcache_https():
+    """HTTPS URLs get HTTPS connections"""
+    connection, idle = dbxincluder.httpcache.CONNECTIONS.get("https", "example.invalid")
+    assert isinstance(connection, http.client.HTTPSConnection) and not idle
+
+
+def test_httpcache_option(tmpdir, capsys):
+    """--http-cache and --offline are used for includes"""
+    CachingHandler.files = {"/a.xml": (b"<a/>", {"ETag": '"1"'})}
+    server = start_server(CachingHandler)
+    url = "http://127.0.0.1:{0}/a.xml".format(server.server_address[1])
+    source = tmpdir.join("doc.xml")
+    source.write(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='{0}'/></doc>".format(url)
+    )
+    cache = str(tmpdir.join("cache"))
+    try:
+        dbxincluder.xinclude.TARGET_CACHE.clear()
+        assert dbxincluder.main(["", "--http-cache", cache, str(source)]) == 0
+        expected = capsys.readouterr()
+        assert "<a xml:base=" in expected[0]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    dbxincluder.xinclude.TARGET_CACHE.clear()
+    assert dbxincluder.main(["", "--http-cache", cache, "--offline", str(source)]) == 0
+    assert capsys.readouterr() == expected
+    dbxincluder.httpcache.CACHE_DIR = None
+    dbxincluder.httpcache.OFFLINE = False
+
+
+def test_httpcache_jobs(tmpdir, capsys, monkeypatch):
+    """Workers don't use the idle connections left by prefetching"""
+    CachingHandler.files = {
+        "/a.xml": (b"<a/>", {"ETag": '"1"'}),
+        "/b.xml": (b"<b/>", {"ETag": '"1"'}),
+    }
+    CachingHandler.connections = connections = []
+    server = start_server(CachingHandler)
+    url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+    source = tmpdir.join("doc.xml")
+    source.write(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'><xi:include href='{0}a.xml'/>"
+        "<xi:include href='{0}b.xml'/></doc>".format(url)
+    )
+    # Only a.xml is prefetched, b.xml is fetched by a worker
+    monkeypatch.setattr(
+        dbxincluder.xinclude, "TARGET_CACHE", dbxincluder.utils.LRUCache(1)
+    )
+    argv = ["", "--http-cache", str(tmpdir.join("cache")), "--prefetch", "2"]
+    try:
+        assert dbxincluder.main(argv + ["-j", "2", str(source)]) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        dbxincluder.httpcache.CACHE_DIR = None
+
+    assert "<b xml:base=" in capsys.readouterr()[0]
+    assert len(connections) == 2
+
+    # A worker drops the inherited pool without closing its connections
+    pool = dbxincluder.httpcache.ConnectionPool()
+    monkeypatch.setattr(dbxincluder.httpcache, "CONNECTIONS", pool)
+    connection = http.client.HTTPConnection("example.invalid")
+    pool.put("http", "example.invalid", connection)
+    dump = dbxincluder.parallel.dump_tree(lxml.etree.fromstring("<doc/>"))
+    settings = (None, None, False, None, False, False)
+    dbxincluder.parallel.init_worker(dump, None, None, None, settings)
+    assert dbxincluder.httpcache.CONNECTIONS is not pool
+    assert pool.get("http", "example.invalid") == (connection, True)
+
+
+def test_prefetch(tmpdir):
+    """Targets of nested includes are fetched into TARGET_CACHE"""
+    xinclude = dbxincluder.xinclude
+    xi = "xmlns:xi='http://www.w3.org/2001/XInclude'"
+    tmpdir.join("a.xml").write(
+        "<a {0}><xi:include href='b.xml'/><xi:include href='t.txt' parse='text/plain'/>"
+        "<xi:include href='missing.xml'><xi:fallback>x<b/></xi:fallback></xi:include> "
+        "<xi:include href='b.xml' fragid='x'/></a>".format(xi)
+    )
+    tmpdir.join("b.xml").write(
+        "<b {0} xml:id='x'><xi:include href='sub/c.xml'><xi:fallback>"
+        "<xi:include href='bad.xml'/></xi:fallback></xi:include></b>".format(xi)
+    )
+    tmpdir.mkdir("sub").join("c.xml").write("<c/>")
+    tmpdir.join("t.txt").write("text")
+    tmpdir.join("bad.xml").write("<bad>")
+
+    xinclude.TARGET_CACHE.clear()
+    base = str(tmpdir.join("a.xml"))
+    tree = lxml.etree.parse(base).getroot()
+    urls = dbxincluder.prefetch.prefetch_tree(tree, base, jobs=2, timeout=5)
+    # Local text files are mapped by fetch_text when needed
+    names = ["b.xml", "missing.xml", "sub/c.xml", "bad.xml"]
+    assert urls == {str(tmpdir.join(name)) for name in names}
+    assert len(xinclude.TARGET_CACHE) == 3
+
+    dbxincluder.docbook.process_tree(tree, base)
+    assert tree.find("b/c") is not None
+    assert xinclude.TARGET_CACHE.stats()["misses"] == 1
+
+
+def test_prefetch_limits(tmpdir, monkeypatch):
+    """Prefetching stops once TARGET_CACHE is full"""
+    xi = "xmlns:xi='http://www.w3.org/2001/XInclude'"
+    tmpdir.join("a.xml").write(
+        "<a {0}><xi:include href='b.xml'/><xi:include href='c.xml'/></a>".format(xi)
+    )
+    monkeypatch.setattr(
+        dbxincluder.xinclude, "TARGET_CACHE", dbxincluder.utils.LRUCache(1)
+    )
+    base = str(tmpdir.join("a.xml"))
+    tree = lxml.etree.parse(base).getroot()
+    assert len(dbxincluder.prefetch.prefetch_tree(tree, base)) == 1
+
+
+def test_prefetch_host_limit():
+    """No more than host_limit requests run in parallel per host"""
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                running.append(self.path)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", "3")
+            self.end_headers()
+            self.wfile.write(b"abc")
+
+        def log_message(self, *args):
+            pass
+
+    server = start_server(Handler)
+    try:
+        url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+        tree = lxml.etree.fromstring(
+            "<a xmlns:xi='http://www.w3.org/2001/XInclude'>"
+            + "".join(
+                "<xi:include href='{0}{1}' parse='text/plain'/>".format(url, i)
+                for i in range(6)
+            )
+            + "</a>"
+        )
+        dbxincluder.xinclude.TARGET_CACHE.clear()
+        urls = dbxincluder.prefetch.prefetch_tree(
+            tree, "doc.xml", jobs=4, host_limit=2, timeout=5
+        )
+        assert len(urls) == 6
+        assert max(peak) <= 2
+        assert dbxincluder.xinclude.TARGET_CACHE.get(url + "0") == b"abc"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_prefetch_option(capsys):
+    """--prefetch gives the same output"""
+    location = os.path.relpath(os.path.dirname(os.path.realpath(__file__)))
+    case = location + "/cases/transclusion.case.xml"
+    assert dbxincluder.main(["", case]) == 0
+    expected = capsys.readouterr()
+    assert dbxincluder.main(["", "--prefetch", "3", case]) == 0
+    assert capsys.readouterr() == expected
+
+    assert dbxincluder.main(["", "--host-limit", "0", case]) == 1
+    assert dbxincluder.main(["", "--timeout", "x", case]) == 1
+    assert capsys.readouterr()[1].startswith("Invalid option value")
+
+
+def test_timeout_option(tmpdir, capsys):
+    """--timeout applies to the includes processed without prefetching"""
+    answer = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            answer.wait(10)
+
+        def log_message(self, *args):
+            pass
+
+    server = start_server(Handler)
+    source = tmpdir.join("doc.xml")
+    source.write(
+        "<doc xmlns:xi='http://www.w3.org/2001/XInclude'>"
+        "<xi:include href='http://127.0.0.1:{0}/slow.xml'>"
+        "<xi:fallback>x<b/></xi:fallback></xi:include>y</doc>".format(
+            server.server_address[1]
+        )
+    )
+    start = time.monotonic()
+    try:
+        assert dbxincluder.main(["", "--timeout", "0.2", str(source)]) == 0
+    finally:
+        answer.set()
+        server.shutdown()
+        server.server_close()
+
+    assert time.monotonic() - start < 5
+    assert "timed out" in capsys.readouterr()[1]
+
+
+def test_find_target():
+    """Test reference resolution for all linkscopes"""
+    tree = lxml.etree.fromstring(
+        "<book><chapter xml:id='c1'><para xml:id='a'/><sect><ref/></sect></chapter>"
+        "<chapter xml:id='c2'><para xml:id='b'/><!-- comment --></chapter></book>"
+    )
+    ref = tree[0][1][0]
+    find_target = dbxincluder.docbook.find_target
+    assert find_target(ref, tree, "b", "global") is tree[1][0]
+    assert find_target(ref, tree, "c2", "local") is tree[1]
+    assert find_target(ref, tree[1], "b", "local") is tree[1][0]
+    assert find_target(ref, tree, "a", "near") is tree[0][0]
+    assert find_target(ref, tree, "c2", "near") is tree[1]
+    assert find_target(ref, tree, "b", "near") is None
+    for linkscope in ("global", "local", "near"):
+        assert find_target(ref, tree, "nonexistant", linkscope) is None
+
+
+def test_find_target_near_xpath():
+    """near references resolve like the XPath based implementation did"""
+    location = os.path.dirname(os.path.realpath(__file__))
+    tree = lxml.etree.parse(location + "/cases/linkscopes.out.xml").getroot()
+    index = dbxincluder.docbook.IDIndex(tree)
+    ids = tree.xpath("//@xml:id")
+    for elem in tree.iter():
+        for value in ids:
+            expected = None
+            for ancestor in elem.iterancestors():
+                target = ancestor.xpath("./*[@xml:id={0!r}]".format(value))
+                if target:
+                    expected = target[0]
+                    break
+
+            found = dbxincluder.docbook.find_target(elem, tree, value, "near", index)
+            assert found is expected
+
+
+def test_inherited_attributes():
+    """iter_inherited_attributes matches get_inherited_attribute"""
+    tree = lxml.etree.fromstring(
+        "<a xmlns:trans='http://docbook.org/ns/transclude' trans:suffix='-a'>"
+        "<b trans:idfixup='suffix'><c trans:suffix=''/><!-- comment --></b>"
+        "<d><e trans:idfixup='none' trans:suffix='-e'/></d></a>"
+    )
+    utils = dbxincluder.utils
+    attributes = ["trans:suffix", "trans:idfixup"]
+    for subtree in (tree, tree[1]):
+        walked = list(utils.iter_inherited_attributes(subtree, attributes))
+        assert [elem for elem, _ in walked] == list(subtree.iter(lxml.etree.Element))
+        for elem, inherited in walked:
+            for attribute in attributes:
+                expected = utils.get_inherited_attribute(elem, attribute)
+                assert inherited[attribute] == expected
+
+
+def test_associate_new_ids():
+    """Nested idfixup elements stack their transformations"""
+    tree = lxml.etree.fromstring(
+        "<a xmlns:trans='http://docbook.org/ns/transclude' trans:suffix='-a'>"
+        "<b trans:idfixup='suffix' xml:id='b'><!-- comment -->"
+        "<c trans:idfixup='auto' xml:id='c'><d trans:idfixup='suffix' xml:id='d'"
+        " trans:suffix='-d'/></c></b><e xml:id='e'/></a>"
+    )
+    b, c, d, e = tree[0], tree[0][1], tree[0][1][0], tree[1]
+    new_ids = dbxincluder.docbook.associate_new_ids(c).new_ids
+    assert b not in new_ids
+    assert new_ids[c] == "c--" + dbxincluder.utils.generate_id(c)
+    index = dbxincluder.docbook.associate_new_ids(tree)
+    assert index.new_ids[b] == "b-a"
+    assert index.new_ids[c] == "c-a--" + dbxincluder.utils.generate_id(c)
+    assert index.new_ids[d] == "d-a--" + dbxincluder.utils.generate_id(d) + "-d"
+    assert e not in index.new_ids
+    assert index.find("e") is e
+    assert tree.get(dbxincluder.utils.QN["trans:suffix"]) == "-a"
+
+
+def test_fused_passes():
+    """Flattening and indexing during associate_new_ids match separate passes"""
+    source = (
+        "<d:a xmlns:d='http://docbook.org/ns/docbook'"
+        " xmlns:xi='http://www.w3.org/2001/XInclude'"
+        " xmlns:trans='http://docbook.org/ns/transclude'>"
+        "<xi:fallback>1<xi:fallback>2<d:b xml:id='b'/>3</xi:fallback>4</xi:fallback>5"
+        "<d:c trans:idfixup='auto' xml:id='c'><d:b xml:id='b2' linkend='b2'/></d:c>"
+        "<d:e linkend='b'/></d:a>"
+    )
+    separate = lxml.etree.fromstring(source)
+    dbxincluder.xinclude.flatten_subtree(separate)
+    separate_index = dbxincluder.docbook.associate_new_ids(separate)
+
+    fused = lxml.etree.fromstring(source)
+    index = dbxincluder.docbook.IDIndex()
+    assert dbxincluder.docbook.associate_new_ids(fused, index) is index
+    assert sorted(index.ids) == ["b", "b2", "c"]
+    assert sorted(index.new_ids.values()) == sorted(separate_index.new_ids.values())
+    assert lxml.etree.tostring(fused) == lxml.etree.tostring(separate)
+
+    dbxincluder.docbook.fixup_references(fused, index, cleanup=True)
+    dbxincluder.docbook.fixup_references(separate, separate_index)
+    for elem in separate.iter():
+        dbxincluder.docbook.cleanup_attributes(elem, separate_index)
+    assert lxml.etree.tostring(fused) == lxml.etree.tostring(separate)
+    assert fused.text == "12" and fused[0].tail == "345"
+
+
+def test_child_path_steps():
+    """Paths built from child_path_steps match getpath"""
+    root = lxml.etree.fromstring(
+        "<r xmlns:p='urn:1' xmlns:q='urn:2'><a/><a/><b/><!-- c --><p:a/>"
+        "<p:a xmlns:p='urn:3'/><q:a/><d xmlns='urn:4'><x/><y/><z xmlns=''/></d>"
+        "<e xmlns='urn:5'/><?pi?><b><a/></b></r>"
+    )
+    doc = root.getroottree()
+    paths = {root: doc.getpath(root)}
+    for elem in root.iter(lxml.etree.Element):
+        for child, step in dbxincluder.utils.child_path_steps(elem):
+            paths[child] = paths[elem] + "/" + step
+
+    assert len(paths) == 14
+    for elem, path in paths.items():
+        assert path == doc.getpath(elem)